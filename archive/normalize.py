@@ -8,8 +8,11 @@ import seaborn as sns
 import statsmodels.stats.multitest
 import pybedtools
 import sys
+import os
+import logging
 from cooltools.lib.numutils import set_diag
 import pickle
+import time
 
 
 def CTALE_norm_multiplicate(mtx, ROI_start, ROI_end, resolution, func=scipy.stats.gmean, mult=1.54):
@@ -70,6 +73,107 @@ def CTALE_norm(mtx, ROI_start, ROI_end, resolution, func=scipy.stats.gmean):
     return (normalized)
 
 
+def pairwise_mean(a, b, func=scipy.stats.gmean):
+    """Vectorized func([a[i], b[j]]) for every i, j.
+    a, b - 1D arrays (row and column marginals)
+    func - function for calculating mean, as in CTALE_norm
+    returns len(a) x len(b) matrix"""
+    if func is scipy.stats.gmean:
+        return (np.sqrt(np.outer(a, b)))  # gmean of two values in closed form
+    if func in (np.mean, np.median, np.average):
+        return ((a[:, None] + b[None, :]) / 2)
+    return (func(np.broadcast_arrays(a[:, None], b[None, :]), axis=0))
+
+
+def CTALE_norm_stripe(rows, cols, start_bin, end_bin, func=scipy.stats.gmean):
+    """Vectorized kernel of CTALE_norm working on the ROI stripe only.
+    rows - ROI rows of the matrix, shape (end_bin - start_bin, N), diagonal already zeroed
+    cols - ROI columns of the matrix, shape (N, end_bin - start_bin), diagonal already zeroed
+    start_bin, end_bin - ROI bins
+    func - function for calculating mean, can be numpy.mean,numpy.median and etc. Default: scipy.stats.gmean
+    Normalized matrix is symmetric and zero outside of the ROI stripe, so it is fully
+    described by its ROI rows.
+    returns (normalized ROI rows, row marginals, upper-triangle marginals)"""
+    # marginals are computed once per call instead of once per bin pair
+    row_sum = rows.sum(axis=1)
+    col_sum = cols.sum(axis=0)
+    upper_sum = np.triu(rows, start_bin).sum(axis=1) + np.triu(cols, 1 - start_bin).sum(axis=0)  # left + up
+    roi = slice(start_bin, end_bin)
+    # left: ROI rows right of the diagonal
+    normalized = rows / upper_sum[:, None]
+    # up: mirrored ROI columns above the ROI
+    normalized[:, :start_bin] = (cols[:start_bin, :] / upper_sum[None, :]).T
+    # ROI block: one broadcast instead of the double loop
+    block = rows[:, roi] / pairwise_mean(row_sum, col_sum, func=func)
+    diagonal = np.diagonal(normalized[:, roi]).copy()
+    upper = np.triu(np.ones(block.shape, dtype=bool), 1)
+    block = np.where(upper, block, block.T)
+    np.fill_diagonal(block, diagonal)
+    normalized[:, roi] = block
+    return (normalized, row_sum, upper_sum)
+
+
+def _roi_stripes(mtx, start_bin, end_bin, mult=1):
+    """Copies ROI rows and columns of dense or scipy.sparse matrix with zeroed diagonal,
+    multiplied by mult everywhere except the ROI block"""
+    if scipy.sparse.issparse(mtx):
+        mtx = mtx.tocsr()
+        rows = mtx[start_bin:end_bin, :].toarray().astype(float)
+        cols = mtx[:, start_bin:end_bin].toarray().astype(float)
+    else:
+        rows = np.array(mtx[start_bin:end_bin, :], dtype=float)
+        cols = np.array(mtx[:, start_bin:end_bin], dtype=float)
+    diagonal = np.arange(end_bin - start_bin)
+    rows[diagonal, diagonal + start_bin] = 0
+    cols[diagonal + start_bin, diagonal] = 0
+    if mult != 1:
+        block = rows[:, start_bin:end_bin].copy()
+        rows *= mult
+        cols *= mult
+        rows[:, start_bin:end_bin] = block
+        cols[start_bin:end_bin, :] = block
+    return (rows, cols)
+
+
+def _from_stripe(normalized, shape, start_bin, end_bin, sparse=False):
+    """Builds full symmetric matrix from normalized ROI rows"""
+    if sparse:
+        stripe = scipy.sparse.coo_matrix(normalized)
+        outside = (stripe.col < start_bin) | (stripe.col >= end_bin)
+        row = np.concatenate([stripe.row + start_bin, stripe.col[outside]])
+        col = np.concatenate([stripe.col, stripe.row[outside] + start_bin])
+        data = np.concatenate([stripe.data, stripe.data[outside]])
+        return (scipy.sparse.csr_matrix((data, (row, col)), shape=shape))
+    out = np.zeros(shape=shape)
+    out[start_bin:end_bin, :] = normalized
+    out[:, start_bin:end_bin] = normalized.T
+    return (out)
+
+
+def CTALE_norm_fast(mtx, ROI_start, ROI_end, resolution, func=scipy.stats.gmean, mult=1):
+    """Vectorized replacement of CTALE_norm (mult=1) and CTALE_norm_multiplicate.
+    Accepts dense numpy array or scipy.sparse matrix, sparse input gives sparse output.
+    mtx- matrix of individual chromosome/region +/- distance
+    ROI_start - first coordinate of C-TALE region(bp)
+    ROI_end - last coordinate of C-TALE region(bp)
+    resolution - C-TALE map resolution(bp)
+    func - function for calculating mean, can be numpy.mean,numpy.median and etc. Default: scipy.stats.gmean
+    mult-coefficient of multiplication around ROI, default=1
+    returns normalized matrix"""
+    start_bin = int(ROI_start / resolution)
+    end_bin = int(ROI_end / resolution)
+    sparse = scipy.sparse.issparse(mtx)
+    if not sparse:
+        # fill main diagonal with zeros, as CTALE_norm does
+        np.fill_diagonal(mtx, 0)
+    rows, cols = _roi_stripes(mtx, start_bin, end_bin, mult=mult)
+    normalized, row_sum, upper_sum = CTALE_norm_stripe(rows, cols, start_bin, end_bin, func=func)
+    if mult == 1:
+        average = mtx.sum() / (mtx.shape[0] * mtx.shape[1])
+        assert np.all(np.isclose(upper_sum, row_sum, atol=average / 100000))
+    return (_from_stripe(normalized, mtx.shape, start_bin, end_bin, sparse=sparse))
+
+
 def multiplicate(mtx, ROI_start, ROI_end, resolution, mult=1.54):
     """mtx- matrix of individual chromosome/region +/- distance
     ROI_start - first coordinate of C-TALE region(bp)
@@ -101,28 +205,228 @@ def CTALE_norm_iterative(mtx,ROI_start,ROI_end,resolution,func=scipy.stats.gmean
     end_bin=int(ROI_end/resolution)
     out=multiplicate(mtx=mtx,ROI_start=ROI_start,ROI_end=ROI_end,resolution=resolution,mult=mult)
     for s in range(steps):
-        out=CTALE_norm(out,ROI_start,ROI_end,resolution,func=func)
+        out=CTALE_norm_fast(out,ROI_start,ROI_end,resolution,func=func)
         var=np.var(np.sum(out[start_bin:end_bin,:],axis=1))
         print('Variance is: ',var)
         if var<tolerance:
             print('Variance < ',tolerance)
             break
     return(out)
-def Save_coolfile(coolfile,mtx,output_coolfile,genome):
+
+def fetch_roi_stripe(coolfile,chrom,ROI_start,ROI_end,resolution):
+    """Fetches ROI rows x whole chromosome from cool file with sparse fetch,
+    without building the whole chromosome matrix.
+    coolfile - cooler.Cooler object
+    chrom - chromosome of C-TALE region
+    ROI_start - first coordinate of C-TALE region(bp)
+    ROI_end - last coordinate of C-TALE region(bp)
+    resolution - C-TALE map resolution(bp)
+    returns dense ROI rows, shape (end_bin - start_bin, chromosome bins)"""
+    start_bin=int(ROI_start/resolution)
+    end_bin=int(ROI_end/resolution)
+    region=(chrom,start_bin*resolution,min(end_bin*resolution,coolfile.chromsizes[chrom]))
+    stripe=coolfile.matrix(balance=False,sparse=True).fetch(region,chrom)
+    return(stripe.toarray().astype(float))
+
+def CTALE_norm_iterative_stripe(rows,ROI_start,ROI_end,resolution,func=scipy.stats.gmean,mult=1.54,steps=20,tolerance=1e-5):
+    """Same as CTALE_norm_iterative, but works on ROI rows only.
+    Normalized matrix is symmetric and zero outside of the ROI stripe, so memory
+    scales with ROI size instead of chromosome size.
+    rows - ROI rows of symmetric matrix of individual chromosome (see fetch_roi_stripe)
+    ROI_start - first coordinate of C-TALE region(bp)
+    ROI_end - last coordinate of C-TALE region(bp)
+    resolution - C-TALE map resolution(bp)
+    func - function for calculating mean, can be numpy.mean,numpy.median and etc. Default: scipy.stats.gmean
+    mult-coefficient of multiplication around ROI, default=1.54
+    steps-number of iterations, by default=20
+    tolerance-when variance<tolerance algorithm stops.
+    returns normalized ROI rows"""
+    start_bin=int(ROI_start/resolution)
+    end_bin=int(ROI_end/resolution)
+    out=np.array(rows,dtype=float)
+    # fill main diagonal with zeros and multiply around region
+    diagonal=np.arange(end_bin-start_bin)
+    out[diagonal,diagonal+start_bin]=0
+    if mult!=1:
+        block=out[:,start_bin:end_bin].copy()
+        out*=mult
+        out[:,start_bin:end_bin]=block
+    for s in range(steps):
+        out,_,_=CTALE_norm_stripe(out,out.T,start_bin,end_bin,func=func)
+        var=np.var(np.sum(out,axis=1))
+        print('Variance is: ',var)
+        if var<tolerance:
+            print('Variance < ',tolerance)
+            break
+    return(out)
+
+def CTALE_norm_iterative_inplace(rows,ROI_start,ROI_end,resolution,mult=1.54,steps=20,tolerance=1e-5,weights=None,relaxation=1.0,logger=None):
+    """Same as CTALE_norm_iterative_stripe with scipy.stats.gmean, but iterates a scaling vector in place.
+    Each C-TALE step divides ROI row i outside the ROI by its sum R_i and ROI block pixel (i, j)
+    by sqrt(R_i * R_j), so the normalized stripe is always rows * w_i outside the ROI and
+    rows * sqrt(w_i * w_j) inside it. One step costs one ROI block product, all buffers are
+    allocated once.
+    rows - ROI rows of symmetric matrix of individual chromosome (see fetch_roi_stripe)
+    ROI_start - first coordinate of C-TALE region(bp)
+    ROI_end - last coordinate of C-TALE region(bp)
+    resolution - C-TALE map resolution(bp)
+    mult-coefficient of multiplication around ROI, default=1.54
+    steps-number of iterations, by default=20
+    tolerance-when variance<tolerance algorithm stops.
+    weights - scaling vector of previous run for the same capture (warm start), default: None
+    relaxation - over-relaxation factor, w_i is multiplied by R_i ** -relaxation on each step, default=1.0
+    logger - logging.Logger for step variance and time, default: print
+    ROI bins with no contacts are kept at zero.
+    returns (normalized ROI rows, scaling vector)"""
+    log=logger.info if logger is not None else print
+    start_bin=int(ROI_start/resolution)
+    end_bin=int(ROI_end/resolution)
+    size=end_bin-start_bin
+    diagonal=np.arange(size)
+    # ROI block and sum outside of the ROI, with zero diagonal and multiplication around region
+    block=np.array(rows[:,start_bin:end_bin],dtype=float)
+    block[diagonal,diagonal]=0
+    outside=(np.sum(rows,axis=1)-np.sum(rows[:,start_bin:end_bin],axis=1))*mult
+    # preallocated buffers
+    if weights is not None and len(weights)!=size:
+        log(f'Warm start weights have {len(weights)} bins, ROI has {size}; starting from scratch')
+        weights=None
+    w=np.ones(size) if weights is None else np.array(weights,dtype=float)
+    root=np.empty(size)
+    row_sum=np.empty(size)
+    factor=np.empty(size)
+
+    def update_row_sum():
+        np.sqrt(w,out=root)
+        np.dot(block,root,out=row_sum)
+        np.multiply(row_sum,root,out=row_sum)
+        np.multiply(w,outside,out=factor)
+        np.add(row_sum,factor,out=row_sum)
+
+    update_row_sum()
+    empty=row_sum<=0
+    w[empty]=0
+    for s in range(steps):
+        start_time=time.time()
+        if relaxation==1:
+            np.divide(w,row_sum,out=w,where=~empty)
+        else:
+            np.power(row_sum,-relaxation,out=factor,where=~empty)
+            np.multiply(w,factor,out=w,where=~empty)
+        update_row_sum()
+        var=np.var(row_sum[~empty])
+        log(f'Step {s+1}: variance is {var}, {time.time()-start_time:.3f} s')
+        if var<tolerance:
+            log(f'Variance < {tolerance}')
+            break
+    # normalized stripe
+    out=np.array(rows,dtype=float)
+    out*=(w*mult)[:,None]
+    np.sqrt(w,out=root)
+    out[:,start_bin:end_bin]=block*np.outer(root,root)
+    return(out,w)
+
+def iter_upper_pixels(mtx,offset=0,chunksize=1000):
+    """Yields upper-triangle pixels of dense matrix in bin-sorted chunks,
+    without dense triu copy of the whole matrix.
+    mtx - matrix to write
+    offset - bin id of the matrix start in cool file
+    chunksize - number of matrix rows per chunk
+    yields pixels DataFrames"""
+    for lo in range(0,mtx.shape[0],chunksize):
+        chunk=mtx[lo:lo+chunksize,lo:]
+        i,j=np.nonzero(np.triu(chunk!=0))
+        if len(i)==0:
+            continue
+        yield(pd.DataFrame({'bin1_id':i+lo+offset,'bin2_id':j+lo+offset,'count':chunk[i,j]}))
+
+def Save_coolfile(coolfile,mtx,output_coolfile,genome,chunksize=1000):
     """Function change raw HiC matrix of cool file to user selected (normalized) and write it to new file.
     Because function rewrite data of original cool, later you should load it with balance=False flag.
+    Pixels are streamed to cooler in chunks of chunksize matrix rows.
     coolfile - original HiC file
     mtx - matrix to write
     output_coolfile - name of new cool file
-    genome - genome assembly id"""
+    genome - genome assembly id
+    chunksize - number of matrix rows per chunk, default=1000"""
     #create bins
     bins=coolfile.bins()[0:]
-    #Create sparse matrix
-    mtx_upper_diag = np.triu(mtx, k=0)
-    smtx=scipy.sparse.csr_matrix(mtx_upper_diag)
-    sc=smtx.tocoo(copy=False)
-    smtx_pixels=pd.DataFrame({'bin1_id': sc.row, 'bin2_id': sc.col, 'count': sc.data})
-    cooler.io.create(output_coolfile,bins,smtx_pixels,assembly=genome,dtype={'count':float})
+    cooler.io.create(output_coolfile,bins,iter_upper_pixels(mtx,chunksize=chunksize),assembly=genome,dtype={'count':float})
+    return('Saved')
+
+def stripe_pixels(rows,start_bin,end_bin,offset=0,lo=0,hi=None):
+    """Upper-triangle pixels of symmetric matrix given by its normalized ROI rows.
+    rows - normalized ROI rows (see CTALE_norm_iterative_stripe)
+    start_bin, end_bin - ROI bins
+    offset - bin id of the chromosome start in cool file
+    lo, hi - range of chromosome bins for bin1_id, default: whole chromosome
+    returns pixels DataFrame sorted by bin1_id, bin2_id"""
+    hi=end_bin if hi is None else min(hi,end_bin)
+    # ROI columns above the ROI are stored mirrored in ROI rows
+    up_hi=min(hi,start_bin)
+    up_j,up_i=np.nonzero((rows[:,lo:up_hi]!=0).T) if lo<up_hi else (np.empty(0,dtype=int),np.empty(0,dtype=int))
+    up_j+=lo
+    # ROI rows right of the diagonal
+    roi_lo=max(lo,start_bin)
+    roi_rows=rows[roi_lo-start_bin:max(hi-start_bin,0)]
+    i,j=np.nonzero(np.triu(roi_rows!=0,roi_lo))
+    i+=roi_lo-start_bin
+    pixels=pd.DataFrame({
+        'bin1_id':np.concatenate([up_j,i+start_bin])+offset,
+        'bin2_id':np.concatenate([up_i+start_bin,j])+offset,
+        'count':np.concatenate([rows[up_i,up_j],rows[i,j]])})
+    return(pixels.sort_values(['bin1_id','bin2_id'],ignore_index=True))
+
+def iter_stripe_pixels(rows,start_bin,end_bin,offset=0,chunksize=1000):
+    """Yields stripe_pixels in chunks of chunksize chromosome bins"""
+    for lo in range(0,end_bin,chunksize):
+        pixels=stripe_pixels(rows,start_bin,end_bin,offset=offset,lo=lo,hi=lo+chunksize)
+        if len(pixels):
+            yield(pixels)
+
+def iter_merged_pixels(coolfile,rows,chrom,start_bin,end_bin,chunksize=1000):
+    """Yields pixels of cool file with ROI stripe replaced by normalized ROI rows, in bin-sorted chunks.
+    Only the ROI stripe is taken from the normalized data, all other pixels are streamed from the cool file.
+    coolfile - original HiC file
+    rows - normalized ROI rows (see CTALE_norm_iterative_stripe)
+    chrom - chromosome of C-TALE region
+    start_bin, end_bin - ROI bins
+    chunksize - number of bins per chunk
+    yields pixels DataFrames"""
+    offset=coolfile.offset(chrom)
+    chrom_lo,chrom_hi=coolfile.extent(chrom)
+    roi_lo,roi_hi=offset+start_bin,offset+end_bin
+    with coolfile.open('r') as h5:
+        bin1_offset=h5['indexes/bin1_offset'][:]
+    for lo in range(0,coolfile.info['nbins'],chunksize):
+        hi=min(lo+chunksize,coolfile.info['nbins'])
+        pixels=coolfile.pixels()[bin1_offset[lo]:bin1_offset[hi]]
+        bin1,bin2=pixels['bin1_id'].values,pixels['bin2_id'].values
+        in_stripe=(bin1>=chrom_lo)&(bin2<chrom_hi)&(((bin1>=roi_lo)&(bin1<roi_hi))|((bin2>=roi_lo)&(bin2<roi_hi)))
+        pixels=pixels[~in_stripe]
+        if lo<chrom_hi and hi>chrom_lo:
+            normalized=stripe_pixels(rows,start_bin,end_bin,offset=offset,lo=max(lo-offset,0),hi=hi-offset)
+            pixels=pd.concat([pixels,normalized],ignore_index=True).sort_values(['bin1_id','bin2_id'],ignore_index=True)
+        if len(pixels):
+            yield(pixels)
+
+def Save_coolfile_stripe(coolfile,rows,chrom,start_bin,end_bin,output_coolfile,genome,merge=False,chunksize=1000):
+    """Same as Save_coolfile, but the matrix is given by its normalized ROI stripe only.
+    coolfile - original HiC file
+    rows - normalized ROI rows (see CTALE_norm_iterative_stripe)
+    chrom - chromosome of C-TALE region
+    start_bin, end_bin - ROI bins
+    output_coolfile - name of new cool file
+    genome - genome assembly id
+    merge - if True, write the whole map: pixels outside of the ROI stripe are copied from the original cool
+            and the stripe is replaced by normalized pixels; if False, write normalized ROI stripe pixels only, default=False
+    chunksize - number of bins per chunk, default=1000"""
+    bins=coolfile.bins()[0:]
+    if merge:
+        pixels=iter_merged_pixels(coolfile,rows,chrom,start_bin,end_bin,chunksize=chunksize)
+    else:
+        pixels=iter_stripe_pixels(rows,start_bin,end_bin,offset=coolfile.offset(chrom),chunksize=chunksize)
+    cooler.io.create(output_coolfile,bins,pixels,assembly=genome,dtype={'count':float})
     return('Saved')
 
 def draw_graph(mat, diagonal_offset, start_bin, end_bin, name):
@@ -135,30 +439,48 @@ def draw_graph(mat, diagonal_offset, start_bin, end_bin, name):
     plt.savefig(name)
     plt.clf()
 
-# n.py raw.cool[1] start_cap[2] end_cap[3] bin_size[4] chr_cap[5] norm.cool[6]
-
-chr = sys.argv[5]
-start = int(sys.argv[2])
-end = int(sys.argv[3])
-bin_size = int(sys.argv[4])
-start_bin = int(start/bin_size)
-end_bin = int(end/bin_size)
-
-#load data
-raw = cooler.Cooler(sys.argv[1])
-mtx_raw = raw.matrix(balance=False).fetch(chr)
-
-#Perform normalization
-mtx_normalized=CTALE_norm_iterative(mtx_raw, start, end, bin_size, steps=20, mult=1)
-mtx = open('rawInv.pkl', 'wb')
-pickle.dump(mtx_raw,mtx)
-mtx.close()
-mtx = open('normalizedInv.pkl','wb')
-pickle.dump(mtx_normalized,mtx)
-
-#Save_coolfile
-Save_coolfile(raw,mtx_normalized,sys.argv[6],raw.info[u'genome-assembly'])
-
-#plot maps
-draw_graph(mtx_raw, 2, 10804, 10892, 'raw_Inv')
-draw_graph(mtx_normalized, 2, 10804, 10892, 'normalized_Inv')
+# n.py raw.cool[1] start_cap[2] end_cap[3] bin_size[4] chr_cap[5] norm.cool[6] [mode[7]: dense (default) | stripe | merge (stripe, written into the whole map)] [weights.npy[8]: stripe mode warm start]
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s', force=True)
+    logger = logging.getLogger('normalize')
+    chr = sys.argv[5]
+    start = int(sys.argv[2])
+    end = int(sys.argv[3])
+    bin_size = int(sys.argv[4])
+    start_bin = int(start/bin_size)
+    end_bin = int(end/bin_size)
+    mode = sys.argv[7] if len(sys.argv) > 7 else 'dense'
+    weights_file = sys.argv[8] if len(sys.argv) > 8 else None
+
+    #load data
+    raw = cooler.Cooler(sys.argv[1])
+
+    if mode in ('stripe', 'merge'):
+        #Perform normalization of ROI stripe only
+        rows_raw = fetch_roi_stripe(raw, chr, start, end, bin_size)
+        weights = np.load(weights_file) if weights_file is not None and os.path.exists(weights_file) else None
+        rows_normalized, weights = CTALE_norm_iterative_inplace(rows_raw, start, end, bin_size, steps=20, mult=1, weights=weights, logger=logger)
+        if weights_file is not None:
+            np.save(weights_file, weights)
+
+        #Save_coolfile
+        Save_coolfile_stripe(raw, rows_normalized, chr, start_bin, end_bin, sys.argv[6], raw.info[u'genome-assembly'], merge=(mode == 'merge'))
+        sys.exit(0)
+
+    mtx_raw = raw.matrix(balance=False).fetch(chr)
+
+    #Perform normalization
+    mtx_normalized=CTALE_norm_iterative(mtx_raw, start, end, bin_size, steps=20, mult=1)
+    mtx = open('rawInv.pkl', 'wb')
+    pickle.dump(mtx_raw,mtx)
+    mtx.close()
+    mtx = open('normalizedInv.pkl','wb')
+    pickle.dump(mtx_normalized,mtx)
+
+    #Save_coolfile
+    Save_coolfile(raw,mtx_normalized,sys.argv[6],raw.info[u'genome-assembly'])
+
+    #plot maps
+    draw_graph(mtx_raw, 2, 10804, 10892, 'raw_Inv')
+    draw_graph(mtx_normalized, 2, 10804, 10892, 'normalized_Inv')
@@ -0,0 +1,58 @@
+"""CTALE_norm_fast must give the same matrix as the reference loops of CTALE_norm and CTALE_norm_multiplicate"""
+import numpy as np
+import pytest
+import scipy.sparse
+import scipy.stats
+
+import normalize
+
+RESOLUTION = 1000
+SIZE = 60
+
+
+def random_matrix(seed=0, density=0.3):
+    """Symmetric contact matrix with empty pixels, ROI rows are never empty"""
+    rng = np.random.default_rng(seed)
+    mtx = rng.poisson(5, size=(SIZE, SIZE)) * (rng.random((SIZE, SIZE)) < density)
+    mtx = np.triu(mtx) + np.triu(mtx, 1).T
+    mtx[np.arange(SIZE - 1), np.arange(1, SIZE)] += 1
+    mtx[np.arange(1, SIZE), np.arange(SIZE - 1)] += 1
+    return (mtx.astype(float))
+
+
+# ROI bins: inside, at the matrix start, at the matrix end, whole matrix
+ROIS = [(20, 35), (0, 12), (47, SIZE), (0, SIZE)]
+FUNCS = [scipy.stats.gmean, np.mean, np.median]
+
+
+def reference(mtx, start_bin, end_bin, func, mult):
+    if mult == 1:
+        return (normalize.CTALE_norm(mtx.copy(), start_bin * RESOLUTION, end_bin * RESOLUTION, RESOLUTION, func=func))
+    return (normalize.CTALE_norm_multiplicate(mtx.copy(), start_bin * RESOLUTION, end_bin * RESOLUTION, RESOLUTION, func=func, mult=mult))
+
+
+@pytest.mark.parametrize('roi', ROIS)
+@pytest.mark.parametrize('func', FUNCS)
+@pytest.mark.parametrize('mult', [1, 1.54])
+def test_dense(roi, func, mult):
+    mtx = random_matrix()
+    expected = reference(mtx, *roi, func, mult)
+    result = normalize.CTALE_norm_fast(mtx.copy(), roi[0] * RESOLUTION, roi[1] * RESOLUTION, RESOLUTION, func=func, mult=mult)
+    np.testing.assert_allclose(result, expected, rtol=1e-12, atol=1e-15)
+
+
+@pytest.mark.parametrize('roi', ROIS)
+@pytest.mark.parametrize('func', FUNCS)
+@pytest.mark.parametrize('mult', [1, 1.54])
+def test_sparse(roi, func, mult):
+    mtx = random_matrix(seed=1, density=0.1)
+    expected = reference(mtx, *roi, func, mult)
+    result = normalize.CTALE_norm_fast(scipy.sparse.csr_matrix(mtx), roi[0] * RESOLUTION, roi[1] * RESOLUTION, RESOLUTION, func=func, mult=mult)
+    assert scipy.sparse.issparse(result)
+    np.testing.assert_allclose(result.toarray(), expected, rtol=1e-12, atol=1e-15)
+
+
+def test_multiplicate_without_multiplication():
+    mtx = random_matrix(seed=2)
+    expected = normalize.CTALE_norm_multiplicate(mtx.copy(), 10 * RESOLUTION, 30 * RESOLUTION, RESOLUTION, mult=1)
+    np.testing.assert_allclose(reference(mtx, 10, 30, scipy.stats.gmean, 1), expected, rtol=1e-12, atol=1e-15)
@@ -0,0 +1,1114 @@
+from SharedFunctions import *
+
+import bisect
+import contextlib
+import decimal
+import heapq
+import queue
+
+## ------======| RESTRICTION SITES |======------
+
+def RestrictionSitesCache(SiteFile: str) -> tuple: return (f"{os.path.splitext(SiteFile)[0]}.sites.npy", f"{os.path.splitext(SiteFile)[0]}.sites.json")
+
+def SaveRestrictionSites(
+		SiteFile: str,
+		Chroms: dict,
+		Logger: logging.Logger) -> int:
+	
+	# Binary cache of a site file: flat int64 array + per-chromosome index, tied to the site file signature
+	ArrayFile, IndexFile = RestrictionSitesCache(SiteFile)
+	Index, Offset = {}, 0
+	for Chrom, Sites in Chroms.items():
+		Index[Chrom] = [Offset, Offset + len(Sites)]
+		Offset += len(Sites)
+	with StageOutput(ArrayFile, Logger) as TempFile:
+		with open(TempFile, 'wb') as File: numpy.save(File, numpy.concatenate(list(Chroms.values())) if Chroms else numpy.array([], dtype=numpy.int64))
+	with StageOutput(IndexFile, Logger) as TempFile: SaveJSON({"Source": FileSignature(SiteFile), "Chroms": Index}, TempFile)
+	return Offset
+
+def CompileRestrictionSites(
+		SiteFile: str,
+		Logger: logging.Logger) -> None:
+	
+	# Juicer site file (one line per chromosome: name, then sorted cut positions) to flat int64 array + per-chromosome index
+	StartTime = time.time()
+	Chroms = {}
+	with OpenAnyway(SiteFile, 'rt', Logger) as File:
+		for Line in File:
+			Fields = Line.split()
+			if not Fields: continue
+			Sites = numpy.array(Fields[1:], dtype=numpy.int64)
+			if numpy.any(Sites[1:] < Sites[:-1]): Sites.sort()
+			Chroms[Fields[0]] = Sites
+	Total = SaveRestrictionSites(SiteFile, Chroms, Logger)
+	Logger.info(f"CompileRestrictionSites: {str(len(Chroms))} chromosomes, {Total:,} sites - %s" % (SecToTime(time.time() - StartTime)))
+
+def LoadRestrictionSites(
+		SiteFile: str,
+		Logger: logging.Logger) -> dict:
+	
+	# Memory-mapped per-chromosome site arrays, compiled once and recompiled if the site file has changed
+	ArrayFile, IndexFile = RestrictionSitesCache(SiteFile)
+	Index = json.load(open(IndexFile, 'rt')) if os.path.isfile(IndexFile) and os.path.isfile(ArrayFile) else None
+	if Index is None or Index["Source"] != FileSignature(SiteFile):
+		CompileRestrictionSites(SiteFile, Logger)
+		Index = json.load(open(IndexFile, 'rt'))
+	Sites = numpy.load(ArrayFile, mmap_mode='r')
+	return {Chrom: Sites[Start:End] for Chrom, (Start, End) in Index["Chroms"].items()}
+
+def AssignFragments(
+		Sites: dict,
+		Chroms: numpy.ndarray,
+		Positions: numpy.ndarray) -> numpy.ndarray:
+	
+	# Fragment ID = number of sites <= position, same as bsearch in fragment.pl; unknown chromosomes get 0
+	Chroms = numpy.asarray(Chroms)
+	Positions = numpy.asarray(Positions, dtype=numpy.int64)
+	Fragments = numpy.zeros(len(Positions), dtype=numpy.int64)
+	Unique, Inverse = numpy.unique(Chroms, return_inverse=True)
+	for Number, Chrom in enumerate(Unique):
+		ChromSites = Sites.get(Chrom.decode('utf-8') if isinstance(Chrom, bytes) else str(Chrom))
+		if ChromSites is None: continue
+		Mask = Inverse == Number
+		Fragments[Mask] = numpy.searchsorted(ChromSites, Positions[Mask], side='right')
+	return Fragments
+
+def FragmentBlock(Block: bytes, SiteFile: str) -> bytes: return FragmentRecords(Block, LoadRestrictionSites(SiteFile, logging.getLogger(__name__)))
+
+def FragmentRecords(Block: bytes, Arrays: dict) -> bytes:
+	
+	# fragment.pl record: str1 chr1 pos1 str2 chr2 pos2 ... -> str1 chr1 pos1 frag1 str2 chr2 pos2 frag2 ...; Arrays are site arrays by chromosome
+	Sites = Arrays
+	Records = [Line.split() for Line in Block.split(b'\n')]
+	Records = [Fields for Fields in Records if Fields]
+	if not Records: return b''
+	Fragments1 = AssignFragments(Sites, [Fields[1] for Fields in Records], [int(Fields[2]) for Fields in Records])
+	Fragments2 = AssignFragments(Sites, [Fields[4] for Fields in Records], [int(Fields[5]) for Fields in Records])
+	return b''.join([b' '.join(Fields[:3] + [str(Fragment1).encode()] + Fields[3:6] + [str(Fragment2).encode()] + Fields[6:]) + b' \n' for Fields, Fragment1, Fragment2 in zip(Records, Fragments1, Fragments2)])
+
+def FragmentFile(
+		InputFile: str,
+		OutputFile: str,
+		SiteFile: str,
+		Logger: logging.Logger,
+		Threads: int = 1,
+		BlockSize: int = 64 * 1024 * 1024) -> None:
+	
+	# Drop-in replacement of fragment.pl, byte-identical output
+	for line in [f"Input file: {InputFile}", f"Output file: {OutputFile}", f"Restriction sites: {SiteFile}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	with StageOutput(OutputFile, Logger) as TempFile, open(TempFile, 'wb') as Output:
+		with WorkerPool("FragmentFile", Logger, Threads, Arrays = LoadRestrictionSites(SiteFile, Logger)) as Workers:
+			for Text in Workers.Map(FragmentRecords, ReadBlocks(InputFile, Logger, BlockSize = BlockSize)): Output.write(Text)
+
+# Recognition sites of juicer enzymes; several motifs are scanned at once, IUPAC codes are allowed (Arima: ^GATC, G^ANTC)
+RESTRICTION_MOTIFS = {
+	"HindIII": ["AAGCTT"],
+	"DpnII": ["GATC"],
+	"MboI": ["GATC"],
+	"Sau3AI": ["GATC"],
+	"NcoI": ["CCATGG"],
+	"MseI": ["TTAA"],
+	"Arima": ["GATC", "GANTC"]
+	}
+
+IUPAC_CODES = {"A": "A", "C": "C", "G": "G", "T": "T", "R": "[AG]", "Y": "[CT]", "S": "[CG]", "W": "[AT]", "K": "[GT]", "M": "[AC]", "B": "[CGT]", "D": "[AGT]", "H": "[ACT]", "V": "[ACG]", "N": "[ACGT]"}
+
+def RestrictionMotifs(Enzyme: str) -> list:
+	
+	# Enzyme names or raw motifs, comma-separated: "Arima", "DpnII,HinfI", "GATC,GANTC"
+	Motifs = []
+	for Item in Enzyme.split(','):
+		Item = Item.strip()
+		if Item in RESTRICTION_MOTIFS: Motifs += RESTRICTION_MOTIFS[Item]
+		elif Item and all(Char in IUPAC_CODES for Char in Item.upper()): Motifs.append(Item.upper())
+		else: raise ValueError(f"Unknown enzyme or motif: '{Item}'")
+	return list(dict.fromkeys(Motifs))
+
+def MotifRegex(Motifs: list) -> bytes:
+	
+	# Lookahead, so that overlapping sites (GATCGATC) are all found
+	return ("(?=" + '|'.join([''.join([IUPAC_CODES[Char] for Char in Motif]) for Motif in Motifs]) + ")").encode()
+
+def FastaIndex(GenomeFA: str) -> list:
+	
+	# samtools faidx records: name, length, offset, bases per line, bytes per line
+	if not os.path.isfile(f"{GenomeFA}.fai"): pysam.faidx(GenomeFA)
+	with open(f"{GenomeFA}.fai", 'rt') as File: return [(Fields[0], int(Fields[1]), int(Fields[2]), int(Fields[3]), int(Fields[4])) for Fields in [Line.split('\t') for Line in File] if len(Fields) >= 5]
+
+def ChromSites(Record: tuple, GenomeFA: str, Regex: bytes) -> tuple:
+	
+	# Worker: one chromosome from the memory-mapped FASTA, 1-based motif starts
+	Name, Length, Offset, LineBases, LineWidth = Record
+	End = Offset + (Length // LineBases) * LineWidth + Length % LineBases if LineBases else Offset
+	with open(GenomeFA, 'rb') as File, mmap.mmap(File.fileno(), 0, access=mmap.ACCESS_READ) as Map:
+		Sequence = Map[Offset:End].translate(None, b'\r\n').upper()
+	Sites = numpy.fromiter((Match.start() + 1 for Match in re.finditer(Regex, Sequence)), dtype=numpy.int64)
+	return (Name, Sites, len(Sequence))
+
+def GenerateRestrictionSites(
+		GenomeFA: str,
+		Enzyme: str,
+		OutputFile: str,
+		Logger: logging.Logger,
+		Threads: int = 1) -> None:
+	
+	# Replacement of generate_site_positions.py: line per chromosome, motif starts, then chromosome length; binary cache is written alongside
+	StartTime = time.time()
+	Motifs = RestrictionMotifs(Enzyme)
+	for line in [f"Genome FASTA path: {GenomeFA}", f"Enzyme: {Enzyme}", f"Motifs: {', '.join(Motifs)}", f"Output file: {OutputFile}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	if GzipCheck(GenomeFA):
+		ErrorMessage = f"Genome FASTA must be uncompressed to be memory-mapped: {GenomeFA}"
+		Logger.error(ErrorMessage)
+		raise OSError(ErrorMessage)
+	Index = FastaIndex(GenomeFA)
+	Chroms = {}
+	with StageOutput(OutputFile, Logger) as TempFile, open(TempFile, 'wt') as Output:
+		# Largest chromosomes first, so that workers finish together
+		Order = sorted(range(len(Index)), key = lambda Number: -Index[Number][1])
+		with WorkerPool("GenerateRestrictionSites", Logger, Threads) as Workers:
+			for Name, Sites, Length in Workers.Map(ChromSites, [Index[Number] for Number in Order], GenomeFA = GenomeFA, Regex = MotifRegex(Motifs)): Chroms[Name] = numpy.append(Sites, Length)
+		Chroms = {Record[0]: Chroms[Record[0]] for Record in Index}
+		for Name, Sites in Chroms.items(): Output.write(' '.join([Name] + Sites.astype(str).tolist()) + '\n')
+	Total = SaveRestrictionSites(OutputFile, Chroms, Logger)
+	Logger.info(f"GenerateRestrictionSites: {str(len(Chroms))} chromosomes, {Total - len(Chroms):,} sites - %s" % (SecToTime(time.time() - StartTime)))
+
+## ------======| DEDUP |======------
+
+AWK_NUMBER_PATTERN = re.compile(rb'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?')
+
+DICTIONARY_ORDER_PATTERN = re.compile(rb'[^A-Za-z0-9 \t]')
+
+def AwkNumber(Value: bytes) -> float:
+	Match = AWK_NUMBER_PATTERN.match(Value)
+	return float(Match.group(0)) if Match else 0.0
+
+def MergedSortKey(Line: bytes) -> tuple:
+	
+	# Juicer sort order (LC_ALL=C sort -k2,2d -k6,6d -k4,4n -k8,8n -k1,1n -k5,5n -k3,3n), whole line as the last resort
+	Fields = Line.split()
+	return (DICTIONARY_ORDER_PATTERN.sub(b'', Fields[1]), DICTIONARY_ORDER_PATTERN.sub(b'', Fields[5]), int(Fields[3]), int(Fields[7]), int(Fields[0]), int(Fields[4]), int(Fields[2]), Line.rstrip(b'\n'))
+
+def DedupKey(Line: bytes) -> tuple:
+	
+	# str1, chr1, frag1, str2, chr2, frag2 - duplicate groups never cross these
+	Fields = Line.split(maxsplit=8)
+	return (Fields[0], Fields[1], Fields[3], Fields[4], Fields[5], Fields[7])
+
+def ReadTile(Name: bytes, Number: int, First: bool) -> tuple:
+	
+	# Illumina read name -> (tile, x, y); other names get a unique tile, so they are never optical duplicates
+	Parts = Name.split(b':')
+	if len(Parts) < 2: return (b'0' if First else str(Number).encode(), 0.0, 0.0)
+	Parts += [b''] * (7 - len(Parts))
+	return (Parts[2] + Parts[3] + Parts[4], AwkNumber(Parts[5]), AwkNumber(Parts[6].split(b'/')[0]))
+
+def DedupChunk(Lines: list, Wobble: int = 4) -> tuple:
+	
+	# dups.awk on a chunk of sorted records: 0 - nodup, 1 - dup, 2 - optical dup
+	if not Lines: return (b'', b'', b'')
+	Records = [Line.split() for Line in Lines]
+	Keys = [(Fields[0], Fields[1], Fields[3], Fields[4], Fields[5], Fields[7]) for Fields in Records]
+	Pos1 = numpy.array([int(Fields[2]) for Fields in Records], dtype=numpy.int64)
+	Pos2 = numpy.array([int(Fields[6]) for Fields in Records], dtype=numpy.int64)
+	NewGroup = numpy.ones(len(Lines), dtype=bool)
+	NewGroup[1:] = (numpy.abs(numpy.diff(Pos1)) > Wobble) | numpy.array([Key != Previous for Key, Previous in zip(Keys[1:], Keys[:-1])], dtype=bool)
+	Starts = numpy.flatnonzero(NewGroup)
+	Ends = numpy.append(Starts[1:], len(Lines))
+	Status = numpy.zeros(len(Lines), dtype=numpy.int8)
+	for Start, End in zip(Starts[Ends - Starts > 1], Ends[Ends - Starts > 1]):
+		Tiles = [ReadTile(Records[Start + Number][14] if len(Records[Start + Number]) > 14 else b'', Number, Number == 0) for Number in range(End - Start)]
+		for j in range(Start, End):
+			if Status[j]: continue
+			for k in range(j + 1, End):
+				Distance1, Distance2 = abs(Pos1[j] - Pos1[k]), abs(Pos2[j] - Pos2[k])
+				if Distance1 <= Wobble and Distance2 <= Wobble:
+					(Tile1, X1, Y1), (Tile2, X2, Y2) = Tiles[j - Start], Tiles[k - Start]
+					Optical = (Tile1 == Tile2) and (abs(X1 - X2) < 50) and (abs(Y1 - Y2) < 50)
+					if Optical and Status[k] != 1: Status[k] = 2
+					if not Optical: Status[k] = 1
+				if Distance1 > Wobble: break
+	return tuple(b''.join([Line for Line, Value in zip(Lines, Status) if Value == Code]) for Code in range(3))
+
+def DedupStatisticsChunk(Lines: list, Wobble: int, Statistics: dict) -> tuple:
+	
+	# Dedup and library statistics of the unique records in one pass over the chunk
+	Result = DedupChunk(Lines, Wobble)
+	return Result + (StatisticsChunk(Result[0].split(b'\n'), **Statistics),)
+
+def MergeSortedSplits(InputFiles: list):
+	
+	# k-way streaming merge, same order as `sort -m` over the split files
+	Files = [open(FileName, 'rb') for FileName in InputFiles]
+	try:
+		for Line in heapq.merge(*Files, key=MergedSortKey):
+			yield Line if Line.endswith(b'\n') else Line + b'\n'
+	finally:
+		for File in Files: File.close()
+
+def DedupChunks(Lines, ChunkSize: int):
+	
+	# Cut the merged stream into chunks at (str, chr, frag) boundaries
+	Chunk, Key = [], None
+	for Line in Lines:
+		if len(Chunk) >= ChunkSize:
+			LineKey = DedupKey(Line)
+			if Key is not None and LineKey != Key:
+				yield Chunk
+				Chunk, LineKey = [], None
+			Key = LineKey
+		Chunk.append(Line)
+	if Chunk: yield Chunk
+
+def DedupMergedSort(
+		InputFiles: list,
+		NoDupsFile: str,
+		DupsFile: str,
+		OptDupsFile: str,
+		Logger: logging.Logger,
+		Threads: int = 1,
+		NoWobble: bool = False,
+		ChunkSize: int = 1000000,
+		Statistics: Union[dict, None] = None) -> dict:
+	
+	# Drop-in replacement of `sort -m` + dups.awk, byte-identical output
+	# Statistics: {"SiteFile", "Ligation", "Thresholds"} - also collect statistics.pl counters of the unique records on the fly
+	StartTime = time.time()
+	for line in [f"Input files: {', '.join(InputFiles)}", f"Output files: {NoDupsFile}, {DupsFile}, {OptDupsFile}", f"Wobble: {'off' if NoWobble else 'on'}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	Counts = {"NoDups": 0, "Dups": 0, "OptDups": 0}
+	if Statistics is not None: Counts["Statistics"] = StatisticsChunk([], **Statistics)
+	with StageOutput(NoDupsFile, Logger) as NoDupsTemp, StageOutput(DupsFile, Logger) as DupsTemp, StageOutput(OptDupsFile, Logger) as OptDupsTemp:
+		with open(NoDupsTemp, 'wb') as NoDups, open(DupsTemp, 'wb') as Dups, open(OptDupsTemp, 'wb') as OptDups:
+			with WorkerPool("DedupMergedSort", Logger, Threads) as Workers:
+				Function, Kwargs = (DedupChunk, {}) if Statistics is None else (DedupStatisticsChunk, {"Statistics": Statistics})
+				for Result in Workers.Map(Function, DedupChunks(MergeSortedSplits(InputFiles), ChunkSize), Wobble = 0 if NoWobble else 4, **Kwargs):
+					for Name, Output, Text in zip(["NoDups", "Dups", "OptDups"], (NoDups, Dups, OptDups), Result):
+						Output.write(Text)
+						Counts[Name] += Text.count(b'\n')
+					if Statistics is not None: Counts["Statistics"] = MergeStatistics([Counts["Statistics"], Result[3]])
+	Logger.info(f"DedupMergedSort: {Counts['NoDups']:,} unique, {Counts['Dups']:,} duplicates, {Counts['OptDups']:,} optical duplicates - %s" % (SecToTime(time.time() - StartTime)))
+	return Counts
+
+def SortedDifference(
+		InputFile1: str,
+		InputFile2: str,
+		OutputFile1: str,
+		OutputFile2: str,
+		Logger: logging.Logger,
+		Threads: int = 1) -> dict:
+	
+	# Two files in merged_nodups order: records only in the first go to OutputFile1, only in the second to OutputFile2 (multiset difference)
+	StartTime = time.time()
+	Counts = {"Common": 0, "First": 0, "Second": 0}
+	with StageOutput(OutputFile1, Logger) as TempFile1, StageOutput(OutputFile2, Logger) as TempFile2, open(TempFile1, 'wb') as Output1, open(TempFile2, 'wb') as Output2:
+		Lines1, Lines2 = ReadLines(InputFile1, Logger, Threads = Threads), ReadLines(InputFile2, Logger, Threads = Threads)
+		Line1, Line2 = next(Lines1, None), next(Lines2, None)
+		Key1, Key2 = (None if Line1 is None else MergedSortKey(Line1)), (None if Line2 is None else MergedSortKey(Line2))
+		while Line1 is not None or Line2 is not None:
+			if Line2 is None or (Line1 is not None and Key1 < Key2):
+				Output1.write(Line1)
+				Counts["First"] += 1
+				Line1 = next(Lines1, None)
+				Key1 = None if Line1 is None else MergedSortKey(Line1)
+				continue
+			if Line1 is None or Key2 < Key1:
+				Output2.write(Line2)
+				Counts["Second"] += 1
+			else:
+				Counts["Common"] += 1
+				Line1 = next(Lines1, None)
+				Key1 = None if Line1 is None else MergedSortKey(Line1)
+			Line2 = next(Lines2, None)
+			Key2 = None if Line2 is None else MergedSortKey(Line2)
+	Logger.info(f"SortedDifference: {Counts['Common']:,} common, {Counts['First']:,} only in '{InputFile1}', {Counts['Second']:,} only in '{InputFile2}' - %s" % (SecToTime(time.time() - StartTime)))
+	return Counts
+
+def AppendContacts(
+		ExistingFile: str,
+		NewFiles: list,
+		OutputFile: str,
+		AddedFile: str,
+		RemovedFile: str,
+		Logger: logging.Logger,
+		Threads: int = 1,
+		NoWobble: bool = False,
+		Statistics: Union[dict, None] = None) -> dict:
+	
+	# Dedup new sorted contacts against the existing library by a merge; AddedFile and RemovedFile are the delta between OutputFile and ExistingFile
+	# (a new record may replace an existing duplicate which sorts after it). Duplicates go to {OutputFile stem}_dups.txt and _optdups.txt
+	Stem = os.path.splitext(OutputFile)[0]
+	Counts = DedupMergedSort([ExistingFile] + list(NewFiles), OutputFile, f"{Stem}_dups.txt", f"{Stem}_optdups.txt", Logger, Threads = Threads, NoWobble = NoWobble, Statistics = Statistics)
+	Delta = SortedDifference(OutputFile, ExistingFile, AddedFile, RemovedFile, Logger, Threads = Threads)
+	Counts.update({"Added": Delta["First"], "Removed": Delta["Second"]})
+	return Counts
+	
+## ------======| LIBRARY STATISTICS |======------
+
+# statistics.pl logspace bins of the contact distance
+DISTANCE_BINS = [10, 12, 15, 19, 23, 28, 35, 43, 53, 66, 81, 100, 123, 152, 187, 231, 285, 351, 433, 534, 658, 811, 1000, 1233, 1520, 1874, 2310, 2848, 3511, 4329, 5337, 6579, 8111, 10000, 12328, 15199, 18738, 23101, 28480, 35112, 43288, 53367, 65793, 81113, 100000, 123285, 151991, 187382, 231013, 284804, 351119, 432876, 533670, 657933, 811131, 1000000, 1232847, 1519911, 1873817, 2310130, 2848036, 3511192, 4328761, 5336699, 6579332, 8111308, 10000000, 12328467, 15199111, 18738174, 23101297, 28480359, 35111917, 43287613, 53366992, 65793322, 81113083, 100000000, 123284674, 151991108, 187381742, 231012970, 284803587, 351119173, 432876128, 533669923, 657933225, 811130831, 1000000000, 1232846739, 1519911083, 1873817423, 2310129700, 2848035868, 3511191734, 4328761281, 5336699231, 6579332247, 8111308308, 10000000000]
+
+STATISTICS_COUNTERS = ["Unique", "IntraFragment", "UnderMapQ", "Contacts", "Dangling", "Ligation", "Inner", "Outer", "Left", "Right", "Inter", "Intra", "VerySmall", "Small", "Large", "VerySmallDangling", "SmallDangling", "LargeDangling", "InterDangling", "TrueDanglingIntraSmall", "TrueDanglingIntraLarge", "TrueDanglingInter", "ThreePrimeEnd", "FivePrimeEnd"]
+
+def NewStatistics() -> dict:
+	Stats = {Name: 0 for Name in STATISTICS_COUNTERS}
+	Stats.update({"RestrictionDistance": [0] * 2001, "MapQ": [[0, 0, 0] for _ in range(201)], "PairTypes": [[0, 0, 0, 0] for _ in range(len(DISTANCE_BINS) + 1)]})
+	return Stats
+
+def MergeStatistics(Partials: list) -> dict:
+	
+	# Partial results are plain sums, so they merge in any order
+	Partials = list(Partials)
+	if not Partials: return {}
+	if isinstance(Partials[0], dict): return {Key: MergeStatistics([Partial[Key] for Partial in Partials]) for Key in Partials[0]}
+	if isinstance(Partials[0], list): return [MergeStatistics(Items) for Items in zip(*Partials)]
+	return sum(Partials)
+
+def LigationPatterns(Ligation: str) -> tuple:
+	
+	# statistics.pl: parentheses removed, dangling junction is the second half of the (first) junction
+	Ligation = Ligation.replace('(', '', 1).replace(')', '', 1)
+	return (re.compile(f"({Ligation})".encode()), re.compile(f"^{Ligation[len(Ligation) // 2:]}".encode()))
+
+def RestrictionDistance(Stats: dict, Sites: dict, Strand: int, Chrom: bytes, Position: int, Fragment: int, Report: bool) -> int:
+	
+	# Distance to the nearest site of the fragment, counts 5'/3' ends if reported (distHindIII in statistics.pl)
+	ChromSites = Sites.get(Chrom.decode('utf-8'), ())
+	Site = lambda Index: int(ChromSites[Index]) if 0 <= Index < len(ChromSites) else 0
+	Distance1 = Position if Fragment == 0 else abs(Position - Site(Fragment - 1))
+	Distance2 = abs(Position - Site(Fragment))
+	Distance = Distance1 if Distance1 <= Distance2 else Distance2
+	if Report:
+		if Distance == Distance1: Stats["FivePrimeEnd" if Strand == 0 else "ThreePrimeEnd"] += 1
+		else: Stats["FivePrimeEnd" if Strand == 16 else "ThreePrimeEnd"] += 1
+	return Distance
+
+def LibraryStatistics(
+		Lines: list,
+		Sites: Union[dict, None],
+		Ligation: str,
+		MapQ: int = 1) -> dict:
+	
+	# statistics.pl counters and histograms for a chunk of merged_nodups records; Sites is None for no enzyme
+	Stats = NewStatistics()
+	LigationPattern, DanglingPattern = LigationPatterns(Ligation)
+	for Line in Lines:
+		Record = Line.split()
+		if not Record: continue
+		Stats["Unique"] += 1
+		Full = len(Record) > 8
+		Strand1, Position1, Fragment1, Strand2, Position2, Fragment2 = int(Record[0]), int(Record[2]), int(Record[3]), int(Record[4]), int(Record[6]), int(Record[7])
+		SameChrom = Record[1] == Record[5]
+		MapQValue = min(int(Record[8]), int(Record[11])) if Full else None
+		if SameChrom and Fragment1 == Fragment2:
+			Stats["IntraFragment"] += 1
+			continue
+		if Full and MapQValue < MapQ:
+			Stats["UnderMapQ"] += 1
+			continue
+		Stats["Contacts"] += 1
+		Distance = abs(Position1 - Position2)
+		Bin = bisect.bisect_left(DISTANCE_BINS, Distance)
+		Dangling = Full and bool(DanglingPattern.search(Record[10]) or DanglingPattern.search(Record[13]))
+		if Dangling: Stats["Dangling"] += 1
+		if SameChrom:
+			Stats["Intra"] += 1
+			if Strand1 == Strand2: Type = "Right" if Strand1 == 0 else "Left"
+			else: Type = "Inner" if (Strand1 == 0) == (Position1 < Position2) else "Outer"
+			if Distance >= 20000: Stats[Type] += 1
+			Stats["PairTypes"][Bin][["Inner", "Outer", "Right", "Left"].index(Type)] += 1
+			Range = "VerySmall" if Distance < 10 else ("Small" if Distance < 20000 else "Large")
+			Stats[Range] += 1
+			if Dangling: Stats[f"{Range}Dangling"] += 1
+		else:
+			Stats["Inter"] += 1
+			if Dangling: Stats["InterDangling"] += 1
+		if Full:
+			if MapQValue <= 200:
+				Stats["MapQ"][MapQValue][0] += 1
+				Stats["MapQ"][MapQValue][1 if SameChrom else 2] += 1
+			if LigationPattern.search(Record[10]) or LigationPattern.search(Record[13]): Stats["Ligation"] += 1
+		if Sites is not None:
+			# Chromosome names are compared numerically here in statistics.pl
+			Report = (AwkNumber(Record[1]) != AwkNumber(Record[5])) or (Distance >= 20000)
+			for Strand, Position, Fragment, Chrom in [(Strand1, Position1, Fragment1, Record[1]), (Strand2, Position2, Fragment2, Record[5])]:
+				SiteDistance = RestrictionDistance(Stats, Sites, Strand, Chrom, Position, Fragment, Report)
+				if SiteDistance <= 2000: Stats["RestrictionDistance"][SiteDistance] += 1
+		if Dangling:
+			if DanglingPattern.search(Record[10]): SiteDistance = RestrictionDistance(Stats, Sites or {}, Strand1, Record[1], Position1, Fragment1, True)
+			else: SiteDistance = RestrictionDistance(Stats, Sites or {}, Strand2, Record[5], Position2, Fragment2, True)
+			if SiteDistance == 1:
+				if AwkNumber(Record[1]) == AwkNumber(Record[5]): Stats["TrueDanglingIntraSmall" if Distance < 20000 else "TrueDanglingIntraLarge"] += 1
+				else: Stats["TrueDanglingInter"] += 1
+	return Stats
+
+def StatisticsChunk(Lines: list, SiteFile: Union[str, None], Ligation: str, Thresholds: list) -> dict:
+	Sites = None if (SiteFile is None) or ("none" in SiteFile) else LoadRestrictionSites(SiteFile, logging.getLogger(__name__))
+	return {str(MapQ): LibraryStatistics(Lines, Sites, Ligation, MapQ) for MapQ in Thresholds}
+
+def SequencedReads(Text: str) -> int:
+	
+	# "Sequenced Read Pairs:  1,234" line written by stats_sub.awk
+	for Line in Text.split('\n'):
+		if "Sequenced" in Line: return int(re.sub(r'[, ]', '', Line.split(':')[1]) or 0)
+	return 0
+
+def LibraryCounts(Text: str) -> dict:
+	
+	# Sequenced read pairs and LibraryComplexity counts of an inter.txt
+	Counts = {"Sequenced": SequencedReads(Text)}
+	for Name, Label in [("NoDups", "Unique Reads"), ("Dups", "PCR Duplicates"), ("OptDups", "Optical Duplicates")]:
+		Match = re.search(f"^{Label}: ([0-9,]+)", Text, flags=re.MULTILINE)
+		Counts[Name] = int(Match.group(1).replace(',', '')) if Match else 0
+	return Counts
+
+def EstimateLibrarySize(ReadPairs: int, UniqueReadPairs: int) -> int:
+	
+	# Lander-Waterman estimate, same bisection as LibraryComplexity.java
+	if not (ReadPairs > 0 and ReadPairs - UniqueReadPairs > 0): return 0
+	F = lambda x, c, n: c / x - 1 + math.exp(-n / x)
+	m, M = 1.0, 100.0
+	while F(M * UniqueReadPairs, UniqueReadPairs, ReadPairs) >= 0: m, M = M, M * 10.0
+	r = (m + M) / 2.0
+	u = F(r * UniqueReadPairs, UniqueReadPairs, ReadPairs)
+	for _ in range(1000):
+		if u == 0: break
+		if u > 0: m = r
+		else: M = r
+		r = (m + M) / 2.0
+		u = F(r * UniqueReadPairs, UniqueReadPairs, ReadPairs)
+	return int(UniqueReadPairs * (m + M) / 2.0)
+
+def LibraryComplexityText(Counts: dict, Sequenced: int) -> str:
+	
+	# Same text as `juicer_tools LibraryComplexity`
+	Percent = lambda Value: f"({decimal.Decimal(Value / Sequenced * 100).quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_EVEN):,}%)\n" if Sequenced > 0 else "\n"
+	Text = f"Unique Reads: {Counts['NoDups']:,} " + Percent(Counts['NoDups'])
+	Text += f"PCR Duplicates: {Counts['Dups']:,} " + Percent(Counts['Dups'])
+	Text += f"Optical Duplicates: {Counts['OptDups']:,} " + Percent(Counts['OptDups'])
+	return Text + f"Library Complexity Estimate: {EstimateLibrarySize(Counts['NoDups'] + Counts['Dups'], Counts['NoDups']):,}\n"
+
+def StatisticsText(Stats: dict, Sequenced: int) -> str:
+	
+	# Same text as statistics.pl appends to inter.txt
+	Unique = Stats["Unique"] or 1
+	Percent = lambda Value: (f" ({Value * 100 / Sequenced:0.2f}% / " if Sequenced else "(") + f"{Value * 100 / Unique:0.2f}%)\n"
+	Text = f"Intra-fragment Reads: {Stats['IntraFragment']:,}" + Percent(Stats['IntraFragment'])
+	Text += f"Below MAPQ Threshold: {Stats['UnderMapQ']:,}" + Percent(Stats['UnderMapQ'])
+	Text += f"Hi-C Contacts: {Stats['Contacts']:,}" + Percent(Stats['Contacts'])
+	Text += f" Ligation Motif Present: {Stats['Ligation']:,} " + Percent(Stats['Ligation'])
+	Ends = Stats["FivePrimeEnd"] + Stats["ThreePrimeEnd"]
+	Text += f" 3' Bias (Long Range): {Stats['ThreePrimeEnd'] * 100 / Ends:0.0f}% - {Stats['FivePrimeEnd'] * 100 / Ends:0.0f}%\n" if Ends > 0 else " 3' Bias (Long Range): 0% - 0%\n"
+	Text += (" Pair Type %(L-I-O-R): " + ' - '.join([f"{Stats[Type] * 100 / Stats['Large']:0.0f}%" for Type in ["Left", "Inner", "Outer", "Right"]]) + "\n") if Stats["Large"] > 0 else " Pair Type %(L-I-O-R): 0% - 0% - 0% - 0%\n"
+	for Label, Name in [("Inter-chromosomal", "Inter"), ("Intra-chromosomal", "Intra"), ("Short Range (<20Kb)", "Small"), ("Long Range (>20Kb)", "Large")]: Text += f"{Label}: {Stats[Name]:,} " + Percent(Stats[Name])
+	return Text
+
+def StatisticsHistograms(Stats: dict) -> str:
+	
+	# Same text as statistics.pl writes to *_hists.m
+	Text = "A = [\n" + ''.join([f"{Value} " for Value in Stats["RestrictionDistance"][1:]]) + "\n];\n"
+	Text += "B = [\n" + ''.join([f"{All} {Intra} {Inter}\n " for All, Intra, Inter in Stats["MapQ"]]) + "\n];\n"
+	Text += "D = [\n" + ''.join([f"{Inner} {Outer} {Right} {Left}\n" for Inner, Outer, Right, Left in Stats["PairTypes"][:len(DISTANCE_BINS)]]) + "\n];"
+	return Text + "x = [\n" + ''.join([f"{Bin} " for Bin in DISTANCE_BINS]) + "\n];\n"
+
+def WriteLibraryStatistics(
+		Statistics: dict,
+		Counts: dict,
+		StatsFiles: dict,
+		Logger: logging.Logger) -> None:
+	
+	# StatsFiles: {MapQ threshold: stats file}, e.g. {1: "inter.txt", 30: "inter_30.txt"}
+	# Each file gets the header of the first one (if any), LibraryComplexity and statistics.pl text, plus *_hists.m and *.json
+	FirstFile = StatsFiles[min(StatsFiles.keys())]
+	Header = open(FirstFile, 'rt').read() if os.path.isfile(FirstFile) else ""
+	Sequenced = SequencedReads(Header)
+	Complexity = LibraryComplexityText(Counts, Sequenced)
+	for MapQ, StatsFile in StatsFiles.items():
+		Stats = Statistics[str(MapQ)]
+		with StageOutput(StatsFile, Logger) as TempFile:
+			with open(TempFile, 'wt') as File: File.write(Header + Complexity + StatisticsText(Stats, Sequenced))
+		with StageOutput(f"{os.path.splitext(StatsFile)[0]}_hists.m", Logger) as TempFile:
+			with open(TempFile, 'wt') as File: File.write(StatisticsHistograms(Stats))
+		with StageOutput(f"{os.path.splitext(StatsFile)[0]}.json", Logger) as TempFile:
+			SaveJSON({"MapQ": MapQ, "Sequenced": Sequenced, "Complexity": {**Counts, "LibrarySize": EstimateLibrarySize(Counts["NoDups"] + Counts["Dups"], Counts["NoDups"])}, "Statistics": Stats, "DistanceBins": DISTANCE_BINS}, TempFile)
+		Logger.info(f"WriteLibraryStatistics: MAPQ >= {str(MapQ)}, {Stats['Contacts']:,} contacts -> {StatsFile}")
+
+def StatisticsBlock(Block: bytes, SiteFile: Union[str, None], Ligation: str, Thresholds: list) -> dict: return StatisticsChunk(Block.split(b'\n'), SiteFile, Ligation, Thresholds)
+
+def StatisticsRange(Range: tuple, StoreFile: str, SiteFile: Union[str, None], Ligation: str, Thresholds: list) -> dict: return StatisticsChunk(ContactLines(LoadContactStore(StoreFile), Range).split(b'\n'), SiteFile, Ligation, Thresholds)
+
+def MergedNoDupsStatistics(
+		InputFile: str,
+		SiteFile: Union[str, None],
+		Ligation: str,
+		Logger: logging.Logger,
+		Thresholds: list = [1, 30],
+		Threads: int = 1,
+		BlockSize: int = 64 * 1024 * 1024,
+		ChunkRows: int = 1000000) -> dict:
+	
+	# Standalone pass over an existing merged_nodups file or contact store (ligation and MapQ counters need its cigar and sequence columns)
+	Statistics = StatisticsChunk([], SiteFile, Ligation, Thresholds)
+	with WorkerPool("MergedNoDupsStatistics", Logger, Threads) as Workers:
+		if IsContactStore(InputFile): Function, Chunks, Kwargs = StatisticsRange, ContactRanges(LoadContactStore(InputFile), ChunkRows), {"StoreFile": InputFile}
+		else: Function, Chunks, Kwargs = StatisticsBlock, ReadBlocks(InputFile, Logger, BlockSize = BlockSize), {}
+		for Partial in Workers.Map(Function, Chunks, SiteFile = SiteFile, Ligation = Ligation, Thresholds = Thresholds, **Kwargs): Statistics = MergeStatistics([Statistics, Partial])
+	return Statistics
+	
+## ------======| CHIMERIC READS |======------
+
+AWK_STRNUM_PATTERN = re.compile(rb'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$')
+
+CIGAR_LENGTH_PATTERN = re.compile(rb'([0-9]+)[M|D|N|X|=]')
+
+CHIMERIC_NUMERIC_COLUMNS = {"Strand1": "uint8", "Chrom1": "int32", "Pos1": "int64", "Strand2": "uint8", "Chrom2": "int32", "Pos2": "int64", "MapQ1": "uint8", "MapQ2": "uint8"}
+
+CHIMERIC_STRING_COLUMNS = ["Cigar1", "Seq1", "Cigar2", "Seq2", "Name1", "Name2"]
+
+def AwkLess(Value1: bytes, Value2: bytes) -> int:
+	
+	# awk comparison of two fields: numeric if both look numeric, string otherwise; returns -1/0/1
+	if AWK_STRNUM_PATTERN.match(Value1) and AWK_STRNUM_PATTERN.match(Value2): Value1, Value2 = float(Value1), float(Value2)
+	return (Value1 > Value2) - (Value1 < Value2)
+
+def ChimericEnd(Line: bytes, Final: bool = False) -> dict:
+	
+	# One SAM record as chimeric_blacklist.awk sees it: 5' position on the reference, clipping included
+	Fields = Line.split()
+	Flag = int(Fields[1])
+	NameParts = Fields[0].split(b'/')
+	End = {"Line": Line, "Name": Fields[0], "Strand": Flag & 16, "Chrom": Fields[2], "Pos": int(Fields[3]), "PosText": Fields[3], "MapQ": Fields[4], "Cigar": Fields[5], "Seq": Fields[9], "Mapped": not (Flag & 4)}
+	# Read end: suffix of the name if any, else the first-in-pair bit (the awk END block has no fallback)
+	End["Read"] = NameParts[1] if len(NameParts) > 1 else (b'' if Final else int(Flag & 64 > 0))
+	Cigar, Position = Fields[5], None
+	if End["Strand"] == 0:
+		Clip = re.match(rb'^([0-9]+)[S]', Cigar) or re.match(rb'^([0-9]+)[H]', Cigar)
+		if Clip: Position = max(End["Pos"] - int(Clip.group(1)), 1)
+	else:
+		Position = End["Pos"] + sum([int(Length) for Length in CIGAR_LENGTH_PATTERN.findall(Cigar)]) - 1
+		Clip = re.search(rb'([0-9]+)S$', Cigar) or re.search(rb'([0-9]+)H$', Cigar)
+		if Clip: Position += int(Clip.group(1))
+	if Position is not None: End["Pos"], End["PosText"] = Position, str(Position).encode()
+	return End
+
+def ChimericRecord(End1: dict, End2: dict) -> tuple:
+	
+	# 14-field intermediate record, lesser end (chr, strand, pos) first
+	Order = AwkLess(End1["Chrom"], End2["Chrom"]) or ((End1["Strand"] > End2["Strand"]) - (End1["Strand"] < End2["Strand"])) or ((End1["Pos"] > End2["Pos"]) - (End1["Pos"] < End2["Pos"]))
+	if Order > 0: End1, End2 = End2, End1
+	return (End1, End2)
+
+def ClassifyReadGroup(Lines: list, Final: bool = False) -> tuple:
+	
+	# chimeric_blacklist.awk rules for one read-name group: ("reg" | "norm", (End1, End2)) or ("abnorm" | "unmapped", Lines)
+	if len(Lines) == 2:
+		Ends = [ChimericEnd(Line) for Line in Lines]
+		return ("reg", ChimericRecord(*Ends)) if Ends[0]["Mapped"] and Ends[1]["Mapped"] else ("unmapped", Lines)
+	if len(Lines) not in (3, 4): return ("abnorm", Lines)
+	Ends = [None] + [ChimericEnd(Line, Final) for Line in Lines]
+	Dist = lambda i, j: abs(AwkNumber(Ends[i]["Chrom"]) - AwkNumber(Ends[j]["Chrom"])) * 10000000 + abs(Ends[i]["Pos"] - Ends[j]["Pos"])
+	if len(Lines) == 4:
+		if (Dist(1, 3) < 1000 and Dist(2, 4) < 1000) or (Dist(1, 4) < 1000 and Dist(2, 3) < 1000): Read1, Read2 = 1, 2
+		elif Dist(1, 2) < 1000 and Dist(3, 4) < 1000: Read1, Read2 = 1, 3
+		else: return ("abnorm", Lines)
+	else:
+		if min(Dist(1, 2), Dist(2, 3), Dist(1, 3)) >= 1000: return ("abnorm", Lines)
+		# A/B...B: take the unique end B and the end of A/B that is not close to B
+		if Ends[1]["Read"] == Ends[2]["Read"]: Read1, Read2 = (1 if Dist(1, 3) > Dist(2, 3) else 2), 3
+		elif Ends[1]["Read"] == Ends[3]["Read"]: Read1, Read2 = (1 if Dist(1, 2) > Dist(2, 3) else 3), 2
+		elif Ends[2]["Read"] == Ends[3]["Read"]: Read1, Read2 = (2 if Dist(1, 2) > Dist(1, 3) else 3), 1
+		else: raise ValueError(f"Reads strange: {Ends[1]['Name'].decode()}")
+	return ("norm", ChimericRecord(Ends[Read1], Ends[Read2])) if Ends[Read1]["Mapped"] and Ends[Read2]["Mapped"] else ("unmapped", Lines)
+
+def ChimericChunk(Chunk: tuple) -> dict:
+	
+	# Classify a chunk of whole read groups; normal records are returned as text and as columns
+	Lines, Final = Chunk
+	Result = {"Norm": [], "Abnorm": [], "Unmapped": [], "Counts": {"Total": 0, "Unmapped": 0, "Regular": 0, "Normal": 0, "Abnormal": 0}}
+	Records, Start = [], 0
+	for Number in range(1, len(Lines) + 1):
+		if Number < len(Lines) and Lines[Number].split(b'\t', 1)[0].split(b'/')[0] == Lines[Start].split(b'\t', 1)[0].split(b'/')[0]: continue
+		Kind, Payload = ClassifyReadGroup(Lines[Start:Number], Final and Number == len(Lines))
+		Result["Counts"]["Total"] += 1
+		Result["Counts"][{"reg": "Regular", "norm": "Normal", "abnorm": "Abnormal", "unmapped": "Unmapped"}[Kind]] += 1
+		if Kind in ("reg", "norm"): Records.append(Payload)
+		else: Result["Abnorm" if Kind == "abnorm" else "Unmapped"].extend(Payload)
+		Start = Number
+	Result["Norm"] = b''.join([b'\t'.join([str(End1["Strand"]).encode(), End1["Chrom"], End1["PosText"], str(End2["Strand"]).encode(), End2["Chrom"], End2["PosText"], End1["MapQ"], End1["Cigar"], End1["Seq"], End2["MapQ"], End2["Cigar"], End2["Seq"], End1["Name"], End2["Name"]]) + b'\n' for End1, End2 in Records])
+	Result["Abnorm"], Result["Unmapped"] = b''.join(Result["Abnorm"]), b''.join(Result["Unmapped"])
+	# Chromosomes are coded locally here and recoded against the global dictionary by the writer
+	Chroms = sorted(set([End["Chrom"] for Record in Records for End in Record]))
+	Codes = {Chrom: Code for Code, Chrom in enumerate(Chroms)}
+	Result["Chroms"] = [Chrom.decode('utf-8') for Chrom in Chroms]
+	Result["Columns"] = {f"{Key}{Number}": numpy.array([Codes[Record[Number - 1]["Chrom"]] if Key == "Chrom" else int(Record[Number - 1][Key]) for Record in Records], dtype=CHIMERIC_NUMERIC_COLUMNS[f"{Key}{Number}"]) for Key in ["Strand", "Chrom", "Pos", "MapQ"] for Number in (1, 2)}
+	Result["Columns"].update({f"{Key}{Number}": [Record[Number - 1][Key] for Record in Records] for Key in ["Cigar", "Seq", "Name"] for Number in (1, 2)})
+	return Result
+
+def ReadGroupChunks(InputFile: str, ChunkSize: int, Threads: int = 1):
+	
+	# SAM lines of a name-sorted SAM/BAM, cut into chunks at read-name group boundaries; the last chunk is flagged
+	Chunk, Name, Previous = [], None, None
+	with pysam.AlignmentFile(InputFile, 'r', check_sq=False, threads=Threads) as File:
+		for Read in File.fetch(until_eof=True):
+			Line = Read.to_string().encode('utf-8') + b'\n'
+			if len(Chunk) >= ChunkSize:
+				LineName = Line.split(b'\t', 1)[0].split(b'/')[0]
+				if Name is not None and LineName != Name:
+					if Previous is not None: yield (Previous, False)
+					Previous, Chunk, LineName = Chunk, [], None
+				Name = LineName
+			Chunk.append(Line)
+	if Previous is not None: yield (Previous, not Chunk)
+	if Chunk: yield (Chunk, True)
+
+def AppendChimericColumns(Directory: str, Columns: dict, Chroms: list, Dictionary: dict) -> int:
+	
+	# Raw little-endian column files; strings as concatenated bytes + int32 lengths
+	Recode = numpy.array([Dictionary.setdefault(Chrom, len(Dictionary)) for Chrom in Chroms] or [0], dtype=numpy.int32)
+	for Name, DType in CHIMERIC_NUMERIC_COLUMNS.items():
+		Values = Recode[Columns[Name]] if Name.startswith("Chrom") else Columns[Name]
+		with open(os.path.join(Directory, f"{Name}.bin"), 'ab') as File: Values.astype(DType).tofile(File)
+	for Name in CHIMERIC_STRING_COLUMNS:
+		with open(os.path.join(Directory, f"{Name}.bin"), 'ab') as File: File.write(b''.join(Columns[Name]))
+		with open(os.path.join(Directory, f"{Name}.lengths"), 'ab') as File: numpy.array([len(Value) for Value in Columns[Name]], dtype=numpy.int32).tofile(File)
+	return len(Columns["Pos1"])
+
+def LoadChimericColumns(Directory: str) -> dict:
+	
+	# Memory-mapped columns; string columns are returned as (bytes, offsets)
+	Manifest = json.load(open(os.path.join(Directory, "columns.json"), 'rt'))
+	Load = lambda Name, DType: numpy.memmap(os.path.join(Directory, Name), dtype=DType, mode='r') if Manifest["Rows"] else numpy.array([], dtype=DType)
+	Columns = {Name: Load(f"{Name}.bin", DType) for Name, DType in Manifest["Columns"].items()}
+	for Name in Manifest["Strings"]: Columns[Name] = (Load(f"{Name}.bin", numpy.uint8), numpy.concatenate([[0], numpy.cumsum(Load(f"{Name}.lengths", numpy.int32), dtype=numpy.int64)]))
+	Columns["Chroms"] = Manifest["Chroms"]
+	return Columns
+
+def ChimericBlacklist(
+		InputFile: str,
+		Prefix: str,
+		Logger: logging.Logger,
+		Threads: int = 1,
+		ChunkSize: int = 1000000,
+		Columns: bool = True) -> dict:
+	
+	# Drop-in replacement of chimeric_blacklist.awk: {Prefix}_norm.txt, _abnorm.sam, _unmapped.sam, _norm.txt.res.txt
+	# and, if Columns, the normal records in columnar form in {Prefix}_norm.cols/
+	StartTime = time.time()
+	for line in [f"Input file: {InputFile}", f"Output prefix: {Prefix}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	Counts = {"Total": 0, "Unmapped": 0, "Regular": 0, "Normal": 0, "Abnormal": 0}
+	Dictionary, Rows = {}, 0
+	with contextlib.ExitStack() as Stack:
+		Outputs = {Name: open(Stack.enter_context(StageOutput(f"{Prefix}{Suffix}", Logger)), 'wb') for Name, Suffix in [("Norm", "_norm.txt"), ("Abnorm", "_abnorm.sam"), ("Unmapped", "_unmapped.sam")]}
+		for File in Outputs.values(): Stack.callback(File.close)
+		# SAM outputs carry the input header plus the awk script's @PG line; fetch() never yields it
+		with pysam.AlignmentFile(InputFile, 'r', check_sq=False) as File: Header = (str(File.header) + "@PG\tID:Juicer\tVN:1.6\n").encode('utf-8')
+		for Name in ["Abnorm", "Unmapped"]: Outputs[Name].write(Header)
+		if Columns: shutil.rmtree(f"{Prefix}_norm.cols", ignore_errors=True)
+		ColumnsDir = Stack.enter_context(StageOutput(f"{Prefix}_norm.cols", Logger)) if Columns else None
+		if Columns: os.mkdir(ColumnsDir)
+		Workers = Stack.enter_context(WorkerPool("ChimericBlacklist", Logger, Threads))
+		for Result in Workers.Map(ChimericChunk, ReadGroupChunks(InputFile, ChunkSize, Threads)):
+			for Name, File in Outputs.items(): File.write(Result[Name])
+			for Key, Value in Result["Counts"].items(): Counts[Key] += Value
+			if Columns: Rows += AppendChimericColumns(ColumnsDir, Result["Columns"], Result["Chroms"], Dictionary)
+		if Columns: SaveJSON({"Rows": Rows, "Chroms": list(Dictionary.keys()), "Columns": CHIMERIC_NUMERIC_COLUMNS, "Strings": CHIMERIC_STRING_COLUMNS}, os.path.join(ColumnsDir, "columns.json"))
+	with open(f"{Prefix}_norm.txt.res.txt", 'at') as File: File.write(f"{Counts['Total']} {Counts['Unmapped']} {Counts['Regular']} {Counts['Normal']} {Counts['Abnormal']}\n")
+	Logger.info(f"ChimericBlacklist: {Counts['Total']:,} read groups, {Counts['Regular']:,} regular, {Counts['Normal']:,} chimeric paired, {Counts['Abnormal']:,} abnormal, {Counts['Unmapped']:,} unmapped - %s" % (SecToTime(time.time() - StartTime)))
+	return Counts
+	
+## ------======| FASTQ CHUNKS |======------
+
+def IsBGZF(FileName: str) -> bool:
+	Header = open(FileName, 'rb').read(14)
+	return len(Header) == 14 and Header[:4] == b'\x1f\x8b\x08\x04' and Header[12:14] == b'BC'
+
+def NthLineEnd(Block: bytes, Number: int) -> int:
+	Position = -1
+	for _ in range(Number): Position = Block.index(b'\n', Position + 1)
+	return Position + 1
+
+def FastQIndex(
+		FileName: str,
+		Logger: logging.Logger,
+		Step: int = 1000000,
+		BlockSize: int = 16 * 1024 * 1024) -> dict:
+	
+	# BGZF virtual offsets of every Step-th record, cached next to the file; plain gzip cannot be seeked, so it has no offsets
+	IndexFile = f"{FileName}.fqidx"
+	if os.path.isfile(IndexFile):
+		Index = json.load(open(IndexFile, 'rt'))
+		if Index["Source"] == FileSignature(FileName) and Index["Step"] == Step: return Index
+	StartTime = time.time()
+	Index = {"Source": FileSignature(FileName), "Step": Step, "Offsets": None, "Records": None}
+	if IsBGZF(FileName):
+		Offsets, Lines, Need = [0], 0, Step * 4
+		with pysam.BGZFile(FileName, 'rb') as File:
+			while True:
+				Start = File.tell()
+				Block = File.read(BlockSize)
+				if not Block: break
+				Count = Block.count(b'\n')
+				Lines += Count
+				if Count < Need:
+					Need -= Count
+					continue
+				# Checkpoint inside the block: re-read up to it to get its virtual offset
+				Cut = NthLineEnd(Block, Need)
+				File.seek(Start)
+				File.read(Cut)
+				Offsets.append(File.tell())
+				Lines -= Count - Need
+				Need = Step * 4
+		Index["Records"] = Lines // 4
+		Index["Offsets"] = Offsets[:max(1, -(-Index["Records"] // Step))]
+	with StageOutput(IndexFile, Logger) as TempFile: SaveJSON(Index, TempFile)
+	Logger.info(f"FastQIndex: {FileName}, {str(len(Index['Offsets'] or [0]))} chunks - %s" % (SecToTime(time.time() - StartTime)))
+	return Index
+
+def FeedFastQ(
+		FileName: str,
+		Pipe: str,
+		Offset: Union[int, None] = None,
+		Records: Union[int, None] = None,
+		BlockSize: int = 16 * 1024 * 1024) -> None:
+	
+	# Writes Records reads from the virtual Offset (or the whole file) into the pipe
+	with open(Pipe, 'wb') as Output:
+		if Offset is None:
+			with OpenAnyway(FileName, 'rb', logging.getLogger(__name__), Threads = 2, BufferSize = BlockSize) as File: shutil.copyfileobj(File, Output, BlockSize)
+			return
+		with pysam.BGZFile(FileName, 'rb') as File:
+			File.seek(Offset)
+			Need = Records * 4
+			while Need > 0:
+				Block = File.read(BlockSize)
+				if not Block: break
+				Count = Block.count(b'\n')
+				if Count >= Need:
+					Output.write(Block[:NthLineEnd(Block, Need)])
+					break
+				Output.write(Block)
+				Need -= Count
+
+def AlignFastQChunks(
+		Read1: str,
+		Read2: str,
+		Command: str,
+		OutputPrefix: str,
+		Logger: logging.Logger,
+		Workers: int = 1,
+		Threads: int = 1,
+		Step: int = 1000000) -> list:
+	
+	# Aligns a FASTQ pair chunk by chunk in parallel; each aligner reads its chunk from named pipes, no split copies are written.
+	# Command is a template with {Read1}, {Read2}, {Threads} and {Output}, e.g. "bwa mem -SP5M -t {Threads} ref.fa {Read1} {Read2} > {Output}"
+	for line in [f"Read 1: {Read1}", f"Read 2: {Read2}", f"Command: {Command}", f"Output prefix: {OutputPrefix}", f"Workers: {str(Workers)}", f"Threads per worker: {str(Threads)}"]: Logger.info(line)
+	Index1, Index2 = FastQIndex(Read1, Logger, Step), FastQIndex(Read2, Logger, Step)
+	if Index1["Offsets"] is None or Index2["Offsets"] is None:
+		Logger.warning(f"FASTQ pair is not BGZF-compressed, aligning it as one chunk")
+		Chunks = [(None, None)]
+	elif Index1["Records"] != Index2["Records"]:
+		ErrorMessage = f"FASTQ pair has different read counts: {Index1['Records']:,} and {Index2['Records']:,}"
+		Logger.error(ErrorMessage)
+		raise ValueError(ErrorMessage)
+	else: Chunks = list(zip(Index1["Offsets"], Index2["Offsets"]))
+	
+	def AlignChunk(Number, Offsets):
+		OutputFile = f"{OutputPrefix}{Number:04d}.sam"
+		with StageOutput(OutputFile, Logger) as TempFile:
+			Pipes = [os.path.join(os.path.dirname(TempFile), f"R{str(Read)}.fastq") for Read in [1, 2]]
+			for Pipe in Pipes: os.mkfifo(Pipe)
+			with concurrent.futures.ThreadPoolExecutor(max_workers=2) as Executor:
+				Feeders = [Executor.submit(FeedFastQ, FileName, Pipe, Offset, None if Offset is None else Step) for FileName, Pipe, Offset in zip([Read1, Read2], Pipes, Offsets)]
+				try:
+					StreamingSubprocess(Name = f"AlignFastQChunks.{Number:04d}", Command = Command.format(Read1 = Pipes[0], Read2 = Pipes[1], Threads = Threads, Output = TempFile), Logger = Logger)
+				finally:
+					# Unblocks feeders whose pipe the aligner never opened
+					for Pipe in Pipes: os.close(os.open(Pipe, os.O_RDONLY | os.O_NONBLOCK))
+				for Feeder in Feeders: Feeder.result()
+		return OutputFile
+	
+	StartTime = time.time()
+	with concurrent.futures.ThreadPoolExecutor(max_workers=Workers) as Executor:
+		OutputFiles = [Future.result() for Future in [Executor.submit(AlignChunk, Number, Offsets) for Number, Offsets in enumerate(Chunks)]]
+	Logger.info(f"AlignFastQChunks: {str(len(Chunks))} chunks - %s" % (SecToTime(time.time() - StartTime)))
+	return OutputFiles
+	
+## ------======| JUICER TOOLS |======------
+
+JUICER_WORKER_SOURCE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "JuicerWorker.java")
+
+JUICER_WORKER_DONE = "@@JUICER_WORKER_DONE"
+
+def JavaMajorVersion() -> int:
+	Match = re.search(r'version "(\d+)(?:\.(\d+))?', subprocess.run(["java", "-version"], capture_output=True, text=True).stderr)
+	if Match is None: return 0
+	return int(Match.group(2)) if Match.group(1) == "1" else int(Match.group(1))
+
+class JuicerToolsWorker:
+	
+	# One warm juicer_tools JVM (JuicerWorker.java); jobs from any thread are queued and run one at a time.
+	# If the worker cannot be built or started, every job falls back to its own `java -jar` run
+	def __init__(self, JarPath: str, Logger: logging.Logger, Memory: str = "8g"):
+		self.JarPath, self.Logger, self.Memory = JarPath, Logger, Memory
+		self.Process, self.Fallback, self.Counter = None, False, 0
+		self.Jobs = queue.Queue()
+		self.Thread = threading.Thread(target=self.Loop, name="JuicerToolsWorker", daemon=True)
+		self.Thread.start()
+	
+	def Command(self) -> list:
+		ClassDir = os.path.join(tempfile.gettempdir(), f"juicer_worker_{hashlib.sha256((FileSignature(JUICER_WORKER_SOURCE) + os.path.realpath(self.JarPath)).encode()).hexdigest()[:16]}")
+		if not os.path.isfile(os.path.join(ClassDir, "JuicerWorker.class")):
+			with StageOutput(ClassDir, self.Logger) as TempDir:
+				os.mkdir(TempDir)
+				SimpleSubprocess(Name = "CompileJuicerWorker", Command = f"javac -cp \"{self.JarPath}\" -d \"{TempDir}\" \"{JUICER_WORKER_SOURCE}\"", Logger = self.Logger)
+		# Java 18+ needs explicit permission to install the security manager that traps System.exit()
+		return ["java", f"-Xmx{self.Memory}"] + (["-Djava.security.manager=allow"] if JavaMajorVersion() >= 18 else []) + ["-cp", f"{ClassDir}{os.pathsep}{self.JarPath}", "JuicerWorker"]
+	
+	def Receive(self, Name: str, Logger: logging.Logger) -> int:
+		Tail = collections.deque(maxlen=100)
+		while True:
+			Line = self.Process.stdout.readline()
+			if not Line: raise OSError(f"juicer_tools worker has died, exit code {str(self.Process.wait())}: {' '.join(Tail)}")
+			if Line.startswith(JUICER_WORKER_DONE): return int(Line.rstrip('\n').split('\t')[2])
+			Tail.append(Line.rstrip('\n'))
+			Logger.debug(f"[{Name}] {Tail[-1]}")
+	
+	def Start(self) -> None:
+		try:
+			self.Process = subprocess.Popen(self.Command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+			if self.Receive("JuicerToolsWorker", self.Logger) != 0: raise OSError("worker is not supported by this JVM")
+			self.Logger.info(f"juicer_tools worker started, PID {str(self.Process.pid)}")
+		except Exception as Err:
+			self.Logger.warning(f"juicer_tools worker is not available ({Err}), each job will start its own JVM")
+			self.Process, self.Fallback = None, True
+	
+	def Run(self, Args: list, Name: str, Logger: logging.Logger) -> None:
+		if self.Fallback:
+			StreamingSubprocess(Name = Name, Command = f"java -Xmx{self.Memory} -jar \"{self.JarPath}\" " + ' '.join([f"\"{Arg}\"" for Arg in Args]), Logger = Logger)
+			return
+		self.Counter += 1
+		StartTime = time.time()
+		self.Process.stdin.write('\t'.join([str(self.Counter)] + [str(Arg) for Arg in Args]) + '\n')
+		self.Process.stdin.flush()
+		ReturnCode = self.Receive(Name, Logger)
+		if ReturnCode != 0:
+			ErrorMessage = f"Command '{Name}' has returned non-zero exit code [{str(ReturnCode)}]\nCommand: juicer_tools {' '.join([str(Arg) for Arg in Args])}"
+			Logger.error(ErrorMessage)
+			raise OSError(ErrorMessage)
+		Logger.info(f"{Name} (juicer_tools worker) - %s" % (SecToTime(time.time() - StartTime)))
+	
+	def Loop(self) -> None:
+		while True:
+			Job = self.Jobs.get()
+			if Job is None: break
+			Args, Name, Logger, Future = Job
+			if not Future.set_running_or_notify_cancel(): continue
+			try:
+				if not self.Fallback and (self.Process is None or self.Process.poll() is not None): self.Start()
+				self.Run(Args, Name, Logger)
+				Future.set_result(None)
+			except Exception as Err:
+				Future.set_exception(Err)
+		if self.Process is not None:
+			self.Process.stdin.close()
+			self.Process.wait()
+	
+	def Submit(self, Args: list, Name: str, Logger: Union[logging.Logger, None] = None) -> concurrent.futures.Future:
+		Future = concurrent.futures.Future()
+		self.Jobs.put((Args, Name, Logger or self.Logger, Future))
+		return Future
+	
+	def Close(self) -> None:
+		self.Jobs.put(None)
+		self.Thread.join()
+
+JUICER_WORKERS, JUICER_WORKERS_LOCK = {}, threading.Lock()
+
+def JuicerTools(
+		Args: list,
+		Name: str,
+		JarPath: str,
+		Logger: logging.Logger,
+		Memory: str = "8g") -> None:
+	
+	# Runs a juicer_tools command on the shared worker of this jar, blocks until it is done
+	with JUICER_WORKERS_LOCK:
+		if JarPath not in JUICER_WORKERS: JUICER_WORKERS[JarPath] = JuicerToolsWorker(JarPath, Logger, Memory)
+		Worker = JUICER_WORKERS[JarPath]
+	with Span(Name, Kind = "tool", Block = Logger.name): Worker.Submit(Args, Name, Logger).result()
+	
+## ------======| CONTACT STORE |======------
+
+CONTACT_STORE_MAGIC = b'HICCOLS1'
+
+CONTACT_NUMERIC_COLUMNS = {"Strand1": "int8", "Chrom1": "int32", "Pos1": "int32", "Frag1": "int32", "Strand2": "int8", "Chrom2": "int32", "Pos2": "int32", "Frag2": "int32", "MapQ1": "uint8", "MapQ2": "uint8"}
+
+# Optional string columns and their merged_nodups fields
+CONTACT_STRING_COLUMNS = {"Cigar1": 9, "Seq1": 10, "Cigar2": 12, "Seq2": 13, "Name1": 14, "Name2": 15}
+
+def Align(Size: int, Alignment: int) -> int: return -(-Size // Alignment) * Alignment
+
+def IsContactStore(FileName: str) -> bool: return os.path.isfile(FileName) and open(FileName, 'rb').read(len(CONTACT_STORE_MAGIC)) == CONTACT_STORE_MAGIC
+
+def ContactBlock(Block: bytes, Strings: list = []) -> dict:
+	
+	# merged_nodups records to numeric columns with chunk-local chromosome codes, and runs of equal (chr1, chr2)
+	Records = [Fields for Fields in (Line.split() for Line in Block.split(b'\n')) if Fields]
+	Chroms = {}
+	Columns = {Name: numpy.array([int(Fields[Index]) for Fields in Records], dtype=CONTACT_NUMERIC_COLUMNS[Name]) for Name, Index in [("Strand1", 0), ("Pos1", 2), ("Frag1", 3), ("Strand2", 4), ("Pos2", 6), ("Frag2", 7)]}
+	Columns.update({Name: numpy.array([int(Fields[Index]) if len(Fields) > Index else 0 for Fields in Records], dtype=CONTACT_NUMERIC_COLUMNS[Name]) for Name, Index in [("MapQ1", 8), ("MapQ2", 11)]})
+	Columns.update({Name: numpy.array([Chroms.setdefault(Fields[Index], len(Chroms)) for Fields in Records], dtype=numpy.int32) for Name, Index in [("Chrom1", 1), ("Chrom2", 5)]})
+	Changes = numpy.flatnonzero((Columns["Chrom1"][1:] != Columns["Chrom1"][:-1]) | (Columns["Chrom2"][1:] != Columns["Chrom2"][:-1])) + 1
+	Starts, Ends = numpy.concatenate([[0], Changes]), numpy.concatenate([Changes, [len(Records)]])
+	return {
+		"Rows": len(Records),
+		"Chroms": [Chrom.decode('utf-8') for Chrom in Chroms],
+		"Columns": Columns,
+		"Strings": {Name: [Fields[CONTACT_STRING_COLUMNS[Name]] if len(Fields) > CONTACT_STRING_COLUMNS[Name] else b'' for Fields in Records] for Name in Strings},
+		"Runs": [(int(Columns["Chrom1"][Start]), int(Columns["Chrom2"][Start]), int(Start), int(End)) for Start, End in zip(Starts, Ends)] if Records else []
+		}
+
+def WriteContactStore(
+		InputFile: str,
+		OutputFile: str,
+		Logger: logging.Logger,
+		Threads: int = 1,
+		Strings: list = [],
+		BlockSize: int = 64 * 1024 * 1024) -> dict:
+	
+	# One-file columnar copy of merged_nodups: magic, header length, JSON header, then 64-byte aligned columns from a 4 KB boundary.
+	# Header "Blocks" lists row ranges [chrom1, chrom2, start, end] of chromosome pairs; Strings are optional string columns (see CONTACT_STRING_COLUMNS)
+	StartTime = time.time()
+	for line in [f"Input file: {InputFile}", f"Output file: {OutputFile}", f"String columns: {', '.join(Strings) if Strings else 'none'}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	Unknown = [Name for Name in Strings if Name not in CONTACT_STRING_COLUMNS]
+	if Unknown: raise ValueError(f"Unknown string columns: {', '.join(Unknown)}")
+	Dictionary, Blocks, Rows = {}, [], 0
+	with StageOutput(OutputFile, Logger) as TempFile:
+		
+		# Columns are collected in part files next to the output, then laid out after the header
+		Sections = [(Name, DType) for Name, DType in CONTACT_NUMERIC_COLUMNS.items()] + [Item for Name in Strings for Item in [(Name, "uint8"), (f"{Name}.offsets", "int64")]]
+		Parts = {Name: open(f"{TempFile}.{Name}.part", 'w+b') for Name, _ in Sections}
+		try:
+			for Name in Strings: numpy.zeros(1, dtype=numpy.int64).tofile(Parts[f"{Name}.offsets"])
+			StringSizes = {Name: 0 for Name in Strings}
+			with WorkerPool("WriteContactStore", Logger, Threads) as Workers:
+				for Result in Workers.Map(ContactBlock, ReadBlocks(InputFile, Logger, BlockSize = BlockSize), Strings = Strings):
+					Recode = numpy.array([Dictionary.setdefault(Chrom, len(Dictionary)) for Chrom in Result["Chroms"]] or [0], dtype=numpy.int32)
+					for Name, DType in CONTACT_NUMERIC_COLUMNS.items(): (Recode[Result["Columns"][Name]] if Name.startswith("Chrom") else Result["Columns"][Name]).astype(DType).tofile(Parts[Name])
+					for Name, Values in Result["Strings"].items():
+						Parts[Name].write(b''.join(Values))
+						Ends = StringSizes[Name] + numpy.cumsum([len(Value) for Value in Values], dtype=numpy.int64)
+						Ends.tofile(Parts[f"{Name}.offsets"])
+						if len(Ends): StringSizes[Name] = int(Ends[-1])
+					for Chrom1, Chrom2, Start, End in Result["Runs"]:
+						Block = [int(Recode[Chrom1]), int(Recode[Chrom2]), Rows + Start, Rows + End]
+						if Blocks and Blocks[-1][:2] == Block[:2] and Blocks[-1][3] == Block[2]: Blocks[-1][3] = Block[3]
+						else: Blocks.append(Block)
+					Rows += Result["Rows"]
+			
+			# Layout
+			Header = {"Rows": Rows, "Chroms": list(Dictionary.keys()), "Strings": Strings, "Blocks": Blocks, "Source": FileSignature(InputFile), "Columns": {}}
+			Offset = 0
+			for Name, DType in Sections:
+				Size = Parts[Name].seek(0, os.SEEK_END)
+				Header["Columns"][Name] = {"DType": DType, "Offset": Offset, "Count": Size // numpy.dtype(DType).itemsize}
+				Offset += Align(Size, 64)
+			HeaderBytes = json.dumps(Header).encode('utf-8')
+			with open(TempFile, 'wb') as Output:
+				Output.write(CONTACT_STORE_MAGIC + len(HeaderBytes).to_bytes(8, 'little') + HeaderBytes)
+				Output.write(b'\0' * (Align(Output.tell(), 4096) - Output.tell()))
+				DataStart = Output.tell()
+				for Name, _ in Sections:
+					Parts[Name].seek(0)
+					shutil.copyfileobj(Parts[Name], Output, 16 * 1024 * 1024)
+					Output.write(b'\0' * (DataStart + Align(Output.tell() - DataStart, 64) - Output.tell()))
+		finally:
+			for Name, File in Parts.items():
+				File.close()
+				os.remove(f"{TempFile}.{Name}.part")
+	Logger.info(f"WriteContactStore: {Rows:,} records, {str(len(Dictionary))} chromosomes, {str(len(Blocks))} chromosome pair blocks - %s" % (SecToTime(time.time() - StartTime)))
+	return {"Rows": Rows, "Chroms": len(Dictionary), "Blocks": len(Blocks)}
+
+def LoadContactStore(FileName: str) -> dict:
+	
+	# Header and memory-mapped columns; string columns are returned as (bytes, offsets)
+	with open(FileName, 'rb') as File:
+		if File.read(len(CONTACT_STORE_MAGIC)) != CONTACT_STORE_MAGIC: raise ValueError(f"'{FileName}' is not a contact store")
+		Length = int.from_bytes(File.read(8), 'little')
+		Header = json.loads(File.read(Length))
+	DataStart = Align(len(CONTACT_STORE_MAGIC) + 8 + Length, 4096)
+	Load = lambda Column: numpy.memmap(FileName, dtype=Column["DType"], mode='r', offset=DataStart + Column["Offset"], shape=(Column["Count"],)) if Column["Count"] else numpy.array([], dtype=Column["DType"])
+	Columns = {Name: Load(Column) for Name, Column in Header["Columns"].items()}
+	for Name in Header["Strings"]: Columns[Name] = (Columns[Name], Columns.pop(f"{Name}.offsets"))
+	return {"FileName": FileName, "Rows": Header["Rows"], "Chroms": Header["Chroms"], "Strings": Header["Strings"], "Blocks": Header["Blocks"], "Source": Header["Source"], "Columns": Columns}
+
+def ContactBlocks(Store: dict, Chrom1: Union[str, None] = None, Chrom2: Union[str, None] = None) -> list:
+	
+	# Row ranges of a chromosome pair (in any order), of all pairs with Chrom1, or of the whole store
+	Selected = []
+	for Code1, Code2, Start, End in Store["Blocks"]:
+		Names = {Store["Chroms"][Code1], Store["Chroms"][Code2]}
+		if Chrom1 is not None and Chrom1 not in Names: continue
+		if Chrom2 is not None and ({Chrom1, Chrom2} != Names): continue
+		Selected.append((Start, End))
+	return Selected
+
+def ContactRanges(Store: dict, ChunkRows: int = 10000000, Chrom1: Union[str, None] = None, Chrom2: Union[str, None] = None) -> list:
+	
+	# Work ranges of about ChunkRows rows inside chromosome pair blocks, cut only where frag1 changes (the sorted group of merged_nodups)
+	Fragments = Store["Columns"]["Frag1"]
+	Ranges = []
+	for Start, End in ContactBlocks(Store, Chrom1, Chrom2):
+		while Start < End:
+			Cut = min(Start + ChunkRows, End)
+			if Cut < End:
+				Fragment = Fragments[Cut]
+				Cut = Start + int(numpy.searchsorted(Fragments[Start:End], Fragment, side='left'))
+				if Cut == Start: Cut = Start + int(numpy.searchsorted(Fragments[Start:End], Fragment, side='right'))
+			Ranges.append((Start, Cut))
+			Start = Cut
+	return Ranges
+
+def ContactColumns(Store: dict, Names: list, Ranges: list) -> dict:
+	
+	# Numeric columns as arrays (memory-mapped views for a single range), string columns as lists of bytes
+	Result = {}
+	for Name in Names:
+		Column = Store["Columns"][Name]
+		if Name in Store["Strings"]:
+			Values, Offsets = Column
+			Result[Name] = [bytes(Values[Offsets[Row]:Offsets[Row + 1]]) for Start, End in Ranges for Row in range(Start, End)]
+		else:
+			Result[Name] = Column[Ranges[0][0]:Ranges[0][1]] if len(Ranges) == 1 else numpy.concatenate([Column[Start:End] for Start, End in Ranges] or [Column[:0]])
+	return Result
+
+def ContactLines(Store: dict, Range: tuple) -> bytes:
+	
+	# merged_nodups text of a row range; records are short (8 fields) unless cigars and sequences are stored
+	Names = list(CONTACT_NUMERIC_COLUMNS.keys()) + Store["Strings"]
+	Columns = ContactColumns(Store, Names, [Range])
+	Columns.update({Name: Columns[Name].tolist() for Name in CONTACT_NUMERIC_COLUMNS})
+	Chroms = [Chrom.encode('utf-8') for Chrom in Store["Chroms"]]
+	Full = all([Name in Store["Strings"] for Name in ["Cigar1", "Seq1", "Cigar2", "Seq2"]])
+	Lines = []
+	for Row in range(Range[1] - Range[0]):
+		Fields = [str(Columns["Strand1"][Row]).encode(), Chroms[Columns["Chrom1"][Row]], str(Columns["Pos1"][Row]).encode(), str(Columns["Frag1"][Row]).encode(), str(Columns["Strand2"][Row]).encode(), Chroms[Columns["Chrom2"][Row]], str(Columns["Pos2"][Row]).encode(), str(Columns["Frag2"][Row]).encode()]
+		if Full: Fields += [str(Columns["MapQ1"][Row]).encode(), Columns["Cigar1"][Row], Columns["Seq1"][Row], str(Columns["MapQ2"][Row]).encode(), Columns["Cigar2"][Row], Columns["Seq2"][Row]] + [Columns[Name][Row] for Name in ["Name1", "Name2"] if Name in Store["Strings"]]
+		Lines.append(b' '.join(Fields) + b'\n')
+	return b''.join(Lines)
+
+def CaptureContacts(
+		StoreFile: str,
+		Chrom: str,
+		Start: int,
+		End: int,
+		Names: list = ["Chrom1", "Pos1", "Chrom2", "Pos2"]) -> dict:
+	
+	# Records with at least one end in the capture region [Start, End), only blocks of pairs with Chrom are read
+	Store = LoadContactStore(StoreFile)
+	if Chrom not in Store["Chroms"]: return {Name: [] if Name in Store["Strings"] else Store["Columns"][Name][:0] for Name in Names}
+	Code = Store["Chroms"].index(Chrom)
+	Ranges = ContactBlocks(Store, Chrom)
+	Columns = ContactColumns(Store, ["Chrom1", "Pos1", "Chrom2", "Pos2"], Ranges)
+	Mask = ((Columns["Chrom1"] == Code) & (Columns["Pos1"] >= Start) & (Columns["Pos1"] < End)) | ((Columns["Chrom2"] == Code) & (Columns["Pos2"] >= Start) & (Columns["Pos2"] < End))
+	Selected = ContactColumns(Store, Names, Ranges)
+	return {Name: [Value for Value, Keep in zip(Selected[Name], Mask) if Keep] if Name in Store["Strings"] else numpy.asarray(Selected[Name])[Mask] for Name in Names}
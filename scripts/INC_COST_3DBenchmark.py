@@ -1,56 +1,111 @@
 from SharedFunctions import *
+from HiCFunctions import *
 
 import cooler
 import cooltools
+import h5py
 
 # GLOBAL
 
 JUICER_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../juicer")
-GENERATE_SITE_POSITIONS_PATH = os.path.join(JUICER_PATH, "misc/generate_site_positions.py")
+
+# Peak memory estimates of pipeline stages [GB], used by the scheduler
+STAGE_MEMORY = {
+	"Sra2FastQ": 1,
+	"Juicer": 16,
+	"WriteContactStore": 2,
+	"MakeInterPairs": 2,
+	"MergedNoDups2Cool": 8,
+	"CTaleNormalize": 8,
+	"AddWeight": 1,
+	"Vector2HiC": 4,
+	"MergeCoolers": 4,
+	"MergeNewContacts": 2,
+	"ApplyContactDelta": 8,
+	"MergedNoDups2HiC": 16
+	}
+
+# Ligation junctions of juicer.sh, used for library statistics
+LIGATION_JUNCTIONS = {
+	"HindIII": "AAGCTAGCTT",
+	"MseI": "TTATAA",
+	"DpnII": "GATCGATC",
+	"MboI": "GATCGATC",
+	"NcoI": "CCATGCATGG",
+	"Arima": "(GAATAATC|GAATACTC|GAATAGTC|GAATATTC|GAATGATC|GACTAATC|GACTACTC|GACTAGTC|GACTATTC|GACTGATC|GAGTAATC|GAGTACTC|GAGTAGTC|GAGTATTC|GAGTGATC|GATCAATC|GATCACTC|GATCAGTC|GATCATTC|GATCGATC|GATTAATC|GATTACTC|GATTAGTC|GATTATTC|GATTGATC)",
+	"none": "XXXX"
+	}
+
+# Published files of a finished block
+BLOCK_RESULTS = ["inter.cool", "inter.hic", "inter_no_balanced.cool", "inter_statistics.txt", "merged_nodups.txt", "vector.txt", "inter.pairs.gz"]
+
+# Concurrent fastq-dump extractions, bounded by disk bandwidth rather than by cores
+SRA_DISK_SLOTS = threading.BoundedSemaphore(3)
 
 # PREPARATION FUNCS
 
-def GetRestrictionSiteLocations(Enzyme, GenomeAssembly, GenomeFA, OutputFile, Logger):
+def GetRestrictionSiteLocations(Enzyme, GenomeAssembly, GenomeFA, OutputFile, Logger, Threads = 1):
 	
 	# Logging
 	for line in [f"Genome assembly: {GenomeAssembly}", f"Genome FASTA path: {GenomeFA}", f"Enzyme: {Enzyme}", f"Output file: {OutputFile}"]: Logger.info(line)
 	
 	# Processing
-	with tempfile.TemporaryDirectory() as TempDir:
-		SimpleSubprocess(
-			Name = "GetRestrictionSiteLocations",
-			Command = f"cd {TempDir}; python3 \"{GENERATE_SITE_POSITIONS_PATH}\" {Enzyme} {GenomeAssembly} \"{GenomeFA}\"",
-			Logger = Logger)
-		SimpleSubprocess(
-			Name = "CopyFiles",
-			Command = f" cp {os.path.join(TempDir, '*')} \"{OutputFile}\"",
-			Logger = Logger)
+	GenerateRestrictionSites(GenomeFA, Enzyme, OutputFile, Logger, Threads = Threads)
+
+
+def ToolVersion(Tool):
+	
+	# Signature of tool executable for stage cache keys
+	Path = Tool if os.path.isfile(Tool) else shutil.which(Tool)
+	return FileSignature(Path) if Path is not None else "missing"
 
 
 # PIPELINE STAGES
 
-def Sra2FastQ(Accession, TopDir, Logger):
+def _ReleaseFifo(Path):
+	
+	# Unblocks a reader of a named pipe that the writer never opened
+	try:
+		os.close(os.open(Path, os.O_WRONLY | os.O_NONBLOCK))
+	except OSError:
+		pass
+
+
+def Sra2FastQ(Accession, TopDir, Logger, Threads = 1):
 	
 	# Logging
-	for line in [f"Accession: {Accession}", f"Directory: {TopDir}"]: Logger.info(line)
+	for line in [f"Accession: {Accession}", f"Directory: {TopDir}", f"Threads: {str(Threads)}"]: Logger.info(line)
 	
 	# Processing
-	with tempfile.TemporaryDirectory() as TempDir:
-		SimpleSubprocess(
-			Name = "Sra2FastQ",
-			Command = f"fastq-dump --split-3 -O {TempDir} \"{Accession}\"",
-			Logger = Logger)
-		SimpleSubprocess(
-			Name = "GZipFastQ",
-			Command = f"gzip {os.path.join(TempDir, '*')}",
-			Logger = Logger)
-		FastQDir = os.path.join(TopDir, "fastq")
-		FastQFiles = glob.glob(os.path.join(TempDir, '*'))
-		RenameCommand = '; '.join(["mv " + item + " " + re.sub(r'_([12])\.fastq\.gz$', r'_R\1.fastq.gz', item) for item in FastQFiles if re.match(r".*_([12])\.fastq\.gz$", item) is not None])
-		SimpleSubprocess(
-			Name = "CopyFiles",
-			Command = f"mkdir -p \"{FastQDir}\"; {RenameCommand}; cp {os.path.join(TempDir, '*_R*.fastq*')} \"{FastQDir}\"",
-			Logger = Logger)
+	# fastq-dump writes into named pipes, mates are compressed on the fly by bgzip straight into fastq/
+	FastQDir = os.path.join(TopDir, "fastq")
+	os.makedirs(FastQDir, exist_ok=True)
+	Base = re.sub(r'\.sra$', '', os.path.basename(Accession))
+	with SRA_DISK_SLOTS, tempfile.TemporaryDirectory(dir=FastQDir, prefix=".Sra2FastQ.") as TempDir, StageOutput(os.path.join(FastQDir, f"{Base}_R1.fastq.gz"), Logger) as R1File, StageOutput(os.path.join(FastQDir, f"{Base}_R2.fastq.gz"), Logger) as R2File:
+		Pipes = {Suffix: os.path.join(TempDir, f"{Base}{Suffix}.fastq") for Suffix in ["_1", "_2", ""]}
+		for Pipe in Pipes.values(): os.mkfifo(Pipe)
+		Compressors = [subprocess.Popen(Command, shell=True, executable="/bin/bash") for Command in [
+			f"bgzip -@ {str(max(1, Threads // 2))} -c < \"{Pipes['_1']}\" > \"{R1File}\"",
+			f"bgzip -@ {str(max(1, Threads // 2))} -c < \"{Pipes['_2']}\" > \"{R2File}\"",
+			f"cat \"{Pipes['']}\" > /dev/null"]]
+		try:
+			StreamingSubprocess(
+				Name = "Sra2FastQ",
+				Command = f"fastq-dump --split-3 -O \"{TempDir}\" \"{Accession}\"",
+				Logger = Logger)
+		finally:
+			for Pipe in Pipes.values(): _ReleaseFifo(Pipe)
+			ReturnCodes = [Compressor.wait() for Compressor in Compressors]
+		if any(ReturnCodes):
+			ErrorMessage = f"Compression of '{Accession}' failed, return codes: {ReturnCodes}"
+			Logger.error(ErrorMessage)
+			raise RuntimeError(ErrorMessage)
+		# Single-end runs go to the unpaired pipe only, empty mate files must not be published
+		Empty = [os.path.basename(FileName) for FileName in [R1File, R2File] if not gzip.open(FileName, 'rb').read(1)]
+		if Empty:
+			ErrorMessage = f"No paired reads in '{Accession}' (single-end run?), empty: {', '.join(Empty)}"
+			Logger.error(ErrorMessage)
+			raise RuntimeError(ErrorMessage)
 
 
 def Juicer(TopDir, Enzyme, RestrictionSiteLocations, GenomeAssembly, GenomeFA, GenomeChromSizes, Threads, Logger):
@@ -60,28 +115,114 @@ def Juicer(TopDir, Enzyme, RestrictionSiteLocations, GenomeAssembly, GenomeFA, G
 	
 	# Processing
 	JuicerScriptPath = os.path.join(JUICER_PATH, "scripts/juicer.sh")
-	FullLogText = SimpleSubprocess(
+	StreamingSubprocess(
 		Name = "Juicer",
 		Command = f"bash \"{JuicerScriptPath}\" -t {Threads} -D \"{JUICER_PATH}\" -g {GenomeAssembly} -z \"{GenomeFA}\" -p \"{GenomeChromSizes}\" -s {Enzyme} -y \"{RestrictionSiteLocations}\" -d \"{TopDir}\"",
 		Logger = Logger)
-	Logger.info(FullLogText.decode('utf-8'))
 
 
-def MakeInterPairs(InputFile, OutputFile, Logger):
+def _MergedNoDupsKey(Line):
+	
+	# chr1, chr2, frag1 - merged_nodups is sorted by them before pos1
+	Fields = Line.split(maxsplit=6)
+	return (Fields[1], Fields[5], Fields[3])
+
+
+def _GroupAlignedBlocks(Blocks):
+	
+	# Moves trailing records of the same (chr1, chr2, frag1) group to the next block, so that blocks can be sorted independently
+	Carry = b''
+	for Block in Blocks:
+		Block = Carry + Block
+		Cut = len(Block)
+		Key = None
+		while Cut > 0:
+			Start = Block.rfind(b'\n', 0, Cut - 1) + 1
+			LineKey = _MergedNoDupsKey(Block[Start:Cut])
+			if Key is not None and LineKey != Key: break
+			Key = LineKey
+			Cut = Start
+		Carry = Block[Cut:]
+		if Cut: yield Block[:Cut]
+	if Carry: yield Carry
+
+
+def MergedNoDups2Pairs(Block, Sort = False):
+	
+	# merged_nodups: str1 chr1 pos1 frag1 str2 chr2 pos2 frag2 [mapq1 cigar1 seq1 mapq2 cigar2 seq2 name1 name2]
+	# pairs: readID chr1 pos1 chr2 pos2 strand1 strand2
+	Records = []
+	for Line in Block.split(b'\n'):
+		Fields = Line.split()
+		if not Fields: continue
+		Records.append((
+			(Fields[1], Fields[5], Fields[3], int(Fields[2])) if Sort else None,
+			b'\t'.join([Fields[14] if len(Fields) > 14 else b'.', Fields[1], Fields[2], Fields[5], Fields[6], b'+' if Fields[0] == b'0' else b'-', b'+' if Fields[4] == b'0' else b'-'])))
+	if Sort:
+		# Keep file order of chromosome pairs and fragments, sort positions inside a fragment
+		Order, Groups, Previous = [], -1, None
+		for Key, _ in Records:
+			if Key[:3] != Previous: Groups, Previous = Groups + 1, Key[:3]
+			Order.append((Groups, Key[3]))
+		Records = [Record for _, Record in sorted(zip(Order, Records), key=lambda x: x[0])]
+	return b''.join([Line + b'\n' for _, Line in Records])
+
+
+def StorePairs(Range, StoreFile, Sort = False):
+	
+	# Same as MergedNoDups2Pairs for a row range of the contact store; ranges never split a (chr1, chr2, frag1) group
+	Store = LoadContactStore(StoreFile)
+	Columns = ContactColumns(Store, ["Chrom1", "Pos1", "Chrom2", "Pos2", "Strand1", "Strand2", "Frag1"] + (["Name1"] if "Name1" in Store["Strings"] else []), [Range])
+	Order = numpy.arange(Range[1] - Range[0])
+	if Sort:
+		# Group starts wherever chr1, chr2 or frag1 changes: adjacent chromosome pair blocks may share a frag1 value
+		Changes = functools.reduce(numpy.logical_or, [Columns[Name][1:] != Columns[Name][:-1] for Name in ["Chrom1", "Chrom2", "Frag1"]])
+		Groups = numpy.concatenate([[0], numpy.cumsum(Changes)])
+		Order = numpy.lexsort((Columns["Pos1"], Groups))
+	Chroms = [Chrom.encode('utf-8') for Chrom in Store["Chroms"]]
+	Names = Columns.get("Name1", [b'.'] * len(Order))
+	Lists = {Name: numpy.asarray(Columns[Name])[Order].tolist() for Name in ["Chrom1", "Pos1", "Chrom2", "Pos2", "Strand1", "Strand2"]}
+	return b''.join([b'\t'.join([Names[Row], Chroms[Chrom1], str(Pos1).encode(), Chroms[Chrom2], str(Pos2).encode(), b'+' if Strand1 == 0 else b'-', b'+' if Strand2 == 0 else b'-']) + b'\n' for Row, Chrom1, Pos1, Chrom2, Pos2, Strand1, Strand2 in zip(Order.tolist(), Lists["Chrom1"], Lists["Pos1"], Lists["Chrom2"], Lists["Pos2"], Lists["Strand1"], Lists["Strand2"])])
+
+
+def MakeInterPairs(InputFile, OutputFile, Logger, ChromSizes = None, Threads = 1, Compress = False, Index = False, BlockSize = 64 * 1024 * 1024, ChunkRows = 1000000):
 	
 	# Logging
-	for line in [f"Input file: {InputFile}", f"Output file: {OutputFile}"]: Logger.info(line)
+	for line in [f"Input file: {InputFile}", f"Output file: {OutputFile}", f"Chrom sizes file path: {ChromSizes}", f"Threads: {str(Threads)}", f"Compress: {Compress}", f"Index: {Index}"]: Logger.info(line)
+	
+	# Header
+	Header = ["## pairs format v1.0"]
+	if Index: Header.append("#sorted: chr1-chr2-pos1")
+	if ChromSizes is not None: Header += [f"#chromsize: {Chrom} {Size}" for Chrom, Size in pandas.read_csv(ChromSizes, sep='\t', header=None, usecols=[0, 1]).itertuples(index=False)]
+	Header.append("#columns: readID chr1 pos1 chr2 pos2 strand1 strand2")
 	
 	# Processing
-	with tempfile.TemporaryDirectory() as TempDir:
-		TempFile = os.path.join(TempDir, "inter.pairs.txt")
-		SimpleSubprocess(
-			Name = "MakeInterPairs",
-			Command = "awk -F \" \" '{print $2 \"\\t\" $3 \"\\t\" $6 \"\\t\" $7}' \"" + InputFile +"\" > \"" + TempFile + "\"",
-			Logger = Logger)
+	# InputFile is merged_nodups or its contact store (see WriteContactStore)
+	StartTime = time.time()
+	if IsContactStore(InputFile):
+		Worker, Blocks, Kwargs = StorePairs, ContactRanges(LoadContactStore(InputFile), ChunkRows), {"StoreFile": InputFile, "Sort": Index}
+	else:
+		Worker, Blocks, Kwargs = MergedNoDups2Pairs, ReadBlocks(InputFile, Logger, BlockSize = BlockSize), {"Sort": Index}
+		if Index: Blocks = _GroupAlignedBlocks(Blocks)
+	with StageOutput(OutputFile, Logger) as TempFile, open(TempFile, 'wb') as File:
+		Compressor = subprocess.Popen(["bgzip", "-@", str(Threads), "-c"], stdin=subprocess.PIPE, stdout=File) if (Compress or Index) else None
+		try:
+			with (Compressor.stdin if Compressor is not None else File) as Output:
+				Output.write(('\n'.join(Header) + '\n').encode('utf-8'))
+				with WorkerPool("MakeInterPairs", Logger, Threads) as Workers:
+					for Text in Workers.Map(Worker, Blocks, **Kwargs): Output.write(Text)
+		finally:
+			# bgzip gets EOF when its stdin is closed, also on errors
+			ReturnCode = Compressor.wait() if Compressor is not None else 0
+		if ReturnCode != 0:
+			ErrorMessage = f"bgzip has returned non-zero exit code [{str(ReturnCode)}]"
+			Logger.error(ErrorMessage)
+			raise OSError(ErrorMessage)
+	Logger.info(f"MakeInterPairs - %s" % (SecToTime(time.time() - StartTime)))
+	if Index:
 		SimpleSubprocess(
-			Name = "CopyFiles",
-			Command = f"cp \"{TempFile}\" \"{OutputFile}\"",
+			Name = "IndexPairs",
+			Command = f"pairix -f \"{OutputFile}\"",
 			Logger = Logger)
 
 
@@ -91,15 +232,206 @@ def Pairs2Cool(PairsFile, CoolFile, GenomeAssembly, GenomeChromSizes, Resolution
 	for line in [f"Input file: {PairsFile}", f"Output file: {CoolFile}", f"Genome assembly: {GenomeAssembly}", f"Chrom sizes file path: {GenomeChromSizes}", f"Resolution [bp]: {Resolution}"]: Logger.info(line)
 	
 	# Processing
-	with tempfile.TemporaryDirectory() as TempDir:
-		TempFile = os.path.join(TempDir, "inter_no_balanced.cool")
+	with StageOutput(CoolFile, Logger) as TempFile:
 		SimpleSubprocess(
 			Name = "MakeCool",
-			Command = f"cooler cload pairs -c1 1 -p1 2 -c2 3 -p2 4 --assembly {GenomeAssembly} \"{GenomeChromSizes}\":{str(Resolution)} \"{PairsFile}\" \"{TempFile}\"",
+			Command = f"cooler cload pairs -c1 2 -p1 3 -c2 4 -p2 5 --assembly {GenomeAssembly} \"{GenomeChromSizes}\":{str(Resolution)} \"{PairsFile}\" \"{TempFile}\"",
 			Logger = Logger)
-		SimpleSubprocess(
-			Name = "CopyFiles",
-			Command = f"cp \"{TempFile}\" \"{CoolFile}\"",
+
+
+def BinMergedNoDups(Block, ChromNames, ChromSizes, Resolutions):
+	
+	# Parse positions of one block of merged_nodups records and bin them on every resolution
+	Table = pandas.read_csv(io.BytesIO(Block), sep=' ', header=None, usecols=[1, 2, 5, 6], dtype={1: str, 2: numpy.int64, 5: str, 6: numpy.int64})
+	Chrom1 = pandas.Categorical(Table[1], categories=ChromNames).codes.astype(numpy.int64)
+	Chrom2 = pandas.Categorical(Table[5], categories=ChromNames).codes.astype(numpy.int64)
+	return BinContacts(Chrom1, Table[2].values, Chrom2, Table[6].values, ChromSizes, Resolutions)
+
+
+def BinStoreRange(Range, StoreFile, ChromNames, ChromSizes, Resolutions):
+	
+	# Same as BinMergedNoDups for a row range of the contact store, only chromosome and position columns are read
+	Store = LoadContactStore(StoreFile)
+	Recode = numpy.array([ChromNames.index(Chrom) if Chrom in ChromNames else -1 for Chrom in Store["Chroms"]] or [-1], dtype=numpy.int64)
+	Columns = ContactColumns(Store, ["Chrom1", "Pos1", "Chrom2", "Pos2"], [Range])
+	return BinContacts(Recode[Columns["Chrom1"]], Columns["Pos1"].astype(numpy.int64), Recode[Columns["Chrom2"]], Columns["Pos2"].astype(numpy.int64), ChromSizes, Resolutions)
+
+
+def BinContacts(Chrom1, Pos1, Chrom2, Pos2, ChromSizes, Resolutions):
+	
+	# Chromosome codes index ChromSizes (-1 for unknown)
+	Records = len(Chrom1)
+	Pos1 = Pos1 - 1 # one-based, like cooler cload pairs
+	Pos2 = Pos2 - 1
+	Valid = (Chrom1 >= 0) & (Chrom2 >= 0) & (Pos1 >= 0) & (Pos2 >= 0)
+	Valid[Valid] &= (Pos1[Valid] < ChromSizes[Chrom1[Valid]]) & (Pos2[Valid] < ChromSizes[Chrom2[Valid]])
+	Chrom1, Chrom2, Pos1, Pos2 = Chrom1[Valid], Chrom2[Valid], Pos1[Valid], Pos2[Valid]
+	Result = {"Records": Records, "Dropped": int((~Valid).sum()), "Pixels": {}}
+	for Resolution in Resolutions:
+		Offsets = numpy.concatenate([[0], numpy.cumsum(-(-ChromSizes // Resolution))])
+		Bin1 = Offsets[Chrom1] + Pos1 // Resolution
+		Bin2 = Offsets[Chrom2] + Pos2 // Resolution
+		Keys, Counts = numpy.unique(numpy.minimum(Bin1, Bin2) * Offsets[-1] + numpy.maximum(Bin1, Bin2), return_counts=True)
+		Result["Pixels"][Resolution] = (Keys, Counts)
+	return Result
+
+
+def _ReducePixels(Keys, Counts):
+	
+	# Sum counts of equal pixel keys
+	Order = numpy.argsort(Keys, kind='stable')
+	Keys, Counts = Keys[Order], Counts[Order]
+	Starts = numpy.flatnonzero(numpy.concatenate([[True], Keys[1:] != Keys[:-1]])) if len(Keys) else numpy.array([], dtype=int)
+	return (Keys[Starts], numpy.add.reduceat(Counts, Starts) if len(Keys) else Counts)
+
+
+def MergedNoDups2Cool(InputFile, CoolFile, GenomeAssembly, GenomeChromSizes, Resolutions, Logger, Threads = 1, BlockSize = 64 * 1024 * 1024, CompactSize = 50000000, ChunkRows = 10000000):
+	
+	# Logging
+	for line in [f"Input file: {InputFile}", f"Output file: {CoolFile}", f"Genome assembly: {GenomeAssembly}", f"Chrom sizes file path: {GenomeChromSizes}", f"Resolutions [bp]: {', '.join([str(item) for item in Resolutions])}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	
+	# Bins
+	StartTime = time.time()
+	ChromSizes = cooler.util.read_chromsizes(GenomeChromSizes, all_names=True)
+	Bins = {Resolution: cooler.binnify(ChromSizes, Resolution) for Resolution in Resolutions}
+	Offsets = {Resolution: numpy.concatenate([[0], numpy.cumsum(-(-ChromSizes.values // Resolution))]) for Resolution in Resolutions}
+	
+	# Per-chromosome pixel accumulators: Accumulators[Resolution][Chrom1] = [(Keys, Counts), ...]
+	Accumulators = {Resolution: [[] for _ in ChromSizes.index] for Resolution in Resolutions}
+	Sizes = {Resolution: [0 for _ in ChromSizes.index] for Resolution in Resolutions}
+	Records, Dropped = 0, 0
+	# InputFile is merged_nodups or its contact store (see WriteContactStore)
+	if IsContactStore(InputFile): Worker, Chunks = functools.partial(BinStoreRange, StoreFile = InputFile, ChromNames = list(ChromSizes.index), ChromSizes = ChromSizes.values.astype(numpy.int64), Resolutions = Resolutions), ContactRanges(LoadContactStore(InputFile), ChunkRows)
+	else: Worker, Chunks = functools.partial(BinMergedNoDups, ChromNames = list(ChromSizes.index), ChromSizes = ChromSizes.values.astype(numpy.int64), Resolutions = Resolutions), ReadBlocks(InputFile, Logger, BlockSize = BlockSize)
+	with WorkerPool("BinMergedNoDups", Logger, Threads) as Workers:
+		for Result in Workers.Map(Worker, Chunks):
+			Records, Dropped = Records + Result["Records"], Dropped + Result["Dropped"]
+			for Resolution, (Keys, Counts) in Result["Pixels"].items():
+				Bounds = numpy.searchsorted(Keys, Offsets[Resolution] * Offsets[Resolution][-1])
+				for Index in numpy.flatnonzero(Bounds[1:] > Bounds[:-1]):
+					Accumulators[Resolution][Index].append((Keys[Bounds[Index]:Bounds[Index + 1]], Counts[Bounds[Index]:Bounds[Index + 1]]))
+					Sizes[Resolution][Index] += Bounds[Index + 1] - Bounds[Index]
+					if Sizes[Resolution][Index] > CompactSize:
+						Accumulators[Resolution][Index] = [_ReducePixels(*[numpy.concatenate(item) for item in zip(*Accumulators[Resolution][Index])])]
+						Sizes[Resolution][Index] = len(Accumulators[Resolution][Index][0][0])
+	Logger.info(f"Records: {Records:,}, dropped (unknown chromosome or out of bounds): {Dropped:,}")
+	
+	# Writing
+	def Pixels(Resolution):
+		for Index, Chunks in enumerate(Accumulators[Resolution]):
+			if not Chunks: continue
+			Keys, Counts = _ReducePixels(*[numpy.concatenate(item) for item in zip(*Chunks)])
+			Accumulators[Resolution][Index] = []
+			yield pandas.DataFrame({"bin1_id": Keys // Offsets[Resolution][-1], "bin2_id": Keys % Offsets[Resolution][-1], "count": Counts})
+	
+	with StageOutput(CoolFile, Logger) as TempFile:
+		for Number, Resolution in enumerate(Resolutions):
+			URI = TempFile if len(Resolutions) == 1 else f"{TempFile}::resolutions/{str(Resolution)}"
+			cooler.create_cooler(URI, Bins[Resolution], Pixels(Resolution), assembly=GenomeAssembly, ordered=True, mode='w' if Number == 0 else 'a')
+		if len(Resolutions) > 1:
+			# mcool root attributes, as cooler zoomify writes them
+			with h5py.File(TempFile, 'r+') as File: File.attrs.update({"format": "HDF5::MCOOL", "format-version": 2})
+	Logger.info(f"MergedNoDups2Cool - %s" % (SecToTime(time.time() - StartTime)))
+
+
+def MergePixelWindow(Window, InputFiles, NBins, Signs):
+	
+	# Pixels of one bin1 window from every cooler: each slice is a sorted run, stable sort merges the runs and equal pixels are summed
+	Keys, Counts = [], []
+	for InputFile, (Start, End), Sign in zip(InputFiles, Window, Signs):
+		with cooler.Cooler(InputFile).open('r') as Group:
+			Keys.append(Group["pixels/bin1_id"][Start:End].astype(numpy.int64) * NBins + Group["pixels/bin2_id"][Start:End])
+			Counts.append(Group["pixels/count"][Start:End] * Sign)
+	Keys, Counts = _ReducePixels(numpy.concatenate(Keys), numpy.concatenate(Counts))
+	if numpy.any(Counts < 0): raise ValueError(f"Negative pixel counts after merge, subtracted contacts are missing from the coolers")
+	Keys, Counts = Keys[Counts != 0], Counts[Counts != 0]
+	return pandas.DataFrame({"bin1_id": Keys // NBins, "bin2_id": Keys % NBins, "count": Counts})
+
+
+def MergeCoolers(InputFiles, OutputFile, Logger, Threads = 1, ChunkPixels = 20000000, Signs = None):
+	
+	# Signs: +1/-1 per input, -1 subtracts the pixels of a cooler (delta updates); zero pixels are dropped
+	Signs = [1] * len(InputFiles) if Signs is None else list(Signs)
+	
+	# Logging
+	for line in [f"Input files: {', '.join([('- ' if Sign < 0 else '') + InputFile for InputFile, Sign in zip(InputFiles, Signs)])}", f"Output file: {OutputFile}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	
+	# Coolers must share bins
+	StartTime = time.time()
+	Coolers = [cooler.Cooler(InputFile) for InputFile in InputFiles]
+	for InputFile, Cool in zip(InputFiles, Coolers):
+		if Cool.binsize != Coolers[0].binsize or not Cool.chromsizes.equals(Coolers[0].chromsizes):
+			ErrorMessage = f"'{InputFile}' has other bins than '{InputFiles[0]}'"
+			Logger.error(ErrorMessage)
+			raise ValueError(ErrorMessage)
+	NBins = Coolers[0].info["nbins"]
+	
+	# Windows: bin1 ranges inside one chromosome with about ChunkPixels input pixels
+	Offsets = []
+	for Cool in Coolers:
+		with Cool.open('r') as Group: Offsets.append(Group["indexes/bin1_offset"][:].astype(numpy.int64))
+	Total = numpy.sum(Offsets, axis=0)
+	with Coolers[0].open('r') as Group: ChromOffsets = Group["indexes/chrom_offset"][:]
+	Cuts = numpy.unique(numpy.concatenate([ChromOffsets, numpy.searchsorted(Total, numpy.arange(ChunkPixels, Total[-1], ChunkPixels)), [NBins]]))
+	Windows = [[(int(Offset[Start]), int(Offset[End])) for Offset in Offsets] for Start, End in zip(Cuts[:-1], Cuts[1:]) if Total[End] > Total[Start]]
+	Logger.info(f"Input pixels: {int(Total[-1]):,}, windows: {len(Windows):,}")
+	
+	# Processing
+	Summary = {"Pixels": 0, "Contacts": 0}
+	with StageOutput(OutputFile, Logger) as TempFile, WorkerPool("MergeCoolers", Logger, Threads) as Workers:
+		def Pixels():
+			for Frame in Workers.Map(MergePixelWindow, Windows, InputFiles = [Cool.uri for Cool in Coolers], NBins = NBins, Signs = Signs):
+				Summary["Pixels"] += len(Frame)
+				Summary["Contacts"] += Frame["count"].sum()
+				yield Frame
+		CountType = numpy.result_type(*[Cool.pixels().dtypes["count"] for Cool in Coolers], *([numpy.int32] if min(Signs) < 0 else []))
+		cooler.create_cooler(TempFile, Coolers[0].bins()[["chrom", "start", "end"]][:], Pixels(), assembly=Coolers[0].info.get("genome-assembly"), ordered=True, dtypes={"count": CountType})
+	Logger.info(f"MergeCoolers: {len(InputFiles)} coolers, {Summary['Pixels']:,} pixels, {Summary['Contacts']:,} contacts - %s" % (SecToTime(time.time() - StartTime)))
+
+
+def MergeNewContacts(ExistingFile, NewFile, OutputFile, AddedFile, RemovedFile, ExistingStatsFile, NewStatsFile, StatsFile, Enzyme, RestrictionSiteLocations, Threads, Logger):
+	
+	# Logging
+	for line in [f"Existing contacts: {ExistingFile}", f"New contacts: {NewFile}", f"Output file: {OutputFile}", f"Delta files: {AddedFile}, {RemovedFile}", f"Enzyme: {Enzyme}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	
+	# Processing: merge-dedup against the existing library, statistics are collected in the same pass
+	Statistics = {"SiteFile": None if Enzyme == "none" else RestrictionSiteLocations, "Ligation": LIGATION_JUNCTIONS.get(Enzyme, "XXXX"), "Thresholds": [1]}
+	Counts = AppendContacts(ExistingFile, [NewFile], OutputFile, AddedFile, RemovedFile, Logger, Threads = Threads, Statistics = Statistics)
+	Logger.info(f"Appended: {Counts['Added']:,} contacts added, {Counts['Removed']:,} replaced")
+	
+	# Library counts: both libraries plus duplicates found between them
+	Existing, New = [LibraryCounts(open(FileName, 'rt').read()) for FileName in [ExistingStatsFile, NewStatsFile]]
+	Library = {"NoDups": Counts["NoDups"], "Dups": Existing["Dups"] + New["Dups"] + Counts["Dups"], "OptDups": Existing["OptDups"] + New["OptDups"] + Counts["OptDups"]}
+	with StageOutput(StatsFile, Logger) as TempFile:
+		with open(TempFile, 'wt') as File: File.write(f"Sequenced Read Pairs:  {Existing['Sequenced'] + New['Sequenced']:,}\n")
+	WriteLibraryStatistics(Counts["Statistics"], Library, {1: StatsFile}, Logger)
+
+
+def ApplyContactDelta(CoolFile, AddedFile, RemovedFile, OutputFile, GenomeAssembly, GenomeChromSizes, Resolution, Threads, Logger):
+	
+	# Logging
+	for line in [f"Input file: {CoolFile}", f"Added contacts: {AddedFile}", f"Removed contacts: {RemovedFile}", f"Output file: {OutputFile}", f"Resolution [bp]: {Resolution}", f"Threads: {str(Threads)}"]: Logger.info(line)
+	
+	# Processing: only the delta is binned, then merged with the existing pixels
+	with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(OutputFile)), prefix=".ApplyContactDelta.") as TempDir:
+		Deltas = [os.path.join(TempDir, f"{Name}.cool") for Name in ["added", "removed"]]
+		for ContactFile, DeltaFile in zip([AddedFile, RemovedFile], Deltas): MergedNoDups2Cool(ContactFile, DeltaFile, GenomeAssembly, GenomeChromSizes, [Resolution], Logger, Threads = Threads)
+		MergeCoolers([CoolFile] + Deltas, OutputFile, Logger, Threads = Threads, Signs = [1, 1, -1])
+
+
+def MergedNoDups2HiC(InputFile, OutputFile, StatsFile, RestrictionSiteLocations, GenomeChromSizes, Logger):
+	
+	# Logging
+	for line in [f"Input file: {InputFile}", f"Output file: {OutputFile}", f"Statistics: {StatsFile}", f"Restriction sites path: {RestrictionSiteLocations}", f"Chrom sizes file path: {GenomeChromSizes}"]: Logger.info(line)
+	
+	# Processing: same as `juicer_tools pre` call of juicer.sh
+	JuicerToolsPath = os.path.join(JUICER_PATH, "scripts/common/juicer_tools.jar")
+	Sites = [] if "none" in RestrictionSiteLocations else ["-f", RestrictionSiteLocations]
+	with StageOutput(OutputFile, Logger) as TempFile:
+		JuicerTools(
+			Args = ["pre"] + Sites + ["-s", StatsFile, "-g", f"{os.path.splitext(StatsFile)[0]}_hists.m", "-q", "1", InputFile, TempFile, GenomeChromSizes],
+			Name = "MergedNoDups2HiC",
+			JarPath = JuicerToolsPath,
 			Logger = Logger)
 
 
@@ -108,33 +440,46 @@ def CTaleNormalize(InputFile, OutputFile, Ranges, Logger):
 	# Logging
 	for line in [f"Input file: {InputFile}", f"Output file: {OutputFile}", f"Capture: {Ranges}"]: Logger.info(line)
 	
-	# Processing
-	with tempfile.TemporaryDirectory() as TempDir:
-		TempFile = os.path.join(TempDir, "inter.cool")
-		SimpleSubprocess(
-			Name = "TempFiles",
-			Command = f"cp \"{InputFile}\" \"{TempFile}\"",
-			Logger = Logger)
+	# Processing: ctale_normalize modifies the file in place, so it gets a private (reflink) copy
+	with StageOutput(OutputFile, Logger, Source = InputFile) as TempFile:
 		SimpleSubprocess(
 			Name = "NormalizeCool",
 			Command = f"ctale_normalize \"{TempFile}\" \"{Ranges}\"",
 			Logger = Logger)
-		SimpleSubprocess(
-			Name = "CopyFiles",
-			Command = f"cp \"{TempFile}\" \"{OutputFile}\"",
-			Logger = Logger)
 
 
-def AddWeight(InputFile, Chrom, Resolution, VectorFile, Logger):
+def WeightVectors(CoolFile, Chroms, Resolution = None):
+	
+	# Juicer addNorm vectors (1 / weight, 0 for masked bins) of the chromosomes, weight column is read once
+	Cool = cooler.Cooler(CoolFile)
+	if Resolution is not None and Cool.binsize != int(Resolution): raise ValueError(f"'{CoolFile}' has resolution {Cool.binsize}, not {Resolution}")
+	if "weight" not in Cool.bins().columns: raise ValueError(f"'{CoolFile}' has no weight column, balance it first")
+	Missing = [Chrom for Chrom in Chroms if Chrom not in Cool.chromnames]
+	if Missing: raise ValueError(f"'{CoolFile}' has no chromosomes: {', '.join(Missing)}")
+	Weights = Cool.bins()["weight"][:].to_numpy(dtype=numpy.float64)
+	if numpy.any(Weights < 0): raise ValueError(f"'{CoolFile}' has negative weights")
+	Vectors = numpy.zeros_like(Weights)
+	Mask = numpy.isfinite(Weights) & (Weights != 0)
+	numpy.divide(1.0, Weights, out=Vectors, where=Mask)
+	return {Chrom: (Cool.binsize, Vectors[slice(*Cool.extent(Chrom))], int(numpy.count_nonzero(~Mask[slice(*Cool.extent(Chrom))]))) for Chrom in Chroms}
+
+
+def AddWeight(InputFile, Chrom, Resolution, VectorFile, Logger, Normalization = "c-tale_normalization"):
+	
+	# InputFile and Chrom may be lists: vectors of all coolers (e.g. resolutions of an mcool) and chromosomes go to one addNorm file
+	InputFiles = [InputFile] if isinstance(InputFile, str) else list(InputFile)
+	Chroms = [Chrom] if isinstance(Chrom, str) else list(Chrom)
 	
 	# Logging
-	for line in [f"Input file: {InputFile}", f"Output file: {VectorFile}", f"Chromosome: {Chrom}", f"Resolution [bp]: {Resolution}"]: Logger.info(line)
+	for line in [f"Input files: {', '.join(InputFiles)}", f"Output file: {VectorFile}", f"Chromosomes: {', '.join(Chroms)}", f"Resolution [bp]: {Resolution if Resolution is not None else 'any'}"]: Logger.info(line)
 	
 	# Processing
 	try:
-		Table = cooler.Cooler(InputFile).bins().fetch(Chrom)
-		Weights = Table['weight'].apply(lambda x: 0 if (x == 0) else (1 / x)).fillna(0).rename(f"vector\tc-tale_normalization\t{Chrom}\t{str(Resolution)} BP")
-		Weights.to_csv(VectorFile, index=False)
+		with StageOutput(VectorFile, Logger) as TempFile, open(TempFile, 'wt') as Output:
+			for CoolFile in InputFiles:
+				for VectorChrom, (BinSize, Vector, Masked) in WeightVectors(CoolFile, Chroms, Resolution if len(InputFiles) == 1 else None).items():
+					Output.write(f"vector\t{Normalization}\t{VectorChrom}\t{str(BinSize)} BP\n" + ''.join([f"{repr(Value)}\n" for Value in Vector.tolist()]))
+					Logger.info(f"Vector {VectorChrom} at {str(BinSize)} bp: {len(Vector):,} bins, {Masked:,} masked")
 	except Exception as e:
 		ErrorMessage = f"Error: {e}"
 		Logger.error(ErrorMessage)
@@ -149,40 +494,58 @@ def Vector2HiC(InputFile, OutputFile, VectorFile, Threads, Logger):
 	
 	# Processing
 	JuicerToolsPath = os.path.join(JUICER_PATH, "scripts/common/juicer_tools.jar")
-	with tempfile.TemporaryDirectory() as TempDir:
-		TempFile = os.path.join(TempDir, "inter.hic")
-		SimpleSubprocess(
-			Name = "TempFiles",
-			Command = f"cp \"{InputFile}\" \"{TempFile}\"",
-			Logger = Logger)
-		SimpleSubprocess(
+	with StageOutput(OutputFile, Logger, Source = InputFile) as TempFile:
+		JuicerTools(
+			Args = ["addNorm", "-j", str(Threads), TempFile, VectorFile],
 			Name = "NormalizeHiC",
-			Command = f"java -jar \"{JuicerToolsPath}\" addNorm -j {str(Threads)} \"{TempFile}\" \"{VectorFile}\"",
-			Logger = Logger)
-		SimpleSubprocess(
-			Name = "CopyFiles",
-			Command = f"cp \"{TempFile}\" \"{OutputFile}\"",
+			JarPath = JuicerToolsPath,
 			Logger = Logger)
 
 
 # PIPELINE
 
-def BenchmarkPipeline(Name, TopDir, Accessions, Enzyme, RestrictionSiteLocations, GenomeAssembly, GenomeFA, GenomeChromSizes, Capture, Resolution, Threads):
+def BlockAccessions(TopDir):
+	
+	# Accessions of a finished block
+	ManifestFile = os.path.join(TopDir, "accessions.json")
+	return json.load(open(ManifestFile, 'rt')) if os.path.isfile(ManifestFile) else None
+
+
+def BenchmarkTasks(Name, TopDir, Accessions, Enzyme, RestrictionSiteLocations, GenomeAssembly, GenomeFA, GenomeChromSizes, Capture, Resolution, Threads, KeepPairs = False, CacheDir = None, CacheQuota = 500, Base = None):
+	
+	# Base: finished block (TopDir itself or another one) whose results are extended; only the missing accessions are aligned
+	# and merged into its contacts and matrix. Base files are only read, new results are published to TopDir
+	Append = Base is not None
+	Existing = BlockAccessions(Base) if Append else None
+	if Append and Existing is None: raise FileNotFoundError(f"'{Base}' is not a finished block, nothing to append to")
+	if Append and not set(Existing) <= set(Accessions): raise ValueError(f"'{Base}' has accessions which are not in '{Name}': {', '.join(sorted(set(Existing) - set(Accessions)))}")
+	NewAccessions = [Accession for Accession in Accessions if Accession not in (Existing or [])]
 	
 	# Make Dirs
-	os.mkdir(TopDir)
+	if CacheDir is None and not Append: os.mkdir(TopDir)
+	else: os.makedirs(TopDir, exist_ok=True)
 	TempDir = os.path.join(TopDir, "__temp__")
+	if os.path.isdir(TempDir): shutil.rmtree(TempDir)
 	os.mkdir(TempDir)
 	
 	# Logging
-	Logger = DefaultLogger(os.path.join(TopDir, "log.txt"))
-	Logger.info(f"--- START PROCESSING '{Name}' ---")
-	StartTime = time.time()
+	Logger = DefaultLogger(os.path.join(TopDir, "log.txt"), Name = Name)
+	if Append:
+		for line in [f"Append mode, base block: {Base}", f"Existing accessions: {', '.join(Existing)}", f"New accessions: {', '.join(NewAccessions) if NewAccessions else 'none'}"]: Logger.info(line)
+		if not NewAccessions:
+			if os.path.samefile(Base, TopDir): return {f"{Name}.Finish": {"Function": functools.partial(Logger.info, f"'{Name}' is up to date"), "Threads": (1, 1), "Memory": 0}}
+			# Same accessions under another name: results are hardlinked from the base block
+			def Link():
+				for FileName in BLOCK_RESULTS + ["accessions.json"]:
+					if os.path.isfile(os.path.join(Base, FileName)): LinkOrCopy(os.path.join(Base, FileName), os.path.join(TopDir, FileName))
+				Logger.info(f"'{Name}' is linked to '{Base}'")
+			return {f"{Name}.Finish": {"Function": Link, "Threads": (1, 1), "Memory": 0}}
 	
 	# Filenames
 	Filenames = {
 		"MergedNoDups": os.path.join(TempDir, "aligned/merged_nodups.txt"),
-		"InterPairs": os.path.join(TempDir, "aligned/inter.pairs.txt"),
+		"Contacts": os.path.join(TempDir, "aligned/merged_nodups.cols"),
+		"InterPairs": os.path.join(TempDir, "aligned/inter.pairs.gz"),
 		"InterNoBalanced": os.path.join(TempDir, "aligned/inter_no_balanced.cool"),
 		"InterCool": os.path.join(TempDir, "aligned/inter.cool"),
 		"Vector": os.path.join(TempDir, "aligned/vector.txt"),
@@ -190,89 +553,179 @@ def BenchmarkPipeline(Name, TopDir, Accessions, Enzyme, RestrictionSiteLocations
 		"InterHicNormalized": os.path.join(TempDir, "aligned/inter_norm.hic"),
 		"InterStat": os.path.join(TempDir, "aligned/inter.txt")
 		}
+	if Append:
+		# Juicer output is the new library only, the block results are rebuilt in appended/
+		Filenames.update({
+			"NewMergedNoDups": Filenames["MergedNoDups"],
+			"NewHic": Filenames["InterHic"],
+			"NewStat": Filenames["InterStat"],
+			"MergedNoDups": os.path.join(TempDir, "appended/merged_nodups.txt"),
+			"Added": os.path.join(TempDir, "appended/added.txt"),
+			"Removed": os.path.join(TempDir, "appended/removed.txt"),
+			"InterHic": os.path.join(TempDir, "appended/inter.hic"),
+			"InterStat": os.path.join(TempDir, "appended/inter.txt")
+			})
+		ExistingFiles = {Key: os.path.join(Base, FileName) for Key, FileName in [("MergedNoDups", "merged_nodups.txt"), ("InterNoBalanced", "inter_no_balanced.cool"), ("InterStat", "inter_statistics.txt")]}
 	
 	CopyFilenames = {
 		Filenames["InterCool"]: os.path.join(TopDir, "inter.cool"),
 		Filenames["InterHicNormalized"]: os.path.join(TopDir, "inter.hic"),
-		Filenames["InterPairs"]: os.path.join(TopDir, "inter.pairs.txt"),
 		Filenames["InterNoBalanced"]: os.path.join(TopDir, "inter_no_balanced.cool"),
 		Filenames["InterStat"]: os.path.join(TopDir, "inter_statistics.txt"),
 		Filenames["MergedNoDups"]: os.path.join(TopDir, "merged_nodups.txt"),
 		Filenames["Vector"]: os.path.join(TopDir, "vector.txt")
 		}
+	if KeepPairs: CopyFilenames[Filenames["InterPairs"]] = os.path.join(TopDir, "inter.pairs.gz")
 	
-	# Pipeline
-	for Accession in Accessions:
-		Sra2FastQ(
-			Accession = Accession,
-			TopDir = TempDir,
-			Logger = Logger)
+	Logger.info(f"--- START PROCESSING '{Name}' ---")
+	StartTime = time.time()
 	
-	Juicer(
-		TopDir = TempDir,
-		Enzyme = Enzyme,
-		RestrictionSiteLocations = RestrictionSiteLocations,
-		GenomeAssembly = GenomeAssembly,
-		GenomeFA = GenomeFA,
-		GenomeChromSizes = GenomeChromSizes,
-		Threads = Threads,
-		Logger = Logger)
+	def Finish():
+		# Results are on the same filesystem, so they are hardlinked instead of copied
+		for source, dest in CopyFilenames.items(): LinkOrCopy(source, dest)
+		with StageOutput(os.path.join(TopDir, "accessions.json"), Logger) as TempFile: SaveJSON(Accessions, TempFile)
+		Logger.info(f"'{Name}' FINISHED, SUMMARY TIME - %s" % (SecToTime(time.time() - StartTime)))
 	
-	MakeInterPairs(
-		InputFile = Filenames["MergedNoDups"],
-		OutputFile = Filenames["InterPairs"],
-		Logger = Logger)
+	# Stage cache: outputs are reused when input files and params are unchanged; each stage run (or cache restore) is a profiling span
+	def Cached(Function, Inputs, Outputs, Params = {}):
+		return functools.partial(Profiled(RunCached, Name = Function.__name__, Block = Name), Function, Name = Function.__name__, Inputs = Inputs, Outputs = Outputs, CacheDir = CacheDir, Params = Params, Quota = CacheQuota)
 	
-	Pairs2Cool(
-		PairsFile = Filenames["InterPairs"],
-		CoolFile = Filenames["InterNoBalanced"],
-		GenomeAssembly = GenomeAssembly,
-		GenomeChromSizes = GenomeChromSizes,
-		Resolution = Resolution,
-		Logger = Logger)
+	FastQFiles = [os.path.join(TempDir, "fastq", re.sub(r'\.sra$', '', os.path.basename(Accession)) + f"_R{str(Read)}.fastq.gz") for Accession in NewAccessions for Read in [1, 2]]
 	
-	CTaleNormalize(
-		InputFile = Filenames["InterNoBalanced"],
-		OutputFile = Filenames["InterCool"],
-		Ranges = f"{Capture[0]}:{Capture[1]:,}-{Capture[2]:,}",
-		Logger = Logger)
+	# Stages: Threads is (min, max), multithreaded stages get their share of cores from the scheduler instead of Kwargs["Threads"]
+	Tasks = {}
+	for Number, Accession in enumerate(NewAccessions):
+		Tasks[f"{Name}.Sra2FastQ.{str(Number)}"] = {
+			"Function": Cached(Sra2FastQ, [Accession], FastQFiles[Number * 2:Number * 2 + 2], {"FastqDump": ToolVersion("fastq-dump")}),
+			"Kwargs": {"Accession": Accession, "TopDir": TempDir, "Logger": Logger},
+			"Threads": (1, 4),
+			"Memory": STAGE_MEMORY["Sra2FastQ"]}
 	
-	AddWeight(
-		InputFile = Filenames["InterCool"],
-		Chrom = Capture[0],
-		Resolution = Resolution,
-		VectorFile = Filenames["Vector"],
-		Logger = Logger)
+	Tasks[f"{Name}.Juicer"] = {
+		"Function": Cached(Juicer, FastQFiles + [RestrictionSiteLocations, GenomeFA, GenomeChromSizes], [os.path.join(TempDir, "aligned", FileName) for FileName in ["merged_nodups.txt", "inter.hic", "inter.txt"]], {"Enzyme": Enzyme, "GenomeAssembly": GenomeAssembly, "Juicer": ToolVersion(os.path.join(JUICER_PATH, "scripts/juicer.sh"))}),
+		"Kwargs": {"TopDir": TempDir, "Enzyme": Enzyme, "RestrictionSiteLocations": RestrictionSiteLocations, "GenomeAssembly": GenomeAssembly, "GenomeFA": GenomeFA, "GenomeChromSizes": GenomeChromSizes, "Threads": Threads, "Logger": Logger},
+		"Depends": [item for item in Tasks.keys()],
+		"Threads": (min(4, Threads), Threads),
+		"Memory": STAGE_MEMORY["Juicer"]}
 	
-	Vector2HiC(
-		InputFile = Filenames["InterHic"],
-		OutputFile = Filenames["InterHicNormalized"],
-		VectorFile = Filenames["Vector"],
-		Threads = Threads,
-		Logger = Logger)
+	ContactsTask = f"{Name}.Juicer"
+	if Append:
+		Tasks[f"{Name}.MergeNewContacts"] = {
+			"Function": Cached(MergeNewContacts, [ExistingFiles["MergedNoDups"], Filenames["NewMergedNoDups"], ExistingFiles["InterStat"], Filenames["NewStat"], RestrictionSiteLocations], [Filenames["MergedNoDups"], Filenames["Added"], Filenames["Removed"], Filenames["InterStat"]], {"Enzyme": Enzyme}),
+			"Kwargs": {"ExistingFile": ExistingFiles["MergedNoDups"], "NewFile": Filenames["NewMergedNoDups"], "OutputFile": Filenames["MergedNoDups"], "AddedFile": Filenames["Added"], "RemovedFile": Filenames["Removed"], "ExistingStatsFile": ExistingFiles["InterStat"], "NewStatsFile": Filenames["NewStat"], "StatsFile": Filenames["InterStat"], "Enzyme": Enzyme, "RestrictionSiteLocations": RestrictionSiteLocations, "Threads": Threads, "Logger": Logger},
+			"Depends": [f"{Name}.Juicer"],
+			"Threads": (1, Threads),
+			"Memory": STAGE_MEMORY["MergeNewContacts"]}
+		ContactsTask = f"{Name}.MergeNewContacts"
+		
+		Tasks[f"{Name}.ApplyContactDelta"] = {
+			"Function": Cached(ApplyContactDelta, [ExistingFiles["InterNoBalanced"], Filenames["Added"], Filenames["Removed"], GenomeChromSizes], [Filenames["InterNoBalanced"]], {"GenomeAssembly": GenomeAssembly, "Resolution": Resolution}),
+			"Kwargs": {"CoolFile": ExistingFiles["InterNoBalanced"], "AddedFile": Filenames["Added"], "RemovedFile": Filenames["Removed"], "OutputFile": Filenames["InterNoBalanced"], "GenomeAssembly": GenomeAssembly, "GenomeChromSizes": GenomeChromSizes, "Resolution": Resolution, "Threads": Threads, "Logger": Logger},
+			"Depends": [ContactsTask],
+			"Threads": (1, Threads),
+			"Memory": STAGE_MEMORY["ApplyContactDelta"]}
+		
+		Tasks[f"{Name}.MergedNoDups2HiC"] = {
+			"Function": Cached(MergedNoDups2HiC, [Filenames["MergedNoDups"], Filenames["InterStat"], RestrictionSiteLocations, GenomeChromSizes], [Filenames["InterHic"]], {"JuicerTools": ToolVersion(os.path.join(JUICER_PATH, "scripts/common/juicer_tools.jar"))}),
+			"Kwargs": {"InputFile": Filenames["MergedNoDups"], "OutputFile": Filenames["InterHic"], "StatsFile": Filenames["InterStat"], "RestrictionSiteLocations": RestrictionSiteLocations, "GenomeChromSizes": GenomeChromSizes, "Logger": Logger},
+			"Depends": [ContactsTask],
+			"Threads": (1, 1),
+			"Memory": STAGE_MEMORY["MergedNoDups2HiC"]}
 	
-	for source, dest in CopyFilenames.items():
-		SimpleSubprocess(
-			Name = "CopyResult",
-			Command = f"cp \"{source}\" \"{dest}\"",
-			Logger = Logger)
+	# Contacts are parsed once into the columnar store, read IDs are kept only for pairs; appended blocks use it for pairs only
+	if KeepPairs or not Append:
+		Tasks[f"{Name}.WriteContactStore"] = {
+			"Function": Cached(WriteContactStore, [Filenames["MergedNoDups"]], [Filenames["Contacts"]], {"Strings": ["Name1"] if KeepPairs else []}),
+			"Kwargs": {"InputFile": Filenames["MergedNoDups"], "OutputFile": Filenames["Contacts"], "Strings": ["Name1"] if KeepPairs else [], "Threads": Threads, "Logger": Logger},
+			"Depends": [ContactsTask],
+			"Threads": (1, Threads),
+			"Memory": STAGE_MEMORY["WriteContactStore"]}
+	
+	if KeepPairs:
+		Tasks[f"{Name}.MakeInterPairs"] = {
+			"Function": Cached(MakeInterPairs, [Filenames["Contacts"], GenomeChromSizes], [Filenames["InterPairs"]], {"Compress": True}),
+			"Kwargs": {"InputFile": Filenames["Contacts"], "OutputFile": Filenames["InterPairs"], "ChromSizes": GenomeChromSizes, "Compress": True, "Threads": Threads, "Logger": Logger},
+			"Depends": [f"{Name}.WriteContactStore"],
+			"Threads": (1, Threads),
+			"Memory": STAGE_MEMORY["MakeInterPairs"]}
+	
+	if not Append:
+		Tasks[f"{Name}.MergedNoDups2Cool"] = {
+			"Function": Cached(MergedNoDups2Cool, [Filenames["Contacts"], GenomeChromSizes], [Filenames["InterNoBalanced"]], {"GenomeAssembly": GenomeAssembly, "Resolutions": [Resolution]}),
+			"Kwargs": {"InputFile": Filenames["Contacts"], "CoolFile": Filenames["InterNoBalanced"], "GenomeAssembly": GenomeAssembly, "GenomeChromSizes": GenomeChromSizes, "Resolutions": [Resolution], "Threads": Threads, "Logger": Logger},
+			"Depends": [f"{Name}.WriteContactStore"],
+			"Threads": (1, Threads),
+			"Memory": STAGE_MEMORY["MergedNoDups2Cool"]}
+	
+	Tasks[f"{Name}.CTaleNormalize"] = {
+		"Function": Cached(CTaleNormalize, [Filenames["InterNoBalanced"]], [Filenames["InterCool"]], {"Capture": Capture, "CTale": ToolVersion("ctale_normalize")}),
+		"Kwargs": {"InputFile": Filenames["InterNoBalanced"], "OutputFile": Filenames["InterCool"], "Ranges": f"{Capture[0]}:{Capture[1]:,}-{Capture[2]:,}", "Logger": Logger},
+		"Depends": [f"{Name}.ApplyContactDelta" if Append else f"{Name}.MergedNoDups2Cool"],
+		"Threads": (1, 1),
+		"Memory": STAGE_MEMORY["CTaleNormalize"]}
 	
-	Logger.info(f"'{Name}' FINISHED, SUMMARY TIME - %s" % (SecToTime(time.time() - StartTime)))
+	Tasks[f"{Name}.AddWeight"] = {
+		"Function": Cached(AddWeight, [Filenames["InterCool"]], [Filenames["Vector"]], {"Chrom": Capture[0], "Resolution": Resolution}),
+		"Kwargs": {"InputFile": Filenames["InterCool"], "Chrom": Capture[0], "Resolution": Resolution, "VectorFile": Filenames["Vector"], "Logger": Logger},
+		"Depends": [f"{Name}.CTaleNormalize"],
+		"Threads": (1, 1),
+		"Memory": STAGE_MEMORY["AddWeight"]}
+	
+	Tasks[f"{Name}.Vector2HiC"] = {
+		"Function": Cached(Vector2HiC, [Filenames["InterHic"], Filenames["Vector"]], [Filenames["InterHicNormalized"]], {"JuicerTools": ToolVersion(os.path.join(JUICER_PATH, "scripts/common/juicer_tools.jar"))}),
+		"Kwargs": {"InputFile": Filenames["InterHic"], "OutputFile": Filenames["InterHicNormalized"], "VectorFile": Filenames["Vector"], "Threads": Threads, "Logger": Logger},
+		"Depends": [f"{Name}.AddWeight"] + ([f"{Name}.MergedNoDups2HiC"] if Append else []),
+		"Threads": (1, Threads),
+		"Memory": STAGE_MEMORY["Vector2HiC"]}
+	
+	Tasks[f"{Name}.Finish"] = {
+		"Function": Profiled(Finish, Block = Name),
+		"Depends": [item for item in Tasks.keys()],
+		"Threads": (1, 1),
+		"Memory": 0}
+	
+	return Tasks
+
+
+def BenchmarkPipeline(Name, TopDir, Accessions, Enzyme, RestrictionSiteLocations, GenomeAssembly, GenomeFA, GenomeChromSizes, Capture, Resolution, Threads, KeepPairs = False, CacheDir = None, CacheQuota = 500, Base = None):
+	
+	Tasks = BenchmarkTasks(Name, TopDir, Accessions, Enzyme, RestrictionSiteLocations, GenomeAssembly, GenomeFA, GenomeChromSizes, Capture, Resolution, Threads, KeepPairs = KeepPairs, CacheDir = CacheDir, CacheQuota = CacheQuota, Base = Base)
+	RunDAG(Tasks, Logger = logging.getLogger(Name), Threads = Threads)
+
+
+def PoolTasks(Pool, TopDir, Blocks, Threads, CacheDir = None, CacheQuota = 500):
+	
+	# Pooled map of several blocks: pixel-level merge of their unbalanced coolers, no re-sort of contacts
+	os.makedirs(TopDir, exist_ok=True)
+	Logger = DefaultLogger(os.path.join(TopDir, "log.txt"), Name = Pool)
+	InputFiles = [os.path.join(BlockDir, "inter_no_balanced.cool") for BlockDir in Blocks.values()]
+	OutputFile = os.path.join(TopDir, "inter_no_balanced.cool")
+	return {f"{Pool}.MergeCoolers": {
+		"Function": Profiled(functools.partial(RunCached, MergeCoolers, Name = "MergeCoolers", Inputs = InputFiles, Outputs = [OutputFile], CacheDir = CacheDir, Quota = CacheQuota), Name = "MergeCoolers", Block = Pool),
+		"Kwargs": {"InputFiles": InputFiles, "OutputFile": OutputFile, "Threads": Threads, "Logger": Logger},
+		"Depends": [f"{Name}.Finish" for Name in Blocks.keys()],
+		"Threads": (1, Threads),
+		"Memory": STAGE_MEMORY["MergeCoolers"]}}
 
 # --------------------------
 
-Data = pandas.read_csv("/Data/NGS_Data/20210714_INC_COST_3DBenchmark/Project/Blocks.tsv", sep='\t', comment='#')
+ProjectDir = "/Data/NGS_Data/20210714_INC_COST_3DBenchmark/Project"
+Data = pandas.read_csv(os.path.join(ProjectDir, "Blocks.tsv"), sep='\t', comment='#')
+Threads = cpu_count()
+Tasks = {}
 for index, line in Data.iterrows():
 	Name = line["Accession"].replace(";", "-")
-	TopDir = f"/Data/NGS_Data/20210714_INC_COST_3DBenchmark/Project/{Name}"
+	TopDir = os.path.join(ProjectDir, Name)
 	Accessions = [f"/Data/NGS_Data/20210714_INC_COST_3DBenchmark/Source/{item}.sra" for item in line["Accession"].split(';')]
 	GenomeFA = f"/Data/DataBases/{line['Genome']}/{line['Genome']}_canonic.fa"
 	GenomeChromSizes = f"/Data/DataBases/{line['Genome']}/{line['Genome']}_canonic.chrom.sizes"
 	RestrictionSiteLocations = f"/Data/UserData/FairWind/Ya.Cloud/core/pipeline/data/restriction_sites/RestrictionSites_{line['Enzyme']}_{line['Genome']}.txt"
 	Capture = [line["Chrom"], line["Start"], line["End"]]
 	Resolution = 5000
-	Threads = 12
-	BenchmarkPipeline(
+	# Finished blocks are kept as is; optional AppendTo column names a finished block to extend with the new accessions
+	Base = TopDir if BlockAccessions(TopDir) is not None else None
+	if Base is None and "AppendTo" in Data.columns and not pandas.isna(line["AppendTo"]): Base = os.path.join(ProjectDir, line["AppendTo"].replace(";", "-"))
+	Tasks.update(BenchmarkTasks(
 		Name = Name,
 		TopDir = TopDir,
 		Accessions = Accessions,
@@ -283,4 +736,21 @@ for index, line in Data.iterrows():
 		GenomeChromSizes = GenomeChromSizes,
 		Capture = Capture,
 		Resolution = Resolution,
-		Threads = Threads)
+		Threads = Threads,
+		CacheDir = os.path.join(ProjectDir, "__cache__"),
+		Base = Base))
+
+# Optional Pool column: blocks with the same pool name are merged into Pools/{pool}
+if "Pool" in Data.columns:
+	for Pool, Group in Data.dropna(subset=["Pool"]).groupby("Pool"):
+		Blocks = {Accession.replace(";", "-"): os.path.join(ProjectDir, Accession.replace(";", "-")) for Accession in Group["Accession"]}
+		Tasks.update(PoolTasks(f"Pool.{Pool}", os.path.join(ProjectDir, "Pools", str(Pool)), Blocks, Threads, CacheDir = os.path.join(ProjectDir, "__cache__")))
+
+SchedulerLogger = DefaultLogger(os.path.join(ProjectDir, "scheduler_log.txt"), Name = "scheduler")
+Run = StartProfiling(os.path.join(ProjectDir, "profile", "profile.jsonl"))
+# Workers are forked here, while the process has no other threads
+StartProcessPool(Threads)
+try:
+	RunDAG(Tasks, Logger = SchedulerLogger, Threads = Threads)
+finally:
+	ProfileReport(PROFILE["File"], Logger = SchedulerLogger, ReportFile = os.path.join(ProjectDir, "profile", f"report_{Run}.txt"), Run = Run)
@@ -0,0 +1,81 @@
+/*
+ * Long-lived juicer_tools worker: runs juicer_tools commands in one warm JVM.
+ *
+ * Reads jobs from stdin, one per line: <job id>\t<arg 1>\t<arg 2>...
+ * Arguments are passed to the juicer_tools main class as on the command line.
+ * After each job prints "@@JUICER_WORKER_DONE\t<job id>\t<exit status>" to stdout.
+ * System.exit() calls of juicer_tools are trapped, so they end the job, not the JVM.
+ *
+ * Usage: java -cp <worker dir>:juicer_tools.jar JuicerWorker [main class]
+ */
+
+import java.io.BufferedReader;
+import java.io.InputStreamReader;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.security.Permission;
+import java.util.Arrays;
+
+public class JuicerWorker {
+
+  static final String DONE = "@@JUICER_WORKER_DONE";
+
+  static class ExitTrap extends SecurityException {
+    final int status;
+    ExitTrap(int status) {
+      super("System.exit(" + status + ")");
+      this.status = status;
+    }
+  }
+
+  public static void main(String[] args) throws Exception {
+    String mainClass = args.length > 0 ? args[0] : "juicebox.tools.HiCTools";
+    Method main = Class.forName(mainClass).getMethod("main", String[].class);
+    try {
+      System.setSecurityManager(new SecurityManager() {
+        @Override
+        public void checkPermission(Permission permission) { }
+        @Override
+        public void checkPermission(Permission permission, Object context) { }
+        @Override
+        public void checkExit(int status) {
+          throw new ExitTrap(status);
+        }
+      });
+    } catch (UnsupportedOperationException error) {
+      // Security manager is not available in this JVM, System.exit() cannot be trapped
+      System.err.println("JuicerWorker: security manager is not supported by this JVM");
+      System.out.println(DONE + "\tunsupported\t1");
+      System.out.flush();
+      Runtime.getRuntime().halt(3);
+    }
+    System.out.println(DONE + "\tready\t0");
+    System.out.flush();
+
+    BufferedReader reader = new BufferedReader(new InputStreamReader(System.in));
+    String line;
+    while ((line = reader.readLine()) != null) {
+      if (line.isEmpty()) continue;
+      String[] fields = line.split("\t", -1);
+      String[] jobArgs = Arrays.copyOfRange(fields, 1, fields.length);
+      int status = 0;
+      try {
+        main.invoke(null, (Object) jobArgs);
+      } catch (InvocationTargetException error) {
+        Throwable cause = error.getCause();
+        if (cause instanceof ExitTrap) {
+          status = ((ExitTrap) cause).status;
+        } else {
+          cause.printStackTrace();
+          status = 1;
+        }
+      } catch (ExitTrap error) {
+        status = error.status;
+      }
+      System.err.flush();
+      System.out.println(DONE + "\t" + fields[0] + "\t" + status);
+      System.out.flush();
+    }
+    Runtime.getRuntime().halt(0);
+  }
+}
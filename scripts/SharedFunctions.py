@@ -1,43 +1,54 @@
 from contextlib import contextmanager
 from copy import deepcopy as dc
 from glob import glob
-from multiprocessing import cpu_count, Pool
+from multiprocessing import cpu_count, Pool, resource_tracker, shared_memory
 from pandarallel import pandarallel
 from typing import Union
 import argparse
+import atexit
 import bz2
 import base64
+import collections
+import concurrent.futures
 import datetime
 import functools
 import glob
 import gzip
+import hashlib
 import io
+import itertools
 import json
 import logging
 import math
+import mmap
 import numpy
 import os
 import pandas
 import pysam
 import re
+import resource
+import shutil
 import subprocess
 import sys
 import tabix
 import tempfile
+import threading
 import time
+import traceback
 import warnings
 
 ## ------======| LOGGING |======------
 
 def DefaultLogger(
 		LogFileName: str,
-		Level: int = logging.DEBUG) -> logging.Logger:
+		Level: int = logging.DEBUG,
+		Name: str = "default_logger") -> logging.Logger:
 	
 	# Format
 	Formatter = "%(asctime)-30s%(levelname)-13s%(funcName)-25s%(message)s"
 	
 	# Compose logger
-	Logger = logging.getLogger("default_logger")
+	Logger = logging.getLogger(Name)
 	logging.basicConfig(level=Level, format=Formatter)
 	
 	# Add log file
@@ -50,6 +61,171 @@ def DefaultLogger(
 	# Return
 	return Logger
 
+## ------======| PROFILING |======------
+
+# Spans are written as JSON lines to PROFILE["File"] (see StartProfiling), nothing is written while it is None
+PROFILE = {"File": None, "Run": None, "Lock": threading.Lock(), "Counter": itertools.count()}
+PROFILE_STACK = threading.local()
+
+def StartProfiling(FileName: str, Run: Union[str, None] = None) -> str:
+	
+	# Set run-level span file
+	os.makedirs(os.path.dirname(os.path.abspath(FileName)), exist_ok=True)
+	PROFILE["File"] = FileName
+	PROFILE["Run"] = Run if Run is not None else datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+	return PROFILE["Run"]
+
+def ProcessIO() -> tuple:
+	
+	# Storage bytes read/written by the whole process (Linux only)
+	try:
+		with open("/proc/self/io", 'rt') as File: Counters = dict(line.split(': ') for line in File.read().splitlines())
+		return int(Counters["read_bytes"]), int(Counters["write_bytes"])
+	except (OSError, KeyError, ValueError):
+		return 0, 0
+
+def CurrentSpan() -> Union[dict, None]:
+	Stack = getattr(PROFILE_STACK, "Spans", None)
+	return Stack[-1] if Stack else None
+
+def ProfileCount(Key: str, Value: int) -> None:
+	
+	# Add to a counter of the innermost span of this thread
+	Record = CurrentSpan()
+	if Record is not None: Record[Key] = Record.get(Key, 0) + Value
+
+def ProfileNote(**Fields) -> None:
+	Record = CurrentSpan()
+	if Record is not None: Record.update(Fields)
+
+def ProfileChild(Stats: dict) -> None:
+	
+	# Subprocess resources, measured exactly by wait4 (None if not measured)
+	Record = CurrentSpan()
+	if Record is not None: Record["Children"].append({Key: Stats.get(Key) for Key in ["Name", "ReturnCode", "WallTime", "CPUTime", "MaxRSS"]})
+
+def PathSize(FileName: str) -> int:
+	if os.path.isdir(FileName): return sum([os.path.getsize(os.path.join(Root, Name)) for Root, _, Names in os.walk(FileName) for Name in Names])
+	return os.path.getsize(FileName) if os.path.isfile(FileName) else 0
+
+@contextmanager
+def Span(
+		Name: str,
+		Kind: str = "stage",
+		Block: Union[str, None] = None,
+		**Fields):
+	
+	# Nested spans of one thread form a tree (Parent); process-wide counters (ProcessCPUTime, IO, MaxRSS) include concurrent threads
+	if not hasattr(PROFILE_STACK, "Spans"): PROFILE_STACK.Spans = []
+	Parent = CurrentSpan()
+	Record = {
+		"Run": PROFILE["Run"],
+		"Id": f"{str(os.getpid())}.{str(next(PROFILE['Counter']))}",
+		"Parent": None if Parent is None else Parent["Id"],
+		"Name": Name,
+		"Kind": Kind,
+		"Block": Block if Block is not None else (None if Parent is None else Parent["Block"]),
+		"Thread": threading.current_thread().name,
+		"Start": time.time(),
+		"Status": "ok",
+		"BytesRead": 0,
+		"BytesWritten": 0,
+		"Children": [],
+		**Fields
+		}
+	StartWall, StartThreadCPU, StartSelf, StartChildren, StartIO = time.perf_counter(), time.thread_time(), resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN), ProcessIO()
+	PROFILE_STACK.Spans.append(Record)
+	try:
+		yield Record
+	except BaseException as Err:
+		Record["Status"] = f"error: {type(Err).__name__}"
+		raise
+	finally:
+		PROFILE_STACK.Spans.pop()
+		EndSelf, EndChildren, EndIO = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN), ProcessIO()
+		Record.update({
+			"WallTime": time.perf_counter() - StartWall,
+			"ThreadCPUTime": time.thread_time() - StartThreadCPU,
+			"ProcessCPUTime": (EndSelf.ru_utime + EndSelf.ru_stime) - (StartSelf.ru_utime + StartSelf.ru_stime),
+			"ChildrenCPUTime": sum([Child["CPUTime"] or 0 for Child in Record["Children"]]),
+			"ProcessChildrenCPUTime": (EndChildren.ru_utime + EndChildren.ru_stime) - (StartChildren.ru_utime + StartChildren.ru_stime),
+			"ProcessReadBytes": EndIO[0] - StartIO[0],
+			"ProcessWriteBytes": EndIO[1] - StartIO[1],
+			"MaxRSS": EndSelf.ru_maxrss * 1024, # bytes, Linux reports KB
+			"ChildrenMaxRSS": max([Child["MaxRSS"] or 0 for Child in Record["Children"]], default=0)
+			})
+		# Counters and subprocesses of nested spans are accounted in the parent too
+		if Parent is not None:
+			for Key in ["BytesRead", "BytesWritten"]: Parent[Key] += Record[Key]
+			Parent["Children"].extend(Record["Children"])
+		if PROFILE["File"] is not None:
+			Line = json.dumps(Record, ensure_ascii=False, default=str)
+			with PROFILE["Lock"]:
+				with open(PROFILE["File"], 'at') as File: File.write(Line + '\n')
+
+def Profiled(Function, Name: Union[str, None] = None, Kind: str = "stage", Block: Union[str, None] = None):
+	
+	# Wrap Function into a span, block name defaults to the name of its Logger
+	@functools.wraps(Function)
+	def Wrapper(*Args, **Kwargs):
+		Logger = Kwargs.get("Logger")
+		with Span(Name if Name is not None else Function.__name__, Kind = Kind, Block = Block if Block is not None else (Logger.name if isinstance(Logger, logging.Logger) else None)):
+			return Function(*Args, **Kwargs)
+	return Wrapper
+
+def ProfileReport(
+		ProfileFile: str,
+		Logger: logging.Logger,
+		ReportFile: Union[str, None] = None,
+		Run: Union[str, None] = None) -> dict:
+	
+	# Load spans
+	if not os.path.isfile(ProfileFile):
+		Logger.warning(f"Profile file '{ProfileFile}' not found")
+		return {}
+	with open(ProfileFile, 'rt') as File: Spans = pandas.DataFrame([json.loads(line) for line in File if line.strip()])
+	if Run is not None: Spans = Spans[Spans["Run"] == Run]
+	Spans["CPUTime"] = Spans["ThreadCPUTime"] + Spans["ChildrenCPUTime"]
+	Spans["Subprocesses"] = Spans["Children"].apply(len)
+	Stages = Spans[(Spans["Kind"] == "stage")].copy()
+	if "Cache" not in Stages: Stages["Cache"] = None
+	Columns = ["WallTime", "CPUTime", "ChildrenCPUTime", "BytesRead", "BytesWritten", "ProcessReadBytes", "ProcessWriteBytes", "ChildrenMaxRSS", "Subprocesses"]
+	
+	# Per-block: stages of each block
+	PerBlock = Stages[["Block", "Name", "Status", "Cache"] + Columns].sort_values(["Block", "WallTime"], ascending=[True, False]).reset_index(drop=True)
+	Blocks = Stages.groupby("Block")[Columns].sum().sort_values("WallTime", ascending=False)
+	
+	# Cross-block: the same stage across blocks
+	CrossBlock = Stages.groupby("Name").agg(
+		Count = ("WallTime", "size"),
+		WallTime = ("WallTime", "sum"),
+		MeanWallTime = ("WallTime", "mean"),
+		MaxWallTime = ("WallTime", "max"),
+		CPUTime = ("CPUTime", "sum"),
+		BytesRead = ("BytesRead", "sum"),
+		BytesWritten = ("BytesWritten", "sum"),
+		ChildrenMaxRSS = ("ChildrenMaxRSS", "max")
+		).sort_values("WallTime", ascending=False)
+	CrossBlock["WallShare"] = CrossBlock["WallTime"] / max(CrossBlock["WallTime"].sum(), 1e-9)
+	
+	# Hot paths: non-stage spans (I/O, tools) by name
+	HotPaths = Spans[Spans["Kind"] != "stage"].groupby(["Kind", "Name"]).agg(
+		Count = ("WallTime", "size"),
+		WallTime = ("WallTime", "sum"),
+		BytesRead = ("BytesRead", "sum"),
+		BytesWritten = ("BytesWritten", "sum")
+		).sort_values("WallTime", ascending=False)
+	
+	# Text report
+	Report = {"PerBlock": PerBlock, "Blocks": Blocks, "CrossBlock": CrossBlock, "HotPaths": HotPaths}
+	Text = '\n\n'.join([f"### {Title}\n{Table.to_string()}" for Title, Table in Report.items()])
+	if ReportFile is not None:
+		with open(ReportFile, 'wt') as File: File.write(Text + '\n')
+	for line in [f"Profile report: {str(len(Spans))} spans, {str(len(Stages))} stages, {str(Stages['Block'].nunique())} blocks"] + [f"{Stage} - %s (%.1f%%)" % (SecToTime(Row["WallTime"]), Row["WallShare"] * 100) for Stage, Row in CrossBlock.iterrows()]: Logger.info(line)
+	
+	# Return
+	return Report
+
 ## ------======| I/O |======------
 
 def GetContigs(FileBAM: str) -> list: return pysam.AlignmentFile(FileBAM, 'rb').header['SQ']
@@ -60,19 +236,173 @@ def GzipCheck(FileName: str) -> bool: return open(FileName, 'rb').read(2).hex()
 
 def Bzip2Check(FileName: str) -> bool: return open(FileName, 'rb').read(3).hex() == "425a68"
 
+# Magic bytes of supported compressions; BGZF is gzip with a "BC" extra subfield
+COMPRESSION_MAGIC = [("zstd", b'\x28\xb5\x2f\xfd'), ("bz2", b'BZh'), ("gzip", b'\x1f\x8b')]
+
+# Multithreaded decompressors, used if installed: {Compression: [(Tool, Command template), ...]}
+PARALLEL_DECOMPRESSORS = {
+	"bgzf": [("bgzip", "bgzip -@ {Threads} -dc"), ("pigz", "pigz -dc -p {Threads}")],
+	"gzip": [("pigz", "pigz -dc -p {Threads}")],
+	"bz2": [("lbzip2", "lbzip2 -dc -n {Threads}"), ("pbzip2", "pbzip2 -dc -p{Threads}")],
+	"zstd": [("zstd", "zstd -dcq -T{Threads}")]
+	}
+
+def SniffCompression(Header: bytes) -> str:
+	
+	# Compression by the first bytes of the file
+	for Name, Magic in COMPRESSION_MAGIC:
+		if Header.startswith(Magic): return "bgzf" if (Name == "gzip") and (len(Header) >= 14) and (Header[3] & 4) and (Header[12:14] == b'BC') else Name
+	return "none"
+
+class DecompressorStream(io.RawIOBase):
+	
+	# Raw stream from an external decompressor reading the given handle; its exit code is checked on close
+	def __init__(self, Command: str, Handle):
+		self.Command, self.Handle = Command, Handle
+		self.Process = subprocess.Popen(Command, shell=True, stdin=Handle, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0)
+	
+	def readable(self) -> bool: return True
+	
+	def readinto(self, Buffer) -> int: return self.Process.stdout.readinto(Buffer)
+	
+	def close(self) -> None:
+		if self.closed: return
+		super().close()
+		self.Process.stdout.close()
+		ReturnCode = self.Process.wait()
+		ErrorText = self.Process.stderr.read().decode('utf-8', errors='replace').strip()
+		self.Process.stderr.close()
+		self.Handle.close()
+		# Consumer stopped early: the decompressor gets SIGPIPE, which is fine
+		if ReturnCode not in (0, -13, 141): raise OSError(f"'{self.Command}' has returned exit code {str(ReturnCode)}: {ErrorText}")
+
 def OpenAnyway(FileName: str,
 		Mode: str,
-		Logger: logging.Logger):
+		Logger: logging.Logger,
+		Threads: int = 1,
+		BufferSize: int = 8 * 1024 * 1024):
 	
+	# Reading: compression is sniffed once from the same handle, multithreaded decompressor is used if Threads > 1 and one is installed.
+	# Writing/appending: compression follows the existing file, as before
 	try:
-		IsGZ = GzipCheck(FileName=FileName)
-		IsBZ2 = Bzip2Check(FileName=FileName)
-		return gzip.open(FileName, Mode) if IsGZ else (bz2.open(FileName, Mode) if IsBZ2 else open(FileName, Mode))
-	except OSError as Err:
+		if 'r' not in Mode:
+			IsGZ = os.path.isfile(FileName) and GzipCheck(FileName=FileName)
+			IsBZ2 = os.path.isfile(FileName) and Bzip2Check(FileName=FileName)
+			return gzip.open(FileName, Mode) if IsGZ else (bz2.open(FileName, Mode) if IsBZ2 else open(FileName, Mode))
+		Handle = open(FileName, 'rb', buffering=BufferSize)
+		Compression = SniffCompression(Handle.peek(18)[:18])
+		Tools = [Command for Tool, Command in PARALLEL_DECOMPRESSORS.get(Compression, []) if shutil.which(Tool) is not None]
+		Decompressor = Tools[0].format(Threads = Threads) if Tools and (Threads > 1 or Compression == "zstd") else None
+		if Compression == "none": Stream = Handle
+		elif Decompressor is not None:
+			# The decompressor reads the descriptor itself, so rewind it past the sniffed buffer
+			Handle.raw.seek(0)
+			Stream = io.BufferedReader(DecompressorStream(Decompressor, Handle), buffer_size=BufferSize)
+		elif Compression in ("gzip", "bgzf"): Stream = io.BufferedReader(gzip.GzipFile(fileobj=Handle, mode='rb'), buffer_size=BufferSize)
+		elif Compression == "bz2": Stream = io.BufferedReader(bz2.BZ2File(Handle, mode='rb'), buffer_size=BufferSize)
+		else:
+			import zstandard
+			Stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(Handle, closefd=True), buffer_size=BufferSize)
+		Logger.debug(f"OpenAnyway: '{FileName}', compression: {Compression}, decompressor: {Decompressor or 'in-process'}")
+		# Plain 'r' keeps the old gzip.open / bz2.open behaviour: bytes for compressed files, text otherwise
+		Binary = 'b' in Mode or ('t' not in Mode and Compression != "none")
+		return Stream if Binary else io.TextIOWrapper(Stream, encoding='utf-8')
+	except (OSError, ImportError) as Err:
 		ErrorMessage = f"Can't open the file '{FileName}' ({Err})"
 		Logger.error(ErrorMessage)
 		raise OSError(ErrorMessage)
 
+def ReadBlocks(
+		FileName: str,
+		Logger: logging.Logger,
+		BlockSize: int = 64 * 1024 * 1024,
+		Threads: int = 1):
+	
+	# Yields large byte blocks cut at line boundaries
+	with OpenAnyway(FileName, 'rb', Logger, Threads = Threads, BufferSize = BlockSize) as File:
+		Tail = b''
+		while True:
+			Block = File.read(BlockSize)
+			if not Block: break
+			ProfileCount("BytesRead", len(Block))
+			Block = Tail + Block
+			Cut = Block.rfind(b'\n') + 1
+			Tail = Block[Cut:]
+			if Cut: yield Block[:Cut]
+		if Tail: yield Tail + b'\n'
+
+def ReadLines(
+		FileName: str,
+		Logger: logging.Logger,
+		Threads: int = 1,
+		BlockSize: int = 8 * 1024 * 1024):
+	
+	# Binary line iterator (with line ends); uncompressed files are memory-mapped, others read in blocks
+	with open(FileName, 'rb') as Handle:
+		if os.fstat(Handle.fileno()).st_size and SniffCompression(Handle.read(18)) == "none":
+			with mmap.mmap(Handle.fileno(), 0, access=mmap.ACCESS_READ) as Map:
+				Start = 0
+				while True:
+					End = Map.find(b'\n', Start)
+					if End == -1: break
+					yield Map[Start:End + 1]
+					Start = End + 1
+				if Start < len(Map): yield Map[Start:] + b'\n'
+				ProfileCount("BytesRead", len(Map))
+			return
+	for Block in ReadBlocks(FileName, Logger, BlockSize = BlockSize, Threads = Threads): yield from io.BytesIO(Block)
+
+def PrivateCopy(Source: str, Dest: str, Hardlink: bool = False) -> None:
+	
+	# Hardlink (for tools which do not modify the file in place) or reflink, falling back to a full copy
+	if Hardlink:
+		try:
+			os.link(Source, Dest)
+			return
+		except OSError:
+			pass
+	ProfileCount("BytesWritten", PathSize(Source))
+	Result = subprocess.run(["cp", "--reflink=auto", "--preserve=timestamps", Source, Dest], stderr=subprocess.PIPE)
+	if Result.returncode != 0: raise OSError(f"Can't copy '{Source}' to '{Dest}' ({Result.stderr.decode('utf-8').strip()})")
+
+def LinkOrCopy(Source: str, Dest: str) -> None:
+	
+	# Atomically publish Source as Dest: hardlink if possible (same filesystem), else copy
+	TempFile = os.path.join(os.path.dirname(os.path.abspath(Dest)), f".{os.path.basename(Dest)}.{str(os.getpid())}.{str(threading.get_ident())}.tmp")
+	with Span("LinkOrCopy", Kind = "io", Source = Source):
+		PrivateCopy(Source, TempFile, Hardlink=True)
+		os.replace(TempFile, Dest)
+
+def CopyOrReflink(Source: str, Dest: str) -> None:
+	
+	# Atomically publish a private copy of Source as Dest (reflink or full copy, never a hardlink): in-place changes of one do not reach the other
+	TempFile = os.path.join(os.path.dirname(os.path.abspath(Dest)), f".{os.path.basename(Dest)}.{str(os.getpid())}.{str(threading.get_ident())}.tmp")
+	with Span("CopyOrReflink", Kind = "io", Source = Source):
+		PrivateCopy(Source, TempFile)
+		os.replace(TempFile, Dest)
+
+@contextmanager
+def StageOutput(
+		OutputFile: str,
+		Logger: logging.Logger,
+		Source: Union[str, None] = None,
+		Hardlink: bool = False):
+	
+	# Yields temp file name on the same filesystem as OutputFile, which is atomically renamed to OutputFile on success.
+	# If Source is given, temp file starts as its private copy (reflink or hardlink, see PrivateCopy)
+	OutputDir = os.path.dirname(os.path.abspath(OutputFile))
+	os.makedirs(OutputDir, exist_ok=True)
+	TempDir = tempfile.mkdtemp(dir=OutputDir, prefix=f".{os.path.basename(OutputFile)}.")
+	try:
+		TempFile = os.path.join(TempDir, os.path.basename(OutputFile))
+		if Source is not None: PrivateCopy(Source, TempFile, Hardlink=Hardlink)
+		yield TempFile
+		ProfileCount("BytesWritten", PathSize(TempFile))
+		os.replace(TempFile, OutputFile)
+		Logger.debug(f"Output published: {OutputFile}")
+	finally:
+		shutil.rmtree(TempDir, ignore_errors=True)
+
 def GenerateFileNames(
 		Unit: dict,
 		Options: dict) -> dict:
@@ -96,13 +426,123 @@ def GenerateFileNames(
 	}
 	return FileNames
 
+## ------======| STAGE CACHE |======------
+
+def FileSignature(FileName: str, Digest: bool = False) -> str:
+	
+	# Content digest, or size and mtime for quick checks
+	if not Digest:
+		Stat = os.stat(FileName)
+		return f"{str(Stat.st_size)}:{str(Stat.st_mtime_ns)}"
+	Hash = hashlib.sha256()
+	with open(FileName, 'rb') as File:
+		for Block in iter(functools.partial(File.read, 16 * 1024 * 1024), b''): Hash.update(Block)
+	return Hash.hexdigest()
+
+def StageKey(
+		Name: str,
+		Inputs: list,
+		Params: dict,
+		Digest: bool = False) -> str:
+	
+	# Hash of stage name, input files and parameters (incl. tool versions)
+	Data = {
+		"Name": Name,
+		"Inputs": [FileSignature(item, Digest=Digest) for item in Inputs],
+		"Params": {Key: str(Value) for Key, Value in sorted(Params.items())}
+		}
+	return hashlib.sha256(json.dumps(Data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def EvictCache(
+		CacheDir: str,
+		Quota: float,
+		Logger: logging.Logger,
+		Keep: Union[str, None] = None) -> None:
+	
+	# Remove least recently used entries (except Keep) until cache size [GB] is under quota
+	Entries = []
+	for Entry in glob.glob(os.path.join(CacheDir, '*', 'manifest.json')):
+		EntryDir = os.path.dirname(Entry)
+		Size = sum([os.path.getsize(os.path.join(EntryDir, item)) for item in os.listdir(EntryDir)])
+		Entries.append((os.path.getmtime(Entry), Size, EntryDir))
+	Total = sum([item[1] for item in Entries])
+	for _, Size, EntryDir in sorted(Entries):
+		if Total <= Quota * (1024 ** 3): break
+		if os.path.basename(EntryDir) == Keep: continue
+		Logger.info(f"Cache entry '{os.path.basename(EntryDir)}' evicted ({Size / (1024 ** 3):.2f} GB)")
+		shutil.rmtree(EntryDir, ignore_errors=True)
+		Total -= Size
+
+def RunCached(
+		Function,
+		Name: str,
+		Inputs: list,
+		Outputs: list,
+		CacheDir: Union[str, None],
+		Logger: logging.Logger,
+		Params: dict = {},
+		Quota: float = 500,
+		Digest: bool = False,
+		**Kwargs) -> None:
+	
+	# Run Function(**Kwargs), or restore its Outputs from the cache entry of the same inputs and params
+	if CacheDir is None:
+		ProfileNote(Cache = "off")
+		return Function(Logger=Logger, **Kwargs)
+	Key = StageKey(Name, Inputs, Params, Digest=Digest)
+	EntryDir = os.path.join(CacheDir, Key)
+	Manifest = os.path.join(EntryDir, 'manifest.json')
+	# Entries are private read-only copies; the key is built from inputs only, so entries changed after saving are dropped
+	Entries = [os.path.join(EntryDir, f"{str(Number)}.{os.path.basename(Output)}") for Number, Output in enumerate(Outputs)]
+	if os.path.isfile(Manifest):
+		Signatures = json.load(open(Manifest, 'rt')).get("Signatures")
+		if Signatures is not None and all([os.path.isfile(Entry) and FileSignature(Entry) == Signature for Entry, Signature in zip(Entries, Signatures)]):
+			for Entry, Output in zip(Entries, Outputs):
+				os.makedirs(os.path.dirname(os.path.abspath(Output)), exist_ok=True)
+				CopyOrReflink(Entry, Output)
+				os.chmod(Output, 0o644)
+			os.utime(Manifest)
+			ProfileNote(Cache = "hit")
+			Logger.info(f"{Name} restored from cache '{Key}'")
+			return
+		Logger.warning(f"{Name}: cache entry '{Key}' has changed since it was saved, dropped")
+		shutil.rmtree(EntryDir, ignore_errors=True)
+	ProfileNote(Cache = "miss")
+	Result = Function(Logger=Logger, **Kwargs)
+	os.makedirs(EntryDir, exist_ok=True)
+	for Output, Entry in zip(Outputs, Entries):
+		CopyOrReflink(Output, Entry)
+		os.chmod(Entry, 0o444)
+	SaveJSON({"Name": Name, "Inputs": Inputs, "Outputs": Outputs, "Params": {Key: str(Value) for Key, Value in Params.items()}, "Signatures": [FileSignature(Entry) for Entry in Entries]}, Manifest)
+	Logger.info(f"{Name} saved to cache '{Key}'")
+	EvictCache(CacheDir, Quota, Logger, Keep=Key)
+	return Result
+
 ## ------======| THREADING |======------
 
+# Set while RunDAG runs tasks on its executor threads
+SCHEDULER = {"Running": False}
+
+@contextmanager
+def Scheduling():
+	SCHEDULER["Running"] = True
+	try:
+		yield
+	finally:
+		SCHEDULER["Running"] = False
+
 @contextmanager
 def Threading(Name: str,
 		Logger: logging.Logger,
 		Threads: int) -> None:
 	
+	# A fresh fork from a scheduler task would inherit locks held by other threads: stages use WorkerPool instead
+	if SCHEDULER["Running"] or threading.current_thread() is not threading.main_thread():
+		ErrorMessage = f"{Name}: Threading() forks a new pool and can't be used in RunDAG tasks, use WorkerPool"
+		Logger.error(ErrorMessage)
+		raise RuntimeError(ErrorMessage)
+	
 	# Timestamp
 	StartTime = time.time()
 	
@@ -116,6 +556,236 @@ def Threading(Name: str,
 	# Timestamp
 	Logger.info(f"{Name} finished on {str(Threads)} threads, summary time - %s" % (SecToTime(time.time() - StartTime)))
 
+def BoundedImap(
+		Pool,
+		Function,
+		Iterable,
+		Window: int):
+	
+	# Like Pool.imap, but keeps at most Window tasks in flight, so that large inputs are not queued at once
+	Queue = collections.deque()
+	for Item in Iterable:
+		Queue.append(Pool.apply_async(Function, (Item,)))
+		if len(Queue) >= Window: yield Queue.popleft().get()
+	while Queue: yield Queue.popleft().get()
+
+# Persistent process pool shared by all stages, and shared arrays attached by this (worker) process
+PROCESS_POOL = {"Pool": None, "Size": 0}
+SHARED_ARRAYS = {}
+
+def StartProcessPool(Threads: int = cpu_count()) -> None:
+	
+	# Workers are forked once and live until exit. Fork must happen before any other thread is started
+	# (children of a threaded process may inherit held logging or executor locks), so call it before RunDAG.
+	# Task functions must be module-level and defined by then
+	if PROCESS_POOL["Pool"] is not None: return
+	if threading.active_count() > 1:
+		ErrorMessage = f"Process pool must be started before other threads, call StartProcessPool() before RunDAG"
+		logging.getLogger(__name__).error(ErrorMessage)
+		raise RuntimeError(ErrorMessage)
+	PROCESS_POOL.update({"Pool": Pool(Threads), "Size": Threads})
+	atexit.register(PROCESS_POOL["Pool"].terminate)
+
+def ProcessPool():
+	
+	# Started on first use if the process is still single-threaded
+	if PROCESS_POOL["Pool"] is None: StartProcessPool()
+	return PROCESS_POOL["Pool"]
+
+class SharedArrays:
+	
+	# NumPy arrays copied once to shared memory; workers get the descriptors only and attach read-only zero-copy views
+	def __init__(self, Arrays: dict):
+		self.Blocks, self.Descriptors = {}, {}
+		try:
+			for Name, Array in Arrays.items():
+				Array = numpy.ascontiguousarray(Array)
+				Block = shared_memory.SharedMemory(create=True, size=max(Array.nbytes, 1))
+				self.Blocks[Name] = Block
+				numpy.ndarray(Array.shape, dtype=Array.dtype, buffer=Block.buf)[...] = Array
+				self.Descriptors[Name] = (Block.name, Array.shape, Array.dtype.str)
+		except BaseException:
+			self.close()
+			raise
+	
+	def Size(self) -> int: return sum([Block.size for Block in self.Blocks.values()])
+	
+	def close(self) -> None:
+		for Block in self.Blocks.values():
+			Block.close()
+			Block.unlink()
+		self.Blocks = {}
+	
+	def __enter__(self): return self
+	
+	def __exit__(self, *Args): self.close()
+
+def AttachArrays(Descriptors: dict) -> dict:
+	
+	# Worker side: attachments are reused by the tasks of one map, those of finished maps are released
+	Names = set([Descriptor[0] for Descriptor in Descriptors.values()])
+	for BlockName in [Item for Item in SHARED_ARRAYS if Item not in Names]:
+		Block, _ = SHARED_ARRAYS.pop(BlockName)
+		try:
+			Block.close()
+		except BufferError:
+			pass
+	Arrays = {}
+	for Name, (BlockName, Shape, DType) in Descriptors.items():
+		if BlockName not in SHARED_ARRAYS:
+			Block = shared_memory.SharedMemory(name=BlockName)
+			# The owner unlinks the block, attached workers must not
+			resource_tracker.unregister(Block._name, "shared_memory")
+			View = numpy.ndarray(Shape, dtype=DType, buffer=Block.buf)
+			View.flags.writeable = False
+			SHARED_ARRAYS[BlockName] = (Block, View)
+		Arrays[Name] = SHARED_ARRAYS[BlockName][1]
+	return Arrays
+
+def SharedTask(Chunk: list, Function, Descriptors: dict, Kwargs: dict) -> dict:
+	
+	# Worker side: a chunk of (index, item); the first error is returned with its traceback
+	StartTime, StartCPU = time.perf_counter(), time.process_time()
+	Extra = {"Arrays": AttachArrays(Descriptors)} if Descriptors else {}
+	Results = []
+	for Index, Item in Chunk:
+		try:
+			Results.append(Function(Item, **Extra, **Kwargs))
+		except Exception:
+			return {"Error": (Index, traceback.format_exc()), "Pid": os.getpid()}
+	return {"Results": Results, "WallTime": time.perf_counter() - StartTime, "CPUTime": time.process_time() - StartCPU, "Pid": os.getpid()}
+
+class WorkerPool:
+	
+	# Persistent process pool with shared arrays: Map(Function, Items, **Kwargs) calls Function(Item, Arrays = {Name: view}, **Kwargs)
+	# (without Arrays if there are none) in chunks of ChunkSize items, yields results in order, logs and raises the first worker error.
+	# The pool is shared between stages, each keeps at most Threads chunks in flight
+	def __init__(self, Name: str, Logger: logging.Logger, Threads: int, Arrays: dict = {}, ChunkSize: int = 1):
+		self.Name, self.Logger, self.ChunkSize = Name, Logger, ChunkSize
+		self.Pool = ProcessPool()
+		self.Threads = max(1, min(Threads, PROCESS_POOL["Size"]))
+		self.Shared = SharedArrays(Arrays)
+		if Arrays: Logger.debug(f"{Name}: {str(len(Arrays))} arrays in shared memory, {self.Shared.Size() / (1024 ** 2):.1f} MB")
+	
+	def Chunks(self, Items, ChunkSize: int):
+		Chunk = []
+		for Index, Item in enumerate(Items):
+			Chunk.append((Index, Item))
+			if len(Chunk) >= ChunkSize:
+				yield Chunk
+				Chunk = []
+		if Chunk: yield Chunk
+	
+	def Map(self, Function, Items, Window: Union[int, None] = None, ChunkSize: Union[int, None] = None, **Kwargs):
+		StartTime = time.time()
+		Stats = {"Tasks": 0, "Chunks": 0, "WallTime": 0, "CPUTime": 0, "Workers": set()}
+		Task = functools.partial(SharedTask, Function = Function, Descriptors = self.Shared.Descriptors, Kwargs = Kwargs)
+		for Result in BoundedImap(self.Pool, Task, self.Chunks(Items, ChunkSize or self.ChunkSize), Window = Window or self.Threads):
+			if "Error" in Result:
+				Index, Details = Result["Error"]
+				ErrorMessages = [f"{self.Name}: task {str(Index)} has failed in worker {str(Result['Pid'])}", f"Details: {Details}"]
+				for line in ErrorMessages: self.Logger.error(line)
+				raise RuntimeError('\n'.join(ErrorMessages))
+			Stats["Tasks"], Stats["Chunks"] = Stats["Tasks"] + len(Result["Results"]), Stats["Chunks"] + 1
+			Stats["WallTime"], Stats["CPUTime"] = Stats["WallTime"] + Result["WallTime"], Stats["CPUTime"] + Result["CPUTime"]
+			Stats["Workers"].add(Result["Pid"])
+			yield from Result["Results"]
+		WallTime = time.time() - StartTime
+		self.Logger.info(f"{self.Name}: {Stats['Tasks']:,} tasks in {Stats['Chunks']:,} chunks on {str(len(Stats['Workers']))}/{str(self.Threads)} workers - %s, worker time %s (%.0f%% busy), worker CPU time %s" % (SecToTime(WallTime), SecToTime(Stats["WallTime"]), Stats["WallTime"] * 100 / max(WallTime * self.Threads, 1e-9), SecToTime(Stats["CPUTime"])))
+	
+	def close(self) -> None: self.Shared.close()
+	
+	def __enter__(self): return self
+	
+	def __exit__(self, *Args): self.close()
+
+def TotalMemory() -> float: return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 ** 3)
+
+def RunDAG(
+		Tasks: dict,
+		Logger: logging.Logger,
+		Threads: int = cpu_count(),
+		Memory: float = TotalMemory()) -> None:
+	
+	# Tasks: {Name: {"Function": callable, "Kwargs": dict, "Depends": [Name, ...], "Threads": (Min, Max), "Memory": GB}}
+	# Multithreaded tasks (Max > 1) get a share of free cores as Kwargs["Threads"], single-threaded ones are packed into the rest
+	StartTime = time.time()
+	
+	# Unknown dependencies and cycles would leave the loop with nothing to run
+	Unknown = sorted({f"{Name} -> {item}" for Name, Task in Tasks.items() for item in Task.get("Depends", []) if item not in Tasks})
+	if Unknown:
+		ErrorMessage = f"Unknown dependencies: {', '.join(Unknown)}"
+		Logger.error(ErrorMessage)
+		raise ValueError(ErrorMessage)
+	Waiting = {Name: len(set(Task.get("Depends", []))) for Name, Task in Tasks.items()}
+	Dependents = collections.defaultdict(list)
+	for Name, Task in Tasks.items():
+		for item in set(Task.get("Depends", [])): Dependents[item].append(Name)
+	Stack = [Name for Name, Count in Waiting.items() if Count == 0]
+	while Stack:
+		for item in Dependents[Stack.pop()]:
+			Waiting[item] -= 1
+			if Waiting[item] == 0: Stack.append(item)
+	Cyclic = sorted([Name for Name, Count in Waiting.items() if Count > 0])
+	if Cyclic:
+		ErrorMessage = f"Dependency cycle between tasks: {', '.join(Cyclic)}"
+		Logger.error(ErrorMessage)
+		raise ValueError(ErrorMessage)
+	
+	Done, Failed, Running = set(), set(), {}
+	FreeThreads, FreeMemory = Threads, Memory
+	Logger.info(f"RunDAG: {len(Tasks)} tasks on {str(Threads)} threads, {Memory:.1f} GB")
+	with Scheduling(), concurrent.futures.ThreadPoolExecutor(max_workers=max(len(Tasks), 1)) as Executor:
+		while len(Done) + len(Failed) < len(Tasks):
+			
+			# Skip tasks depending on failed ones
+			for Name, Task in Tasks.items():
+				if Name not in Done and Name not in Failed and any(item in Failed for item in Task.get("Depends", [])):
+					Logger.error(f"Task '{Name}' skipped, dependency failed")
+					Failed.add(Name)
+			
+			# Start ready tasks, multithreaded first
+			Ready = [Name for Name, Task in Tasks.items() if Name not in Done and Name not in Failed and Name not in Running and all(item in Done for item in Task.get("Depends", []))]
+			Ready.sort(key=lambda Name: -Tasks[Name].get("Threads", (1, 1))[1])
+			Multithreaded = len([Name for Name in Ready if Tasks[Name].get("Threads", (1, 1))[1] > 1])
+			# One thread is held back for each ready single-threaded task (up to half of the machine), the rest is split between multithreaded ones
+			Reserved = min(len(Ready) - Multithreaded, Threads // 2)
+			for Name in Ready:
+				Task = Tasks[Name]
+				MinThreads, MaxThreads = Task.get("Threads", (1, 1))
+				TaskMemory = Task.get("Memory", 0)
+				Oversized = FreeThreads < MinThreads or FreeMemory < TaskMemory
+				if Oversized and (Running or FreeThreads < Threads): continue
+				Share = max(MinThreads, min(MaxThreads, max(FreeThreads - Reserved, 0) // max(Multithreaded, 1))) if MaxThreads > 1 else MinThreads
+				# Task which does not fit the machine runs alone, on what is there
+				if Oversized: Share = min(Share, max(FreeThreads, 1))
+				if MaxThreads > 1: Multithreaded -= 1
+				Kwargs = dict(Task.get("Kwargs", {}))
+				if MaxThreads > 1: Kwargs["Threads"] = Share
+				FreeThreads, FreeMemory = FreeThreads - Share, FreeMemory - TaskMemory
+				Logger.info(f"Task '{Name}' started on {str(Share)} threads, {TaskMemory:.1f} GB")
+				Running[Name] = (Executor.submit(Task["Function"], **Kwargs), Share, TaskMemory, time.time())
+			if not Running: continue
+			
+			# Wait for any task
+			Finished, _ = concurrent.futures.wait([item[0] for item in Running.values()], return_when=concurrent.futures.FIRST_COMPLETED)
+			for Name in [Name for Name, item in Running.items() if item[0] in Finished]:
+				Future, Share, TaskMemory, TaskStartTime = Running.pop(Name)
+				FreeThreads, FreeMemory = FreeThreads + Share, FreeMemory + TaskMemory
+				if Future.exception() is not None:
+					Logger.error(f"Task '{Name}' failed: {Future.exception()}")
+					Failed.add(Name)
+				else:
+					Logger.info(f"Task '{Name}' finished - %s" % (SecToTime(time.time() - TaskStartTime)))
+					Done.add(Name)
+	
+	# Timestamp
+	Logger.info(f"RunDAG finished, summary time - %s" % (SecToTime(time.time() - StartTime)))
+	if Failed:
+		ErrorMessage = f"{len(Failed)} tasks failed or skipped: {', '.join(sorted(Failed))}"
+		Logger.error(ErrorMessage)
+		raise RuntimeError(ErrorMessage)
+
 ## ------======| SUBPROCESS |======------
 
 def SimpleSubprocess(
@@ -136,6 +806,7 @@ def SimpleSubprocess(
 	# Shell
 	Shell = subprocess.Popen(Command, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	Stdout, Stderr = Shell.communicate()
+	ProfileChild({"Name": Name, "ReturnCode": Shell.returncode, "WallTime": time.time() - StartTime, "CPUTime": None, "MaxRSS": None})
 	if Shell.returncode != 0 and Shell.returncode not in AllowedCodes:
 		ErrorMessages = [
 			f"Command '{Name}' has returned non-zero exit code [{str(Shell.returncode)}]",
@@ -152,6 +823,64 @@ def SimpleSubprocess(
 	# Return
 	return Stdout[:-1]
 
+def StreamingSubprocess(
+		Name: str,
+		Command: str,
+		Logger: logging.Logger,
+		CheckPipefail: bool = False,
+		Env: Union[str, None] = None,
+		AllowedCodes: list = [],
+		TailLines: int = 100) -> dict:
+	
+	# Timestamp
+	StartTime = time.time()
+	
+	# Compose command
+	Command = (f"source {Env}; " if Env is not None else f"") + (f"set -o pipefail; " if CheckPipefail else f"") + Command
+	Logger.debug(Command)
+	
+	# Shell: stdout/stderr are forwarded to Logger line by line, only a bounded tail is kept for error reports
+	Shell = subprocess.Popen(Command, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	Tails = {"stdout": collections.deque(maxlen=TailLines), "stderr": collections.deque(maxlen=TailLines)}
+	def Forward(Stream, StreamName):
+		for Line in iter(Stream.readline, b''):
+			Line = Line.decode('utf-8', errors='replace').rstrip('\n')
+			Tails[StreamName].append(Line)
+			Logger.debug(f"[{Name}:{StreamName}] {Line}")
+		Stream.close()
+	Readers = [threading.Thread(target=Forward, args=(Shell.stdout, "stdout"), daemon=True), threading.Thread(target=Forward, args=(Shell.stderr, "stderr"), daemon=True)]
+	for Reader in Readers: Reader.start()
+	
+	# Resource accounting
+	_, Status, Usage = os.wait4(Shell.pid, 0)
+	Shell.returncode = os.waitstatus_to_exitcode(Status)
+	for Reader in Readers: Reader.join()
+	Stats = {
+		"Name": Name,
+		"ReturnCode": Shell.returncode,
+		"WallTime": time.time() - StartTime,
+		"CPUTime": Usage.ru_utime + Usage.ru_stime,
+		"MaxRSS": Usage.ru_maxrss * 1024, # bytes, Linux reports KB
+		"Stdout": list(Tails["stdout"]),
+		"Stderr": list(Tails["stderr"])
+		}
+	ProfileChild(Stats)
+	if Shell.returncode != 0 and Shell.returncode not in AllowedCodes:
+		ErrorMessages = [
+			f"Command '{Name}' has returned non-zero exit code [{str(Shell.returncode)}]",
+			f"Command: {Command}",
+			f"Details (last {str(TailLines)} lines): " + '\n'.join(Stats["Stderr"])
+			]
+		for line in ErrorMessages: Logger.error(line)
+		raise OSError(f"{ErrorMessages[0]}\n{ErrorMessages[2]}")
+	if Shell.returncode in AllowedCodes: Logger.warning(f"Command '{Name}' has returned ALLOWED non-zero exit code [{str(Shell.returncode)}]")
+	
+	# Timestamp
+	Logger.info(f"{Name} - %s, CPU time %s, peak RSS %.1f MB" % (SecToTime(Stats["WallTime"]), SecToTime(Stats["CPUTime"]), Stats["MaxRSS"] / (1024 ** 2)))
+	
+	# Return
+	return Stats
+
 ## ------======| MISC |======------
 
 def SecToTime(Sec: float) -> str: return str(datetime.timedelta(seconds=int(Sec)))
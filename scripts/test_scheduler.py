@@ -0,0 +1,36 @@
+import logging
+import threading
+
+import pytest
+
+from SharedFunctions import RunDAG
+
+
+def test_single_threaded_task_starts_with_multithreaded():
+
+	# Both tasks are ready at once: the multithreaded one must leave a thread to the single-threaded one
+	SingleStarted, Result = threading.Event(), {}
+	def Multi(Threads):
+		Result["Threads"] = Threads
+		Result["Overlap"] = SingleStarted.wait(timeout=10)
+	Tasks = {
+		"Multi": {"Function": Multi, "Threads": (1, 8)},
+		"Single": {"Function": SingleStarted.set, "Threads": (1, 1)}}
+	RunDAG(Tasks, Logger = logging.getLogger(__name__), Threads = 4, Memory = 1)
+	assert Result == {"Threads": 3, "Overlap": True}
+
+
+def test_multithreaded_tasks_share_threads():
+
+	Shares = {}
+	Tasks = {Name: {"Function": lambda Threads, Name = Name: Shares.update({Name: Threads}), "Threads": (1, 8)} for Name in ["A", "B"]}
+	RunDAG(Tasks, Logger = logging.getLogger(__name__), Threads = 8, Memory = 1)
+	assert Shares == {"A": 4, "B": 4}
+
+
+@pytest.mark.parametrize("Tasks", [
+	{"A": {"Function": print, "Depends": ["Missing"]}},
+	{"A": {"Function": print, "Depends": ["B"]}, "B": {"Function": print, "Depends": ["A"]}}])
+def test_broken_graph_raises(Tasks):
+	with pytest.raises(ValueError):
+		RunDAG(Tasks, Logger = logging.getLogger(__name__), Threads = 2, Memory = 1)